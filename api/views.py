@@ -1,5 +1,4 @@
 import os
-import requests
 import secrets
 import certifi
 from datetime import timedelta
@@ -11,7 +10,7 @@ from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.utils import timezone
 from django.utils.timezone import localtime, now
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.core.mail import get_connection, EmailMultiAlternatives, send_mail
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -23,7 +22,8 @@ from rest_framework import status
 from api.serializers import CustomTokenObtainPairSerializer, ForgotPasswordSerializer, ResetPasswordSerializer
 from subscriptions.models import StripeStatus, Subscription
 from users.models import User
-from campaigns.models import Campaign
+from utils.http_client import http_get, http_post
+from campaigns.models import Campaign, CampaignDailyStats
 from leads.models import Lead, LeadStatus
 from emails.models import EmailLog, EmailReplyTracking
 
@@ -235,7 +235,7 @@ class GoogleCallbackView(APIView):
             "grant_type": "authorization_code",
         }
 
-        token_response = requests.post(token_request_url, data=token_request_data)
+        token_response = http_post(token_request_url, idempotent=False, data=token_request_data)
         if token_response.status_code != 200:
             return Response({"error": "Failed to retrieve token."}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -247,7 +247,7 @@ class GoogleCallbackView(APIView):
 
         # Verifica l'ID token e ottieni i dati dell'utente
         user_info_url = "https://oauth2.googleapis.com/tokeninfo"
-        user_info_response = requests.get(user_info_url, params={"id_token": id_token})
+        user_info_response = http_get(user_info_url, params={"id_token": id_token})
 
         if user_info_response.status_code != 200:
             return Response({"error": "Failed to retrieve user info."}, status=status.HTTP_400_BAD_REQUEST)
@@ -329,6 +329,14 @@ class TestEmailView(APIView):
 
 
 class DashboardStatsView(APIView):
+    """
+    Statistiche della dashboard negli ultimi `range` giorni (default 90), con il trend rispetto
+    al periodo precedente, lette da CampaignDailyStats:
+    - leads_count: lead aggiunti nel periodo;
+    - replies_count: lead che hanno risposto per la prima volta nel periodo;
+    - reply_rate: replies_count sui lead contattati per la prima volta nel periodo
+      (non più sui lead creati nel periodo con stato "contacted").
+    """
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -351,33 +359,30 @@ class DashboardStatsView(APIView):
 
         # === CURRENT PERIOD ===
         campaigns_current = Campaign.objects.filter(user=user, created_at__gte=start_date_current)
-        leads_current = Lead.objects.filter(campaign__user=user, created_at__gte=start_date_current)
-        contacted_leads_current = leads_current.filter(status=LeadStatus.CONTACTED)
-        replies_current = EmailReplyTracking.objects.filter(
-            lead__campaign__user=user,
-            received_at__gte=start_date_current
-        ).distinct('lead')
+        # Lead, contatti e risposte dalle metriche giornaliere (una riga per campagna e giorno)
+        daily_stats = CampaignDailyStats.objects.filter(campaign__user=user)
+        totals_current = daily_stats.filter(date__gte=localtime(start_date_current).date()).aggregate(
+            leads=Sum('leads'), contacted=Sum('contacted'), replied_leads=Sum('replied_leads')
+        )
 
         # === PREVIOUS PERIOD ===
         campaigns_prev = Campaign.objects.filter(user=user, created_at__range=(start_date_previous, end_date_previous))
-        leads_prev = Lead.objects.filter(campaign__user=user, created_at__range=(start_date_previous, end_date_previous))
-        contacted_leads_prev = leads_prev.filter(status=LeadStatus.CONTACTED)
-        replies_prev = EmailReplyTracking.objects.filter(
-            lead__campaign__user=user,
-            received_at__range=(start_date_previous, end_date_previous)
-        ).distinct('lead')
+        totals_prev = daily_stats.filter(
+            date__gte=localtime(start_date_previous).date(),
+            date__lt=localtime(end_date_previous).date()
+        ).aggregate(leads=Sum('leads'), contacted=Sum('contacted'), replied_leads=Sum('replied_leads'))
 
         # === Count ===
         campaigns_count = campaigns_current.count()
-        leads_count = leads_current.count()
-        replies_count = replies_current.count()
-        contacted_leads_count = contacted_leads_current.count()
+        leads_count = totals_current['leads'] or 0
+        replies_count = totals_current['replied_leads'] or 0
+        contacted_leads_count = totals_current['contacted'] or 0
 
         # === Previous Count ===
         campaigns_count_prev = campaigns_prev.count()
-        leads_count_prev = leads_prev.count()
-        replies_count_prev = replies_prev.count()
-        contacted_leads_prev_count = contacted_leads_prev.count()
+        leads_count_prev = totals_prev['leads'] or 0
+        replies_count_prev = totals_prev['replied_leads'] or 0
+        contacted_leads_prev_count = totals_prev['contacted'] or 0
 
         # === DEBUG: stampa i conteggi
         # print("📊 CURRENT PERIOD")
@@ -443,25 +448,17 @@ class GlobalEmailPerformanceView(APIView):
             for date in date_range
         }
 
-        # EMAIL INVIATE
-        sent_data = EmailLog.objects.filter(
-            lead__campaign__user=user,
-            sent_at__date__gte=start_date
-        ).values('sent_at__date').annotate(count=Count('id'))
-
-        for entry in sent_data:
-            date_str = entry['sent_at__date'].isoformat()
-            analytics_data[date_str]["sent"] = entry["count"]
-
-        # RISPOSTE
-        reply_data = EmailReplyTracking.objects.filter(
-            lead__campaign__user=user,
-            received_at__date__gte=start_date
-        ).values('received_at__date').annotate(count=Count('id'))
-
-        for entry in reply_data:
-            date_str = entry['received_at__date'].isoformat()
-            analytics_data[date_str]["replied"] = entry["count"]
+        # EMAIL INVIATE E RISPOSTE: metriche giornaliere di tutte le campagne dell'utente
+        daily_data = CampaignDailyStats.objects.filter(
+            campaign__user=user,
+            date__gte=start_date
+        ).values('date').annotate(sent=Sum('sent'), replied=Sum('replied'))
+
+        for entry in daily_data:
+            date_str = entry['date'].isoformat()
+            if date_str in analytics_data:
+                analytics_data[date_str]["sent"] = entry["sent"]
+                analytics_data[date_str]["replied"] = entry["replied"]
 
         return Response(list(analytics_data.values()))    
 
@@ -0,0 +1,66 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.functions import TruncDate
+from django.utils.timezone import localdate
+from campaigns.models import CampaignDailyStats
+from emails.models import EmailClickTracking, EmailLog, EmailOpenTracking, EmailReplyTracking
+from leads.models import Lead, LeadStatus
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce CampaignDailyStats a partire da lead, email inviate, aperture, click e risposte"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--campaign", help="ID della campagna da ricostruire (default: tutte)")
+
+    def handle(self, *args, **options):
+        campaign_id = options["campaign"]
+        stats = defaultdict(lambda: defaultdict(int))  # (campaign_id, giorno) -> {campo: valore}
+
+        def scope(queryset, campaign_field):
+            return queryset.filter(**{campaign_field: campaign_id}) if campaign_id else queryset
+
+        def add_daily_counts(field, queryset, campaign_field, date_field):
+            rows = (
+                scope(queryset, campaign_field)
+                .annotate(day=TruncDate(date_field))
+                .values(campaign_field, "day")
+                .annotate(count=Count("id"))
+            )
+            for row in rows:
+                stats[(row[campaign_field], row["day"])][field] += row["count"]
+
+        def add_first_event_counts(field, queryset, date_field):
+            # Primo evento per lead (primo contatto, prima risposta)
+            rows = (
+                scope(queryset, "lead__campaign_id")
+                .values("lead_id", "lead__campaign_id")
+                .annotate(first_at=Min(date_field))
+            )
+            for row in rows.iterator():
+                stats[(row["lead__campaign_id"], localdate(row["first_at"]))][field] += 1
+
+        add_daily_counts("leads", Lead.objects.all(), "campaign_id", "created_at")
+        add_daily_counts("sent", EmailLog.objects.filter(sent_at__isnull=False), "lead__campaign_id", "sent_at")
+        add_daily_counts("opened", EmailOpenTracking.objects.filter(opened=True, opened_at__isnull=False), "lead__campaign_id", "opened_at")
+        add_daily_counts("clicked", EmailClickTracking.objects.filter(clicked=True, clicked_at__isnull=False), "lead__campaign_id", "clicked_at")
+        add_daily_counts("replied", EmailReplyTracking.objects.all(), "lead__campaign_id", "received_at")
+        # Il bounce non ha una data propria: si usa l'ultimo aggiornamento del lead
+        add_daily_counts("bounced", Lead.objects.filter(status=LeadStatus.BOUNCED), "campaign_id", "updated_at")
+        add_first_event_counts("contacted", EmailLog.objects.filter(sent_at__isnull=False), "sent_at")
+        add_first_event_counts("replied_leads", EmailReplyTracking.objects.all(), "received_at")
+
+        rows = [
+            CampaignDailyStats(campaign_id=row_campaign_id, date=day, **counts)
+            for (row_campaign_id, day), counts in stats.items()
+        ]
+
+        with transaction.atomic():
+            scope(CampaignDailyStats.objects.all(), "campaign_id").delete()
+            CampaignDailyStats.objects.bulk_create(rows, batch_size=BACKFILL_BATCH_SIZE)
+
+        self.stdout.write(self.style.SUCCESS(f"📊 Campaign daily stats rebuilt: {len(rows)} rows"))
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2025-04-17 14:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campaigns', '0003_alter_campaign_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('leads', models.PositiveIntegerField(default=0)),
+                ('contacted', models.PositiveIntegerField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('opened', models.PositiveIntegerField(default=0)),
+                ('clicked', models.PositiveIntegerField(default=0)),
+                ('replied', models.PositiveIntegerField(default=0)),
+                ('replied_leads', models.PositiveIntegerField(default=0)),
+                ('bounced', models.PositiveIntegerField(default=0)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='campaigns.campaign')),
+            ],
+            options={
+                'unique_together': {('campaign', 'date')},
+            },
+        ),
+    ]
@@ -2,6 +2,10 @@ import uuid
 from django.db import models
 from users.models import User
 
+# Totali denormalizzati di Campaign, scritti solo con UPDATE F() e mai da un save() ordinario
+CAMPAIGN_COUNTERS = ("leads_total", "contacted", "sent", "opened", "clicked", "replied", "bounced", "unsubscribed")
+
+
 class Campaign(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -12,6 +16,56 @@ class Campaign(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
 
+    # Totali denormalizzati, aggiornati con F() dagli eventi (campaigns/stats.py)
+    # e riallineati da `reconcile_campaign_counters`
+    leads_total = models.PositiveIntegerField(default=0)
+    contacted = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    opened = models.PositiveIntegerField(default=0)
+    clicked = models.PositiveIntegerField(default=0)
+    replied = models.PositiveIntegerField(default=0)
+    bounced = models.PositiveIntegerField(default=0)
+    unsubscribed = models.PositiveIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        """
+        Su una campagna esistente i contatori restano fuori dall'UPDATE (es. PATCH dall'API):
+        i valori letti in memoria sovrascriverebbero gli incrementi F() concorrenti.
+        Dopo il salvataggio vengono riletti dal database.
+        """
+        if self._state.adding or kwargs.get("force_insert") or kwargs.get("update_fields") is not None or args:
+            return super().save(*args, **kwargs)
+
+        kwargs["update_fields"] = [
+            field.name for field in self._meta.concrete_fields
+            if not field.primary_key and field.name not in CAMPAIGN_COUNTERS
+        ]
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=CAMPAIGN_COUNTERS)
+
+
+class CampaignDailyStats(models.Model):
+    """
+    Metriche giornaliere per campagna, aggiornate a ogni invio/apertura/click/risposta/bounce
+    (campaigns/stats.py) e ricostruibili con `manage.py backfill_campaign_stats`.
+    """
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name="daily_stats")
+    date = models.DateField()
+    leads = models.PositiveIntegerField(default=0)  # Lead aggiunti
+    contacted = models.PositiveIntegerField(default=0)  # Lead contattati per la prima volta
+    sent = models.PositiveIntegerField(default=0)  # Email inviate
+    opened = models.PositiveIntegerField(default=0)  # Email aperte (prima apertura)
+    clicked = models.PositiveIntegerField(default=0)  # Link cliccati (primo click per link)
+    replied = models.PositiveIntegerField(default=0)  # Risposte ricevute
+    replied_leads = models.PositiveIntegerField(default=0)  # Lead che hanno risposto per la prima volta
+    bounced = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("campaign", "date")
+
+    def __str__(self):
+        return f"{self.campaign_id} - {self.date}"
+
 
 # class EmailSequence(models.Model):
 #     campaign = models.ForeignKey(
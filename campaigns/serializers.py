@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from workflows.models import Workflow 
-from .models import Campaign
+from .models import CAMPAIGN_COUNTERS, Campaign
 
 class CampaignSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)  # Mostra username invece dell'ID, opzionale
@@ -8,8 +8,12 @@ class CampaignSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Campaign
-        fields = ['id', 'user', 'name', 'is_active', 'start_date', 'end_date', 'created_at', 'updated_at', 'workflow_status']
-        read_only_fields = ['id', 'user', 'created_at', 'updated_at']
+        fields = [
+            'id', 'user', 'name', 'is_active', 'start_date', 'end_date', 'created_at', 'updated_at', 'workflow_status',
+            *CAMPAIGN_COUNTERS
+        ]
+        # Contatori denormalizzati: letti dalla riga della campagna, senza query aggiuntive, mai scritti dall'API
+        read_only_fields = ['id', 'user', 'created_at', 'updated_at', *CAMPAIGN_COUNTERS]
 
     def get_workflow_status(self, campaign):
         try:
@@ -0,0 +1,68 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.timezone import localdate
+from campaigns.models import Campaign, CampaignDailyStats
+
+# Metriche giornaliere riportate anche sui totali di Campaign: campo giornaliero -> campo di Campaign
+CAMPAIGN_COUNTER_FIELDS = {
+    "leads": "leads_total",
+    "contacted": "contacted",
+    "sent": "sent",
+    "opened": "opened",
+    "clicked": "clicked",
+    "replied": "replied",
+    "bounced": "bounced",
+}
+
+
+def count_per_campaign(queryset, campaign_field="lead__campaign", distinct=False):
+    """
+    Subquery correlata con il numero di righe per campagna (0 se non ce ne sono).
+    """
+    counts = queryset.order_by().values(campaign_field).annotate(count=Count("id", distinct=distinct)).values("count")
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def increment_campaign_counters(campaign_id, **counts):
+    """
+    Incrementa i totali denormalizzati di Campaign (es. unsubscribed=1) con un UPDATE atomico.
+    """
+    counts = {field: value for field, value in counts.items() if value}
+    if campaign_id and counts:
+        Campaign.objects.filter(pk=campaign_id).update(**{field: F(field) + value for field, value in counts.items()})
+
+
+def increment_daily_stats(campaign_id, day=None, **counts):
+    """
+    Incrementa i contatori di CampaignDailyStats (es. sent=1, opened=3) per la campagna e il giorno
+    (oggi se non indicato), con un UPDATE atomico; la riga del giorno viene creata al primo evento.
+    Aggiorna anche i totali corrispondenti su Campaign.
+    """
+    counts = {field: value for field, value in counts.items() if value}
+    if not campaign_id or not counts:
+        return
+
+    day = day or localdate()
+    increments = {field: F(field) + value for field, value in counts.items()}
+    daily_stats = CampaignDailyStats.objects.filter(campaign_id=campaign_id, date=day)
+
+    if not daily_stats.update(**increments):
+        try:
+            with transaction.atomic():
+                CampaignDailyStats.objects.create(campaign_id=campaign_id, date=day, **counts)
+        except IntegrityError:
+            # Riga del giorno appena creata da un altro worker
+            daily_stats.update(**increments)
+
+    increment_campaign_counters(campaign_id, **{
+        CAMPAIGN_COUNTER_FIELDS[field]: value for field, value in counts.items() if field in CAMPAIGN_COUNTER_FIELDS
+    })
+
+
+def increment_daily_stats_bulk(increments):
+    """
+    Più incrementi in una volta: {(campaign_id, giorno): {campo: valore}}.
+    """
+    for (campaign_id, day), counts in increments.items():
+        increment_daily_stats(campaign_id, day, **counts)
@@ -0,0 +1,54 @@
+from celery import shared_task
+from django.db.models import F, OuterRef
+from campaigns.models import Campaign
+from campaigns.stats import count_per_campaign
+from emails.models import EmailClickTracking, EmailLog, EmailOpenTracking, EmailReplyTracking
+from leads.models import Lead, LeadStatus
+
+RECONCILE_BATCH_SIZE = 200  # Campagne ricontrollate per query
+
+
+def get_expected_counters():
+    """
+    Valori reali dei contatori di Campaign, calcolati dalle tabelle degli eventi come subquery correlate.
+    """
+    leads = Lead.objects.filter(campaign=OuterRef("pk"))
+    return {
+        "leads_total": count_per_campaign(leads, "campaign"),
+        "contacted": count_per_campaign(leads.filter(emails__sent_at__isnull=False), "campaign", distinct=True),
+        "sent": count_per_campaign(EmailLog.objects.filter(lead__campaign=OuterRef("pk"), sent_at__isnull=False)),
+        "opened": count_per_campaign(EmailOpenTracking.objects.filter(lead__campaign=OuterRef("pk"), opened=True)),
+        "clicked": count_per_campaign(EmailClickTracking.objects.filter(lead__campaign=OuterRef("pk"), clicked=True)),
+        "replied": count_per_campaign(EmailReplyTracking.objects.filter(lead__campaign=OuterRef("pk"))),
+        "bounced": count_per_campaign(leads.filter(status=LeadStatus.BOUNCED), "campaign"),
+        "unsubscribed": count_per_campaign(leads.filter(unsubscribed=True), "campaign"),
+    }
+
+
+@shared_task
+def reconcile_campaign_counters():
+    """
+    Task periodico: confronta i contatori denormalizzati di Campaign con i conteggi reali
+    e corregge le differenze (eventi persi, lead eliminati, campagne create prima dei contatori).
+    La correzione è un incremento F() della sola differenza, per non perdere gli eventi concorrenti.
+    """
+    expected = get_expected_counters()
+    fields = list(expected)
+    campaign_ids = list(Campaign.objects.values_list("id", flat=True))
+    repaired = 0
+
+    for start in range(0, len(campaign_ids), RECONCILE_BATCH_SIZE):
+        rows = (
+            Campaign.objects.filter(id__in=campaign_ids[start:start + RECONCILE_BATCH_SIZE])
+            .annotate(**{f"expected_{field}": expression for field, expression in expected.items()})
+            .values("id", *fields, *(f"expected_{field}" for field in fields))
+        )
+        for row in rows:
+            deltas = {field: row[f"expected_{field}"] - row[field] for field in fields if row[f"expected_{field}"] != row[field]}
+            if not deltas:
+                continue
+            Campaign.objects.filter(id=row["id"]).update(**{field: F(field) + delta for field, delta in deltas.items()})
+            repaired += 1
+            print(f"🔧 Campaign {row['id']} counters repaired: {deltas}")
+
+    print(f"📊 Campaign counters reconciled: {repaired}/{len(campaign_ids)} campaigns repaired.")
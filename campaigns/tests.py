@@ -1,3 +1,226 @@
+from io import StringIO
+from django.core.management import call_command
+from django.db.models import Count
 from django.test import TestCase
+from django.utils.timezone import localdate, now, timedelta
+from rest_framework.test import APIClient
+from emails.models import EmailLog, EmailOpenTracking, EmailReplyTracking
+from leads.models import Lead, LeadStatus
+from users.models import User
+from .models import Campaign, CampaignDailyStats
+from .stats import increment_campaign_counters
 
-# Create your tests here.
+
+class TopCampaignsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_ranks_campaigns_by_reply_rate(self):
+        Campaign.objects.create(user=self.user, name="Low", sent=100, replied=5)
+        Campaign.objects.create(user=self.user, name="High", sent=10, replied=4)
+        Campaign.objects.create(user=self.user, name="Never sent")
+        other_user = User.objects.create_user(email="other@example.com", password="password123")
+        Campaign.objects.create(user=other_user, name="Other", sent=1, replied=1)
+
+        response = self.client.get("/api/campaigns/top-campaigns/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([campaign["name"] for campaign in response.data], ["High", "Low"])
+        self.assertEqual(response.data[0]["sent"], 10)
+        self.assertEqual(response.data[0]["replies"], 4)
+        self.assertEqual(response.data[0]["reply_rate"], 40.0)
+
+
+    def test_recent_campaigns_read_the_campaign_counters(self):
+        campaign = Campaign.objects.create(user=self.user, name="Recent", leads_total=7, sent=5, replied=2)
+        lead = Lead.objects.create(campaign=campaign, email="lead@example.com")
+        EmailLog.objects.create(lead=lead, subject="Queued", sender="sender@example.com")  # Non ancora inviata
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/campaigns/recent-campaigns/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {key: response.data[0][key] for key in ("name", "leads_count", "sent_emails", "replies")},
+            {"name": "Recent", "leads_count": 8, "sent_emails": 5, "replies": 2},  # Il nuovo lead incrementa leads_total
+        )
+
+
+class CampaignCountersTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.campaign = Campaign.objects.create(user=self.user, name="Campaign", sent=3)
+
+    def test_save_keeps_concurrent_increments(self):
+        campaign = Campaign.objects.get(id=self.campaign.id)
+        increment_campaign_counters(campaign.id, sent=2, replied=1)
+
+        campaign.name = "Renamed"
+        campaign.save()
+
+        self.campaign.refresh_from_db()
+        self.assertEqual((self.campaign.name, self.campaign.sent, self.campaign.replied), ("Renamed", 5, 1))
+        self.assertEqual((campaign.sent, campaign.replied), (5, 1))
+
+    def test_patch_does_not_write_counters(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.patch(f"/api/campaigns/{self.campaign.id}/", {"name": "Renamed", "sent": 0}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["sent"], 3)
+        self.campaign.refresh_from_db()
+        self.assertEqual((self.campaign.name, self.campaign.sent), ("Renamed", 3))
+
+
+class CampaignDailyStatsTests(TestCase):
+    """
+    Le metriche giornaliere devono restituire gli stessi numeri delle query sulle tabelle
+    degli eventi usate prima di CampaignDailyStats.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.campaign = Campaign.objects.create(user=self.user, name="Campaign")
+        self.today = now()
+
+        first = self.make_lead("first@example.com", LeadStatus.CONTACTED, days_ago=2)
+        second = self.make_lead("second@example.com", LeadStatus.CONVERTED, days_ago=1)
+        third = self.make_lead("third@example.com", LeadStatus.CONTACTED, days_ago=0)
+        self.make_lead("bounced@example.com", LeadStatus.BOUNCED, days_ago=40)
+
+        first_email = self.make_email(first, days_ago=2)
+        self.make_email(first, days_ago=1)
+        second_email = self.make_email(second, days_ago=1)
+        self.make_email(third, days_ago=0)
+        EmailLog.objects.create(lead=third, subject="Queued", sender="sender@example.com")
+
+        self.make_open(first_email, days_ago=1)
+        self.make_open(second_email, days_ago=0)
+        EmailOpenTracking.objects.create(lead=third, email_log=EmailLog.objects.filter(lead=third).first())
+        self.make_reply(second_email, "Re: Hello", days_ago=0)
+        self.make_reply(second_email, "Re: Re: Hello", days_ago=0)
+
+        # Dati di un altro utente, esclusi da tutte le metriche
+        other_user = User.objects.create_user(email="other@example.com", password="password123")
+        other_campaign = Campaign.objects.create(user=other_user, name="Other")
+        other_lead = Lead.objects.create(campaign=other_campaign, email="lead@example.com", status=LeadStatus.CONTACTED)
+        self.make_reply(self.make_email(other_lead, days_ago=0), "Re: Hello", days_ago=0)
+
+    def days_ago(self, days):
+        return self.today - timedelta(days=days)
+
+    def make_lead(self, email, status, days_ago):
+        lead = Lead.objects.create(campaign=self.campaign, email=email, status=status)
+        Lead.objects.filter(id=lead.id).update(created_at=self.days_ago(days_ago))
+        return lead
+
+    def make_email(self, lead, days_ago):
+        return EmailLog.objects.create(lead=lead, subject="Hello", sender="sender@example.com", sent_at=self.days_ago(days_ago))
+
+    def make_open(self, email_log, days_ago):
+        EmailOpenTracking.objects.create(lead=email_log.lead, email_log=email_log, opened=True, opened_at=self.days_ago(days_ago))
+
+    def make_reply(self, email_log, subject, days_ago):
+        reply = EmailReplyTracking.objects.create(lead=email_log.lead, email_log=email_log, subject=subject, body="Thanks")
+        EmailReplyTracking.objects.filter(id=reply.id).update(received_at=self.days_ago(days_ago))
+
+    def backfill(self, *args):
+        call_command("backfill_campaign_stats", *args, stdout=StringIO())
+
+    def daily_counts(self, queryset, date_field):
+        # Query per giorno usate prima delle metriche giornaliere
+        return {
+            row[f"{date_field}__date"].isoformat(): row["count"]
+            for row in queryset.values(f"{date_field}__date").annotate(count=Count("id"))
+        }
+
+    def test_campaign_analytics_matches_the_event_tables(self):
+        self.backfill()
+
+        response = self.client.get("/api/leads/campaign-analytics/", {"campaign_id": self.campaign.id, "period": 7})
+
+        self.assertEqual(response.status_code, 200)
+        analytics = {row["date"]: row for row in response.data}
+        opened = self.daily_counts(EmailOpenTracking.objects.filter(lead__campaign=self.campaign, opened_at__isnull=False), "opened_at")
+        replied = self.daily_counts(EmailReplyTracking.objects.filter(lead__campaign=self.campaign), "received_at")
+        self.assertEqual({day: row["opened"] for day, row in analytics.items() if row["opened"]}, opened)
+        self.assertEqual({day: row["replied"] for day, row in analytics.items() if row["replied"]}, replied)
+        # "contacted": lead contattati per la prima volta quel giorno
+        self.assertEqual(
+            {day: row["contacted"] for day, row in analytics.items() if row["contacted"]},
+            {localdate(self.days_ago(2)).isoformat(): 1, localdate(self.days_ago(1)).isoformat(): 1, localdate(self.days_ago(0)).isoformat(): 1},
+        )
+
+    def test_global_performance_matches_the_event_tables(self):
+        self.backfill()
+
+        response = self.client.get("/api/dashboard/global-performance/", {"range": 7})
+
+        self.assertEqual(response.status_code, 200)
+        sent = self.daily_counts(EmailLog.objects.filter(lead__campaign__user=self.user, sent_at__isnull=False), "sent_at")
+        replied = self.daily_counts(EmailReplyTracking.objects.filter(lead__campaign__user=self.user), "received_at")
+        self.assertEqual({row["date"]: row["sent"] for row in response.data if row["sent"]}, sent)
+        self.assertEqual({row["date"]: row["replied"] for row in response.data if row["replied"]}, replied)
+
+    def test_dashboard_stats_match_the_event_tables(self):
+        self.backfill()
+
+        response = self.client.get("/api/dashboard/stats/", {"range": 90})
+
+        self.assertEqual(response.status_code, 200)
+        start = self.days_ago(90)
+        leads = Lead.objects.filter(campaign__user=self.user, created_at__gte=start).count()
+        replied_leads = EmailReplyTracking.objects.filter(lead__campaign__user=self.user, received_at__gte=start).values("lead").distinct().count()
+        contacted_leads = EmailLog.objects.filter(lead__campaign__user=self.user, sent_at__gte=start).values("lead").distinct().count()
+        self.assertEqual((response.data["leads_count"], response.data["replies_count"]), (leads, replied_leads))
+        # Tasso di risposta sui lead contattati nel periodo (3), non sui lead "contacted" creati nel periodo (2)
+        self.assertEqual(response.data["reply_rate"], round(replied_leads / contacted_leads * 100, 2))
+
+    def test_incremental_lead_counters_match_the_backfill(self):
+        Lead.objects.create(campaign=self.campaign, email="new@example.com")
+        incremental = CampaignDailyStats.objects.get(campaign=self.campaign, date=localdate()).leads
+
+        self.backfill()
+
+        # I lead retrodatati dal setUp sono stati contati oggi dal signal: il backfill li sposta nel loro giorno
+        self.assertEqual(incremental, 5)
+        self.assertEqual(CampaignDailyStats.objects.get(campaign=self.campaign, date=localdate()).leads, 2)
+
+    def test_backfill_rebuilds_all_counters(self):
+        CampaignDailyStats.objects.all().delete()
+
+        self.backfill()
+
+        stats = {row.date: row for row in CampaignDailyStats.objects.filter(campaign=self.campaign)}
+        today, yesterday = localdate(self.days_ago(0)), localdate(self.days_ago(1))
+        self.assertEqual(sorted(stats), [localdate(self.days_ago(40)), localdate(self.days_ago(2)), yesterday, today])
+        self.assertEqual(
+            [(stats[today].leads, stats[today].sent, stats[today].contacted, stats[today].opened, stats[today].replied, stats[today].replied_leads)],
+            [(1, 1, 1, 1, 2, 1)],
+        )
+        self.assertEqual((stats[yesterday].sent, stats[yesterday].contacted, stats[yesterday].opened), (2, 1, 1))
+        self.assertEqual(sum(row.bounced for row in stats.values()), 1)
+
+    def test_backfill_is_idempotent(self):
+        def rows():
+            return list(CampaignDailyStats.objects.order_by("campaign_id", "date").values_list("campaign_id", "date", "leads", "sent", "replied"))
+
+        self.backfill()
+        first_run = rows()
+        self.backfill()
+
+        self.assertEqual(rows(), first_run)
+
+    def test_backfill_of_one_campaign_keeps_the_others(self):
+        other_campaign = Campaign.objects.get(name="Other")
+        CampaignDailyStats.objects.filter(campaign=other_campaign).update(sent=99)
+
+        self.backfill("--campaign", str(self.campaign.id))
+
+        self.assertEqual(CampaignDailyStats.objects.get(campaign=other_campaign).sent, 99)
+        self.assertEqual(CampaignDailyStats.objects.get(campaign=self.campaign, date=localdate()).leads, 1)
@@ -1,3 +1,4 @@
+from django.db.models import ExpressionWrapper, F, FloatField
 from django.utils.timesince import timesince
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
@@ -5,9 +6,6 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 
-from emails.models import EmailLog, EmailReplyTracking
-from leads.models import Lead
-
 from .models import Campaign
 from .serializers import CampaignSerializer
 from .pagination import CustomPageNumberPagination
@@ -20,8 +18,8 @@ class CampaignViewSet(viewsets.ModelViewSet):
     pagination_class = CustomPageNumberPagination
 
     def get_queryset(self):
-        # Mostra solo le campagne dell’utente autenticato
-        return Campaign.objects.filter(user=self.request.user)
+        # Mostra solo le campagne dell’utente autenticato (workflow in join per `workflow_status`)
+        return Campaign.objects.filter(user=self.request.user).select_related("workflow")
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -31,53 +29,43 @@ class CampaignViewSet(viewsets.ModelViewSet):
     def top_campaigns(self, request):
         user = request.user
 
-        # Trova le campagne dell'utente
-        campaigns = Campaign.objects.filter(user=user)
-
-        results = []
-
-        for campaign in campaigns:
-            sent = EmailLog.objects.filter(lead__campaign=campaign).count()
-            replies = EmailReplyTracking.objects.filter(lead__campaign=campaign).count()
-
-            if sent > 0:
-                reply_rate = round((replies / sent) * 100, 2) if sent > 0 else 0.0
-                results.append({
-                    "id": str(campaign.id),
-                    "name": campaign.name,
-                    "sent": sent,
-                    "replies": replies,
-                    "reply_rate": reply_rate,
-                })
-
-        # Ordina per reply rate decrescente
-        results.sort(key=lambda x: x["reply_rate"], reverse=True)
+        # Ranking sui contatori denormalizzati della campagna: una query, LIMIT 3 nel database
+        campaigns = (
+            Campaign.objects.filter(user=user, sent__gt=0)
+            .annotate(reply_rate=ExpressionWrapper(F("replied") * 100.0 / F("sent"), output_field=FloatField()))
+            .order_by("-reply_rate")[:3]
+        )
 
-        return Response(results[:3], status=status.HTTP_200_OK)
+        results = [
+            {
+                "id": str(campaign.id),
+                "name": campaign.name,
+                "sent": campaign.sent,
+                "replies": campaign.replied,
+                "reply_rate": round(campaign.reply_rate, 2),
+            }
+            for campaign in campaigns
+        ]
+
+        return Response(results, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=["get"], url_path="recent-campaigns")
     def recent_campaigns(self, request):
         user = request.user
 
-        campaigns = (
-            Campaign.objects.filter(user=user)
-            .order_by("-created_at")[:3]
-        )
-
-        results = []
-
-        for campaign in campaigns:
-            leads_count = Lead.objects.filter(campaign=campaign).count()
-            sent_emails = EmailLog.objects.filter(lead__campaign=campaign).count()
-            replies = EmailReplyTracking.objects.filter(lead__campaign=campaign).count()
+        # Contatori denormalizzati della campagna, come in `top_campaigns` (solo email inviate)
+        campaigns = Campaign.objects.filter(user=user).order_by("-created_at")[:3]
 
-            results.append({
+        results = [
+            {
                 "id": str(campaign.id),
                 "name": campaign.name,
                 "created_ago": timesince(campaign.created_at) + " ago",
-                "leads_count": leads_count,
-                "sent_emails": sent_emails,
-                "replies": replies,
-            })
+                "leads_count": campaign.leads_total,
+                "sent_emails": campaign.sent,
+                "replies": campaign.replied,
+            }
+            for campaign in campaigns
+        ]
 
         return Response(results, status=status.HTTP_200_OK)    
\ No newline at end of file
@@ -0,0 +1,156 @@
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from connected_accounts.models import ConnectedAccount, Provider
+from utils.http_client import http_post
+
+GMAIL_TOKEN_URL = "https://oauth2.googleapis.com/token"
+MICROSOFT_TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)  # Il token viene rinnovato poco prima della scadenza
+TOKEN_DEFAULT_EXPIRES_IN = 3600  # Se il provider non indica la durata del token
+TOKEN_LOCK_TIMEOUT = 30  # Secondi: durata massima di un refresh in corso
+TOKEN_WAIT_TIMEOUT = 15  # Secondi di attesa del refresh eseguito da un altro worker
+TOKEN_WAIT_INTERVAL = 0.2
+TOKEN_FAILURE_TIMEOUT = 60  # Dopo un refresh fallito gli altri worker non riprovano per N secondi
+
+
+def get_token_cache_key(account_id):
+    return f"oauth_token:{account_id}"
+
+
+def get_token_lock_key(account_id):
+    return f"oauth_token_lock:{account_id}"
+
+
+def get_token_failure_key(account_id):
+    return f"oauth_token_failed:{account_id}"
+
+
+def is_token_valid(expires_at):
+    return expires_at is not None and expires_at - TOKEN_REFRESH_MARGIN > now()
+
+
+def get_refresh_request(account):
+    if account.provider == Provider.GMAIL:
+        return GMAIL_TOKEN_URL, {
+            "client_id": settings.GOOGLE_CLIENT_ID,
+            "client_secret": settings.GOOGLE_CLIENT_SECRET,
+            "refresh_token": account.refresh_token,
+            "grant_type": "refresh_token",
+        }
+    if account.provider == Provider.OUTLOOK:
+        return MICROSOFT_TOKEN_URL, {
+            "client_id": settings.MICROSOFT_CLIENT_ID,
+            "client_secret": settings.MICROSOFT_CLIENT_SECRET,
+            "refresh_token": account.refresh_token,
+            "grant_type": "refresh_token",
+            "scope": "https://graph.microsoft.com/.default",
+        }
+    return None, None
+
+
+def _apply_token(account, token):
+    account.access_token = token["access_token"]
+    account.token_expires_at = token["expires_at"]
+    return account.access_token
+
+
+def _cache_token(account_id, token):
+    timeout = (token["expires_at"] - TOKEN_REFRESH_MARGIN - now()).total_seconds()
+    if timeout > 0:
+        cache.set(get_token_cache_key(account_id), token, timeout=int(timeout))
+
+
+def refresh_access_token(account):
+    """
+    Chiede un nuovo access token al provider e lo salva con la scadenza reale (`expires_in`).
+    """
+    if not account.refresh_token:
+        print(f"No refresh token available for {account.email_address}. User must reconnect the account.")
+        return None
+
+    url, data = get_refresh_request(account)
+    if url is None:
+        return None
+
+    response = http_post(url, data=data)
+    if response.status_code != 200:
+        print(f"Failed to refresh {account.provider} token for {account.email_address}. Error: {response.text}")
+        cache.set(get_token_failure_key(account.pk), True, timeout=TOKEN_FAILURE_TIMEOUT)
+        return None
+
+    token_data = response.json()
+    token = {
+        "access_token": token_data["access_token"],
+        "expires_at": now() + timedelta(seconds=int(token_data.get("expires_in", TOKEN_DEFAULT_EXPIRES_IN))),
+    }
+
+    fields = {"access_token": token["access_token"], "token_expires_at": token["expires_at"]}
+    if token_data.get("refresh_token"):
+        # Microsoft può ruotare il refresh token
+        account.refresh_token = token_data["refresh_token"]
+        fields["refresh_token"] = account.refresh_token
+
+    # update() e non save(): ConnectedAccount.save() ricripterebbe la password
+    ConnectedAccount.objects.filter(pk=account.pk).update(**fields)
+    _cache_token(account.pk, token)
+
+    print(f"{account.provider} token refreshed for {account.email_address} (expires at {token['expires_at']})")
+    return _apply_token(account, token)
+
+
+def get_access_token(account, force_refresh=False):
+    """
+    Restituisce un access token valido per l'account (Gmail/Outlook), rinnovandolo solo se
+    sta per scadere. Con `force_refresh` (es. dopo un 401) il token attuale è considerato non valido.
+    Un solo worker per account esegue il refresh (lock in cache), gli altri attendono il risultato.
+    """
+    stale_token = account.access_token if force_refresh else None
+
+    if not force_refresh and account.access_token and is_token_valid(account.token_expires_at):
+        return account.access_token
+
+    cache_key = get_token_cache_key(account.pk)
+    lock_key = get_token_lock_key(account.pk)
+    deadline = time.monotonic() + TOKEN_WAIT_TIMEOUT
+
+    while True:
+        token = cache.get(cache_key)
+        if token and token["access_token"] != stale_token and is_token_valid(token["expires_at"]):
+            return _apply_token(account, token)
+
+        if cache.get(get_token_failure_key(account.pk)):
+            print(f"Token refresh recently failed for {account.email_address}, skipping.")
+            return None
+
+        lock_id = str(uuid.uuid4())
+        if cache.add(lock_key, lock_id, timeout=TOKEN_LOCK_TIMEOUT):
+            try:
+                # Un altro worker potrebbe aver appena salvato un token nuovo nel database
+                stored = ConnectedAccount.objects.filter(pk=account.pk).values(
+                    "access_token", "token_expires_at", "refresh_token"
+                ).first()
+                if stored:
+                    account.refresh_token = stored["refresh_token"]
+                    if (
+                        stored["access_token"]
+                        and stored["access_token"] != stale_token
+                        and is_token_valid(stored["token_expires_at"])
+                    ):
+                        token = {"access_token": stored["access_token"], "expires_at": stored["token_expires_at"]}
+                        _cache_token(account.pk, token)
+                        return _apply_token(account, token)
+
+                return refresh_access_token(account)
+            finally:
+                if cache.get(lock_key) == lock_id:
+                    cache.delete(lock_key)
+
+        if time.monotonic() > deadline:
+            print(f"Timeout waiting for token refresh of {account.email_address}")
+            return None
+        time.sleep(TOKEN_WAIT_INTERVAL)
@@ -1,4 +1,3 @@
-import requests
 import imaplib
 import smtplib
 from datetime import datetime, timedelta
@@ -10,6 +9,7 @@ from rest_framework.response import Response
 from google_auth_oauthlib.flow import Flow
 
 from utils.pagination import CustomPageNumberPagination
+from utils.http_client import http_get, http_post
 from .utils import discover_email_servers, encrypt_password, decrypt_password
 from .models import ConnectedAccount
 from .serializers import ConnectedAccountSerializer
@@ -115,7 +115,7 @@ class OAuth2CallbackView(APIView):
         return Response({"message": "Gmail account connected successfully"})
 
     def get_user_email(self, credentials):
-        response = requests.get(
+        response = http_get(
             'https://www.googleapis.com/oauth2/v1/userinfo',
             headers={'Authorization': f'Bearer {credentials.token}'}
         )
@@ -158,7 +158,7 @@ class OutlookOAuth2CallbackView(APIView):
             'grant_type': 'authorization_code',
         }
 
-        token_response = requests.post(token_url, data=data).json()
+        token_response = http_post(token_url, idempotent=False, data=data).json()
 
         access_token = token_response.get('access_token')
         refresh_token = token_response.get('refresh_token')  # Salviamo anche questo
@@ -178,7 +178,7 @@ class OutlookOAuth2CallbackView(APIView):
         return Response({"message": "Outlook account connected successfully"})
 
     def get_user_email(self, access_token):
-        response = requests.get(
+        response = http_get(
             'https://graph.microsoft.com/v1.0/me',
             headers={'Authorization': f'Bearer {access_token}'}
         )
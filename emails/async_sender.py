@@ -0,0 +1,229 @@
+import asyncio
+import time
+import aiosmtplib
+import httpx
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from connected_accounts.models import ConnectedAccount, Provider
+from connected_accounts.tokens import get_access_token
+from emails.models import EmailLog, EmailStatus
+from emails.email_sender import (
+    GMAIL_SEND_API_URL,
+    OUTLOOK_SEND_API_URL,
+    build_gmail_raw_message,
+    build_outlook_message,
+    build_smtp_message,
+    smtp_error_result,
+    apply_send_results,
+)
+from emails.tasks import (
+    acquire_bulk_send_lock,
+    claim_queued_emails,
+    release_bulk_send_lock,
+    release_claimed_emails,
+    requeue_stale_claims,
+)
+from emails.utils.throttling import is_account_throttled
+from emails.utils.smtp_pool import SMTP_TIMEOUT
+from utils.http_client import HTTP_TIMEOUT
+
+ASYNC_SEND_CONCURRENCY = 1000  # Invii contemporanei nel processo
+ASYNC_SEND_PER_ACCOUNT = 5  # Invii (e connessioni SMTP) contemporanei per account
+ASYNC_SEND_POLL_INTERVAL = 2  # Secondi tra due controlli della coda
+ASYNC_RETRY_AFTER_DEFAULT = 60  # Pausa dell'account dopo un 429 senza Retry-After
+
+
+class AsyncSendWorker:
+    """
+    Svuota la coda delle email (EmailLog QUEUED) con invii concorrenti in un solo processo:
+    httpx per Gmail/Graph, aiosmtplib per gli account SMTP. Ogni account è preso in carico
+    da un solo processo alla volta (stesso lock di `send_queued_emails`).
+    """
+
+    def __init__(self, concurrency=ASYNC_SEND_CONCURRENCY, per_account=ASYNC_SEND_PER_ACCOUNT, poll_interval=ASYNC_SEND_POLL_INTERVAL):
+        self.concurrency = concurrency
+        self.per_account = per_account
+        self.poll_interval = poll_interval
+        self.active = {}  # sender -> asyncio.Task
+        self.lock_tokens = {}  # sender -> token del lock dell'account
+        self.backoff_until = {}  # sender -> time.monotonic() fino a cui l'account è in pausa (429)
+        self.stopping = False
+        self.client = None
+        self.slots = None
+
+    def stop(self):
+        print("🛑 Send worker: stopping after in-flight sends...")
+        self.stopping = True
+
+    def claim_accounts(self):
+        """
+        Prende in carico gli account con email in coda non gestiti da altri processi.
+        """
+        close_old_connections()
+        requeue_stale_claims()
+        now_monotonic = time.monotonic()
+        senders = EmailLog.objects.filter(status=EmailStatus.QUEUED).values_list("sender", flat=True).distinct()
+
+        claimed = []
+        for sender in senders:
+            if sender in self.active or self.backoff_until.get(sender, 0) > now_monotonic:
+                continue
+            token = acquire_bulk_send_lock(sender)
+            if not token:
+                continue
+
+            account = ConnectedAccount.objects.filter(email_address=sender, is_active=True).first()
+
+            if not account:
+                print(f"No connected account for {sender}: queued emails marked as failed.")
+                EmailLog.objects.filter(status=EmailStatus.QUEUED, sender=sender).update(status=EmailStatus.FAILED)
+                release_bulk_send_lock(sender, token)
+                continue
+
+            if is_account_throttled(account):
+                release_bulk_send_lock(sender, token)
+                continue
+
+            # Email segnate SENDING: restano di questo processo anche se il lock dell'account scade
+            email_logs = claim_queued_emails(sender)
+            if not email_logs:
+                release_bulk_send_lock(sender, token)
+                continue
+            self.lock_tokens[sender] = token
+            claimed.append((account, email_logs))
+        return claimed
+
+    async def run(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        connect_timeout, read_timeout = HTTP_TIMEOUT
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+
+        async with httpx.AsyncClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout), limits=limits) as client:
+            self.client = client
+            while not self.stopping:
+                claimed = await sync_to_async(self.claim_accounts)()
+                for account, email_logs in claimed:
+                    self.active[account.email_address] = asyncio.create_task(self.process_account(account, email_logs))
+                await asyncio.sleep(self.poll_interval)
+
+            if self.active:
+                await asyncio.gather(*self.active.values(), return_exceptions=True)
+
+    async def process_account(self, account, email_logs):
+        try:
+            results = await self.send_account_messages(account, email_logs)
+            await sync_to_async(apply_send_results)(account, email_logs, results)
+        except Exception as e:
+            print(f"❌ Send worker: error while sending for {account.email_address}: {e}")
+        finally:
+            await sync_to_async(release_claimed_emails)(email_logs)
+            await sync_to_async(release_bulk_send_lock)(account.email_address, self.lock_tokens.pop(account.email_address, None))
+            self.active.pop(account.email_address, None)
+
+    async def send_account_messages(self, account, email_logs):
+        account_slots = asyncio.Semaphore(self.per_account)
+
+        if account.provider == Provider.IMAP_SMTP:
+            smtp_clients = asyncio.Queue()
+            opened = []
+            try:
+                return await self.gather_sends(
+                    email_logs, account_slots,
+                    lambda email_log: self.send_smtp(account, email_log, smtp_clients, opened)
+                )
+            finally:
+                for smtp_client in opened:
+                    try:
+                        await smtp_client.quit()
+                    except aiosmtplib.SMTPException:
+                        smtp_client.close()
+
+        access_token = await sync_to_async(get_access_token)(account)
+        if not access_token:
+            print(f"Cannot send emails, no valid token for {account.email_address}")
+            return {}
+
+        results = await self.gather_sends(
+            email_logs, account_slots,
+            lambda email_log: self.send_http(account, email_log, access_token)
+        )
+
+        # Token revocato: un solo refresh e nuovo tentativo per i messaggi rifiutati con 401
+        unauthorized = [email_log for email_log in email_logs if results[str(email_log.id)][0] == 401]
+        if unauthorized:
+            access_token = await sync_to_async(get_access_token)(account, force_refresh=True)
+            if access_token:
+                results.update(await self.gather_sends(
+                    unauthorized, account_slots,
+                    lambda email_log: self.send_http(account, email_log, access_token)
+                ))
+        return results
+
+    async def gather_sends(self, email_logs, account_slots, send):
+        async def send_one(email_log):
+            async with account_slots, self.slots:
+                return str(email_log.id), await send(email_log)
+
+        return dict(await asyncio.gather(*(send_one(email_log) for email_log in email_logs)))
+
+    async def send_http(self, account, email_log, access_token):
+        if self.backoff_until.get(account.email_address, 0) > time.monotonic():
+            return None, "Account paused after 429"
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+        try:
+            if account.provider == Provider.GMAIL:
+                raw = build_gmail_raw_message(account.email_address, email_log.lead.email, email_log.subject, email_log.body, email_log.message_id)
+                response = await self.client.post(GMAIL_SEND_API_URL, headers=headers, json={"raw": raw})
+            else:
+                message = build_outlook_message(email_log.lead.email, email_log.subject, email_log.body, email_log.message_id)
+                response = await self.client.post(OUTLOOK_SEND_API_URL, headers=headers, json=message)
+        except httpx.HTTPError as e:
+            return None, str(e)
+
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            delay = int(retry_after) if retry_after.isdigit() else ASYNC_RETRY_AFTER_DEFAULT
+            self.backoff_until[account.email_address] = time.monotonic() + delay
+        return response.status_code, response.text
+
+    @staticmethod
+    async def reset_smtp(smtp_client):
+        # Transazione rifiutata: RSET per riutilizzare la sessione, altrimenti la chiudiamo
+        try:
+            await smtp_client.rset()
+        except (aiosmtplib.SMTPException, OSError):
+            smtp_client.close()
+
+    async def send_smtp(self, account, email_log, smtp_clients, opened):
+        # Una connessione per invio concorrente, riutilizzata dai messaggi successivi dello stesso account
+        if smtp_clients.empty() and len(opened) < self.per_account:
+            smtp_client = aiosmtplib.SMTP(
+                hostname=account.smtp_host,
+                port=account.smtp_port,
+                use_tls=account.smtp_port == 465,
+                timeout=SMTP_TIMEOUT,
+            )
+            opened.append(smtp_client)
+        else:
+            smtp_client = await smtp_clients.get()
+
+        message = build_smtp_message(account.email_address, email_log.lead.email, email_log.subject, email_log.body, email_log.message_id)
+        try:
+            if not smtp_client.is_connected:
+                await smtp_client.connect()
+                await smtp_client.login(account.username, account.password)
+            await smtp_client.sendmail(account.email_address, [email_log.lead.email], message)
+            return 200, ""
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            await self.reset_smtp(smtp_client)
+            refused = e.recipients[0] if e.recipients else None
+            return smtp_error_result(refused.code if refused else None, e)
+        except aiosmtplib.SMTPResponseException as e:
+            await self.reset_smtp(smtp_client)
+            return smtp_error_result(e.code, e.message)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            smtp_client.close()  # Riconnessione al prossimo invio
+            return None, str(e)
+        finally:
+            smtp_clients.put_nowait(smtp_client)
@@ -1,87 +1,79 @@
-import requests
+import base64
+import json
 import smtplib
+import uuid
+from collections import Counter
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+from email.parser import BytesParser
 from django.conf import settings
-from django.utils.timezone import now
+from django.utils.timezone import localdate, now
 from leads.models import Lead, LeadStatus
+from emails.models import EmailLog, EmailStatus
+from connected_accounts.models import Provider
 from emails.utils.throttling import is_account_throttled, update_throttle_status, reset_throttle_status
+from emails.utils.smtp_pool import smtp_pool
+from utils.http_client import http_post
+from connected_accounts.tokens import get_access_token
+from campaigns.stats import increment_daily_stats, increment_daily_stats_bulk
 
 
-GMAIL_TOKEN_URL = "https://oauth2.googleapis.com/token"
-GMAIL_SEND_API_URL = "https://www.googleapis.com/gmail/v1/users/me/messages/send"
+# URL configurabili dalle settings (es. per puntare a un server di test locale)
+GMAIL_SEND_API_URL = getattr(settings, "GMAIL_SEND_API_URL", "https://www.googleapis.com/gmail/v1/users/me/messages/send")
+GMAIL_BATCH_API_URL = getattr(settings, "GMAIL_BATCH_API_URL", "https://www.googleapis.com/batch/gmail/v1")
 
-MICROSOFT_TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-OUTLOOK_SEND_API_URL = "https://graph.microsoft.com/v1.0/me/sendMail"
+OUTLOOK_SEND_API_URL = getattr(settings, "OUTLOOK_SEND_API_URL", "https://graph.microsoft.com/v1.0/me/sendMail")
+GRAPH_BATCH_API_URL = getattr(settings, "GRAPH_BATCH_API_URL", "https://graph.microsoft.com/v1.0/$batch")
+
+GMAIL_BATCH_LIMIT = 50  # Google consiglia al massimo 50 invii per batch
+GRAPH_BATCH_LIMIT = 20  # Limite di richieste per $batch di Microsoft Graph
+RETRYABLE_BATCH_STATUSES = (401, 429, 500, 502, 503, 504)  # Il messaggio resta in coda e verrà ritentato
 
 def handle_bounce(email, reason="Unknown"):
     lead = Lead.objects.filter(email=email).first()
     if lead:
         print(f"🚫 Bounce detected for {email}: {reason}")
+        if lead.status != LeadStatus.BOUNCED:
+            increment_daily_stats(lead.campaign_id, bounced=1)
         lead.status = LeadStatus.BOUNCED  # Aggiungi questo status se non esiste
         # lead.bounce_reason = reason       # Crea questo campo se non esiste
         lead.save()
     else:
         print(f"⚠️ Bounce received but no lead found for {email}")
 
-def refresh_outlook_token(account):
+def build_gmail_raw_message(sender, recipient, subject, body, message_id=None):
     """
-    Aggiorna il token di accesso per un account Outlook se è scaduto.
+    Messaggio RFC 2822 codificato in base64url, come richiesto dal campo `raw` di Gmail.
     """
-    if not account.refresh_token:
-        print(f"No refresh token available for {account.email_address}. User must reconnect the account.")
-        return None
-
-    data = {
-        "client_id": settings.MICROSOFT_CLIENT_ID,
-        "client_secret": settings.MICROSOFT_CLIENT_SECRET,
-        "refresh_token": account.refresh_token,
-        "grant_type": "refresh_token",
-        "scope": "https://graph.microsoft.com/.default",
+    message = MIMEText(body, "plain", "utf-8")
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = subject
+    if message_id:
+        message["Message-ID"] = message_id
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+def build_smtp_message(sender, recipient, subject, body, message_id=None):
+    message = MIMEMultipart()
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = subject
+    if message_id:
+        message["Message-ID"] = message_id
+    message.attach(MIMEText(body, "plain"))
+    return message.as_string()
+
+def build_outlook_message(recipient, subject, body, message_id=None):
+    message = {
+        "subject": subject,
+        "body": {"contentType": "Text", "content": body},
+        "toRecipients": [{"emailAddress": {"address": recipient}}],
     }
+    if message_id:
+        message["internetMessageId"] = message_id
+    return {"message": message, "saveToSentItems": "true"}
 
-    response = requests.post(MICROSOFT_TOKEN_URL, data=data)
-    if response.status_code == 200:
-        token_data = response.json()
-        account.access_token = token_data["access_token"]
-        account.token_expires_at = now()  # Aggiorna la data di scadenza
-        account.save()
-        print(f"Outlook token refreshed for {account.email_address}")
-        return account.access_token
-    else:
-        print(f"Failed to refresh Outlook token for {account.email_address}. Error: {response.text}")
-        return None
-
-def refresh_gmail_token(account):
-    """
-    Aggiorna il token di accesso per un account Gmail se è scaduto.
-    """
-    if not account.refresh_token:
-        print(f"No refresh token available for {account.email_address}. User must reconnect the account.")
-        return None
-
-    data = {
-        "client_id": settings.GOOGLE_CLIENT_ID,
-        "client_secret": settings.GOOGLE_CLIENT_SECRET,
-        "refresh_token": account.refresh_token,
-        "grant_type": "refresh_token",
-    }
-
-    response = requests.post(GMAIL_TOKEN_URL, data=data)
-    if response.status_code == 200:
-        token_data = response.json()
-        account.access_token = token_data["access_token"]
-        account.token_expires_at = now()  # Aggiorniamo la data di scadenza
-        account.save()
-        print(f"Gmail token refreshed for {account.email_address}")
-        return account.access_token
-    else:
-        print(f"Failed to refresh Gmail token for {account.email_address}. Error: {response.text}")
-        return None
-
-def send_email_gmail(account, recipient, subject, body):
+def send_email_gmail(account, recipient, subject, body, message_id=None, retry_auth=True):
     """
     Invia un'email usando l'API di Gmail, aggiornando il token se necessario.
     """
@@ -90,30 +82,27 @@ def send_email_gmail(account, recipient, subject, body):
         print(f"⛔ Gmail: {account.email_address} è in throttling. Invio annullato.")
         return
 
-    # Se il token è scaduto, aggiorniamolo
-    if account.token_expires_at and now() > account.token_expires_at:
-        print(f"Gmail token expired for {account.email_address}, refreshing...")
-        new_token = refresh_gmail_token(account)
-        if not new_token:
-            print(f"Cannot send email, no valid token for {account.email_address}")
-            update_throttle_status(account)
-            return
+    # Token valido dalla cache condivisa, rinnovato solo se sta per scadere
+    access_token = get_access_token(account)
+    if not access_token:
+        print(f"Cannot send email, no valid token for {account.email_address}")
+        update_throttle_status(account)
+        return
 
-    headers = {"Authorization": f"Bearer {account.access_token}", "Content-Type": "application/json"}
-    message = f"From: {account.email_address}\nTo: {recipient}\nSubject: {subject}\n\n{body}"
-    encoded_message = {"raw": message.encode("utf-8").hex()}
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    encoded_message = {"raw": build_gmail_raw_message(account.email_address, recipient, subject, body, message_id)}
 
-    response = requests.post(GMAIL_SEND_API_URL, headers=headers, json=encoded_message)
+    response = http_post(GMAIL_SEND_API_URL, idempotent=False, headers=headers, json=encoded_message)
 
     if response.status_code == 200:
         print(f"Gmail: Email sent successfully to {recipient}")
         reset_throttle_status(account)
 
-    elif response.status_code == 401:  # Token scaduto, proviamo a rinnovarlo
+    elif response.status_code == 401 and retry_auth:  # Token revocato, proviamo a rinnovarlo
         print(f"Gmail: Token expired for {account.email_address}. Refreshing token...")
-        new_token = refresh_gmail_token(account)
+        new_token = get_access_token(account, force_refresh=True)
         if new_token:
-            send_email_gmail(account, recipient, subject, body)  # Riproviamo l'invio
+            send_email_gmail(account, recipient, subject, body, message_id, retry_auth=False)  # Riproviamo l'invio
         else:
             print(f"Gmail: Failed to refresh token. Email not sent to {recipient}.")
             update_throttle_status(account)
@@ -124,7 +113,7 @@ def send_email_gmail(account, recipient, subject, body):
         if "Invalid To" in response.text or "Address not found" in response.text:
             handle_bounce(recipient, reason="Invalid recipient (Gmail)")
 
-def send_email_outlook(account, recipient, subject, body):
+def send_email_outlook(account, recipient, subject, body, message_id=None, retry_auth=True):
     """
     Invia un'email usando l'API di Microsoft Outlook, aggiornando il token se necessario.
     """
@@ -132,35 +121,26 @@ def send_email_outlook(account, recipient, subject, body):
         print(f"⛔ Outlook: {account.email_address} è in throttling. Invio annullato.")
         return
 
-    if account.token_expires_at and now() > account.token_expires_at:
-        print(f"Outlook token expired for {account.email_address}, refreshing...")
-        new_token = refresh_outlook_token(account)
-        if not new_token:
-            print(f"Cannot send email, no valid token for {account.email_address}")
-            update_throttle_status(account)
-            return
-
-    headers = {"Authorization": f"Bearer {account.access_token}", "Content-Type": "application/json"}
-    email_data = {
-        "message": {
-            "subject": subject,
-            "body": {"contentType": "Text", "content": body},
-            "toRecipients": [{"emailAddress": {"address": recipient}}],
-        },
-        "saveToSentItems": "true",
-    }
+    access_token = get_access_token(account)
+    if not access_token:
+        print(f"Cannot send email, no valid token for {account.email_address}")
+        update_throttle_status(account)
+        return
+
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    email_data = build_outlook_message(recipient, subject, body, message_id)
 
-    response = requests.post(OUTLOOK_SEND_API_URL, headers=headers, json=email_data)
+    response = http_post(OUTLOOK_SEND_API_URL, idempotent=False, headers=headers, json=email_data)
 
     if response.status_code == 202:
         print(f"Outlook: Email sent successfully to {recipient}")
         reset_throttle_status(account)
 
-    elif response.status_code == 401:
+    elif response.status_code == 401 and retry_auth:
         print(f"Outlook: Token expired for {account.email_address}. Refreshing token...")
-        new_token = refresh_outlook_token(account)
+        new_token = get_access_token(account, force_refresh=True)
         if new_token:
-            send_email_outlook(account, recipient, subject, body)
+            send_email_outlook(account, recipient, subject, body, message_id, retry_auth=False)
         else:
             print(f"Outlook: Failed to refresh token. Email not sent to {recipient}.")
             update_throttle_status(account)
@@ -170,6 +150,200 @@ def send_email_outlook(account, recipient, subject, body):
         if "InvalidRecipients" in response.text or "not found" in response.text:
             handle_bounce(recipient, reason="Invalid recipient (Outlook)")        
 
+
+def parse_gmail_batch_response(response):
+    """
+    Divide la risposta multipart/mixed del batch Gmail: {Content-ID: (status HTTP, corpo)}.
+    """
+    header = f"Content-Type: {response.headers.get('Content-Type', '')}\r\n\r\n".encode()
+    multipart = BytesParser().parsebytes(header + response.content)
+
+    results = {}
+    for part in multipart.get_payload() if multipart.is_multipart() else []:
+        content_id = (part.get("Content-ID") or "").strip("<>").replace("response-", "", 1)
+        payload = part.get_payload(decode=True) or b""
+        http_response = payload.decode("utf-8", errors="replace")
+        status_line, _, rest = http_response.lstrip().partition("\n")
+        _, _, content = rest.replace("\r\n", "\n").partition("\n\n")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            status = None
+        results[content_id] = (status, content)
+    return results
+
+def send_gmail_batch(account, access_token, email_logs):
+    """
+    Una richiesta HTTP per più invii: endpoint `batch` di Gmail (multipart/mixed).
+    """
+    boundary = f"batch_{uuid.uuid4().hex}"
+    parts = []
+    for email_log in email_logs:
+        payload = json.dumps({"raw": build_gmail_raw_message(account.email_address, email_log.lead.email, email_log.subject, email_log.body, email_log.message_id)})
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <{email_log.id}>\r\n\r\n"
+            "POST /gmail/v1/users/me/messages/send\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            f"{payload}\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n")
+
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": f"multipart/mixed; boundary={boundary}"}
+    response = http_post(GMAIL_BATCH_API_URL, idempotent=False, headers=headers, data="".join(parts).encode("utf-8"))
+    if response.status_code != 200:
+        return response.status_code, response.text, {}
+    return response.status_code, "", parse_gmail_batch_response(response)
+
+def send_outlook_batch(account, access_token, email_logs):
+    """
+    Una richiesta HTTP per più invii: `$batch` JSON di Microsoft Graph.
+    """
+    payload = {
+        "requests": [
+            {
+                "id": str(email_log.id),
+                "method": "POST",
+                "url": "/me/sendMail",
+                "headers": {"Content-Type": "application/json"},
+                "body": build_outlook_message(email_log.lead.email, email_log.subject, email_log.body, email_log.message_id),
+            }
+            for email_log in email_logs
+        ]
+    }
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    response = http_post(GRAPH_BATCH_API_URL, idempotent=False, headers=headers, json=payload)
+    if response.status_code != 200:
+        return response.status_code, response.text, {}
+
+    results = {}
+    for item in response.json().get("responses", []):
+        results[str(item.get("id"))] = (item.get("status"), json.dumps(item.get("body") or {}))
+    return response.status_code, "", results
+
+BATCH_SENDERS = {
+    Provider.GMAIL: (send_gmail_batch, GMAIL_BATCH_LIMIT),
+    Provider.OUTLOOK: (send_outlook_batch, GRAPH_BATCH_LIMIT),
+}
+
+BOUNCE_MARKERS = {
+    Provider.GMAIL: ("Invalid To", "Address not found"),
+    Provider.OUTLOOK: ("InvalidRecipients", "not found"),
+    Provider.IMAP_SMTP: ("550", "User unknown"),
+}
+
+def smtp_error_result(code, message):
+    """
+    Errori SMTP nel formato dei risultati dei batch: i 4xx sono temporanei (il messaggio resta in coda).
+    """
+    if code is not None and code >= 500:
+        return code, str(message)
+    return None, str(message)
+
+def send_smtp_messages(account, email_logs):
+    """
+    Invio sequenziale sulle sessioni SMTP del pool, con risultati nello stesso formato dei batch HTTP.
+    """
+    results = {}
+    for email_log in email_logs:
+        message = build_smtp_message(account.email_address, email_log.lead.email, email_log.subject, email_log.body, email_log.message_id)
+        try:
+            smtp_pool.sendmail(account, account.email_address, email_log.lead.email, message)
+            results[str(email_log.id)] = (200, "")
+        except smtplib.SMTPRecipientsRefused as e:
+            code, error = next(iter(e.recipients.values()), (None, str(e)))
+            results[str(email_log.id)] = smtp_error_result(code, error)
+        except smtplib.SMTPResponseException as e:
+            results[str(email_log.id)] = smtp_error_result(e.smtp_code, e.smtp_error)
+        except Exception as e:
+            results[str(email_log.id)] = (None, str(e))
+    return results
+
+def apply_send_results(account, email_logs, results):
+    """
+    Aggiorna gli EmailLog in base ai risultati {email_log_id: (status, dettaglio)}:
+    SENT se accettato, FAILED se rifiutato, QUEUED (ritentato in seguito) per errori temporanei.
+    Restituisce {email_log_id: status}.
+    """
+    bounce_markers = BOUNCE_MARKERS.get(account.provider, ())
+    statuses = {}
+    sent = []
+    failed = []
+
+    for email_log in email_logs:
+        status, content = results.get(str(email_log.id), (None, "Missing response"))
+        if status is not None and 200 <= status < 300:
+            email_log.status = EmailStatus.SENT
+            email_log.sent_at = now()
+            sent.append(email_log)
+        elif status is None or status in RETRYABLE_BATCH_STATUSES:
+            continue
+        else:
+            print(f"{account.provider}: Failed to send email to {email_log.lead.email}. Error: {content}")
+            email_log.status = EmailStatus.FAILED
+            failed.append(email_log)
+            if any(marker in content for marker in bounce_markers):
+                handle_bounce(email_log.lead.email, reason=f"Invalid recipient ({account.get_provider_display()})")
+        statuses[email_log.id] = email_log.status
+
+    EmailLog.objects.bulk_update(sent + failed, ["status", "sent_at"])
+
+    sent_counts = Counter((email_log.lead.campaign_id, localdate(email_log.sent_at)) for email_log in sent)
+    increment_daily_stats_bulk({key: {"sent": count} for key, count in sent_counts.items()})
+
+    if sent:
+        reset_throttle_status(account)
+    if failed:
+        update_throttle_status(account)
+
+    print(f"📨 {account.email_address}: {len(sent)} sent, {len(failed)} failed, {len(email_logs) - len(sent) - len(failed)} still queued")
+    return statuses
+
+def send_emails_bulk(account, email_logs):
+    """
+    Invia gli EmailLog in coda di uno stesso account: in batch per Gmail/Outlook,
+    sulle sessioni del pool SMTP per gli account IMAP/SMTP.
+    Restituisce {email_log_id: status}.
+    """
+    if not email_logs:
+        return {}
+
+    if is_account_throttled(account):
+        print(f"⛔ {account.provider}: {account.email_address} è in throttling. Invio rimandato.")
+        return {}
+
+    if account.provider not in BATCH_SENDERS:
+        return apply_send_results(account, email_logs, send_smtp_messages(account, email_logs))
+
+    access_token = get_access_token(account)
+    if not access_token:
+        print(f"Cannot send emails, no valid token for {account.email_address}")
+        update_throttle_status(account)
+        return {}
+
+    send_batch, batch_limit = BATCH_SENDERS[account.provider]
+    results = {}
+
+    for start in range(0, len(email_logs), batch_limit):
+        chunk = email_logs[start:start + batch_limit]
+        status_code, error, chunk_results = send_batch(account, access_token, chunk)
+
+        if status_code == 401:
+            access_token = get_access_token(account, force_refresh=True)
+            if access_token:
+                status_code, error, chunk_results = send_batch(account, access_token, chunk)
+
+        if status_code != 200:
+            # Batch rifiutato per intero: i messaggi restano in coda
+            print(f"{account.provider}: batch of {len(chunk)} emails failed ({status_code}). Error: {error}")
+            update_throttle_status(account)
+            break
+
+        results.update(chunk_results)
+
+    return apply_send_results(account, email_logs, results)
+
 # def send_email_outlook(account, recipient, subject, body):
 #     """
 #     Invia un'email usando l'API di Microsoft Outlook, aggiornando il token se necessario.
@@ -206,7 +380,7 @@ def send_email_outlook(account, recipient, subject, body):
 #     else:
 #         print(f"Outlook: Failed to send email to {recipient}. Error: {response.text}")
 
-def send_email_smtp(account, recipient, subject, body):
+def send_email_smtp(account, recipient, subject, body, message_id=None):
     """
     Invia un'email usando SMTP per account IMAP personalizzati.
     """
@@ -215,17 +389,10 @@ def send_email_smtp(account, recipient, subject, body):
         return
 
     try:
-        msg = MIMEMultipart()
-        msg["From"] = account.email_address
-        msg["To"] = recipient
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "plain"))
-
-        server = smtplib.SMTP(account.smtp_host, account.smtp_port)
-        server.starttls()
-        server.login(account.username, account.password)
-        server.sendmail(account.email_address, recipient, msg.as_string())
-        server.quit()
+        message = build_smtp_message(account.email_address, recipient, subject, body, message_id)
+
+        # Sessione SMTP già autenticata riutilizzata dal pool del processo
+        smtp_pool.sendmail(account, account.email_address, recipient, message)
 
         print(f"SMTP: Email sent successfully to {recipient}")
         reset_throttle_status(account)
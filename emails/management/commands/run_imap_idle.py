@@ -0,0 +1,54 @@
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from connected_accounts.models import ConnectedAccount, Provider
+from emails.utils.imap_sync import ImapIdleSession
+
+IMAP_ACCOUNTS_REFRESH_INTERVAL = 60  # Secondi tra due controlli degli account IMAP attivi
+
+
+class Command(BaseCommand):
+    help = "Sessioni IMAP IDLE persistenti per ricevere in tempo reale le risposte degli account IMAP (IMAP_IDLE_ENABLED)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--refresh-interval", type=float, default=IMAP_ACCOUNTS_REFRESH_INTERVAL, help="Secondi tra due controlli degli account")
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop_event.set())
+
+        sessions = {}  # account id -> (thread, stop_event della sessione)
+        self.stdout.write("📬 IMAP IDLE worker started")
+
+        while not stop_event.is_set():
+            close_old_connections()
+            accounts = {
+                account.id: account
+                for account in ConnectedAccount.objects.filter(is_active=True, provider=Provider.IMAP_SMTP)
+            }
+
+            # Account disattivati o rimossi
+            for account_id in list(sessions):
+                thread, session_stop = sessions[account_id]
+                if account_id not in accounts or not thread.is_alive():
+                    session_stop.set()
+                    sessions.pop(account_id)
+
+            for account_id, account in accounts.items():
+                if account_id not in sessions:
+                    session_stop = threading.Event()
+                    session = ImapIdleSession(account, session_stop)
+                    thread = threading.Thread(target=session.run, name=f"imap-idle-{account_id}", daemon=True)
+                    thread.start()
+                    sessions[account_id] = (thread, session_stop)
+
+            stop_event.wait(options["refresh_interval"])
+
+        self.stdout.write("🛑 IMAP IDLE worker: closing sessions...")
+        for thread, session_stop in sessions.values():
+            session_stop.set()
+        for thread, _ in sessions.values():
+            thread.join(timeout=30)
+        self.stdout.write(self.style.SUCCESS("IMAP IDLE worker stopped"))
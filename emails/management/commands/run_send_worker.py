@@ -0,0 +1,34 @@
+import asyncio
+import signal
+from django.core.management.base import BaseCommand
+from emails.async_sender import (
+    AsyncSendWorker,
+    ASYNC_SEND_CONCURRENCY,
+    ASYNC_SEND_PER_ACCOUNT,
+    ASYNC_SEND_POLL_INTERVAL,
+)
+
+
+class Command(BaseCommand):
+    help = "Worker asyncio che invia le email in coda (EMAIL_SEND_MODE = \"async\")"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=ASYNC_SEND_CONCURRENCY, help="Invii contemporanei nel processo")
+        parser.add_argument("--per-account", type=int, default=ASYNC_SEND_PER_ACCOUNT, help="Invii contemporanei per account")
+        parser.add_argument("--poll-interval", type=float, default=ASYNC_SEND_POLL_INTERVAL, help="Secondi tra due controlli della coda")
+
+    def handle(self, *args, **options):
+        worker = AsyncSendWorker(
+            concurrency=options["concurrency"],
+            per_account=options["per_account"],
+            poll_interval=options["poll_interval"],
+        )
+        self.stdout.write(f"📮 Send worker started (concurrency {worker.concurrency}, {worker.per_account} per account)")
+        asyncio.run(self.run_worker(worker))
+        self.stdout.write(self.style.SUCCESS("Send worker stopped"))
+
+    async def run_worker(self, worker):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, worker.stop)
+        await worker.run()
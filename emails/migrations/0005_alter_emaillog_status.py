@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2025-04-15 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0004_throttlestatus'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emaillog',
+            name='status',
+            field=models.CharField(choices=[('sent', 'Sent'), ('pending', 'Pending'), ('queued', 'Queued'), ('failed', 'Failed'), ('opened', 'Opened'), ('clicked', 'Clicked'), ('replied', 'Replied'), ('bounced', 'Bounced')], default='pending', max_length=50),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2025-04-16 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connected_accounts', '0002_connectedaccount_imap_port_connectedaccount_password_and_more'),
+        ('emails', '0005_alter_emaillog_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gmail_history_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('outlook_delta_link', models.TextField(blank=True, null=True)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='connected_accounts.connectedaccount')),
+            ],
+        ),
+    ]
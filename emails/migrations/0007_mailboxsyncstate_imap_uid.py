@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2025-04-16 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0006_mailboxsyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='imap_last_uid',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailboxsyncstate',
+            name='imap_uidvalidity',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
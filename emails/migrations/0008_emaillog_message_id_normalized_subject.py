@@ -0,0 +1,53 @@
+# Generated by Django 4.2 on 2025-04-17 09:40
+
+import re
+
+from django.db import migrations, models
+
+# Copia di emails.utils.message_ids.normalize_subject al momento della migrazione:
+# le migrazioni non importano il codice dell'app
+REPLY_PREFIX_PATTERN = re.compile(r'^\s*((re|r|rif|aw|sv|vs|antw|fwd?|i|tr|wg)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_subject(subject):
+    subject = REPLY_PREFIX_PATTERN.sub('', subject or '')
+    return WHITESPACE_PATTERN.sub(' ', subject).strip().lower()[:255]
+
+
+def fill_normalized_subject(apps, schema_editor):
+    EmailLog = apps.get_model('emails', 'EmailLog')
+    batch = []
+    for email_log in EmailLog.objects.only('id', 'subject').iterator(chunk_size=2000):
+        email_log.normalized_subject = normalize_subject(email_log.subject)
+        batch.append(email_log)
+        if len(batch) >= 2000:
+            EmailLog.objects.bulk_update(batch, ['normalized_subject'])
+            batch = []
+    if batch:
+        EmailLog.objects.bulk_update(batch, ['normalized_subject'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0007_mailboxsyncstate_imap_uid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emaillog',
+            name='message_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='emaillog',
+            name='normalized_subject',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(fill_normalized_subject, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='emaillog',
+            index=models.Index(fields=['sender', 'normalized_subject'], name='emails_emai_sender_79bf44_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2025-04-19 10:20
+
+from django.db import migrations, models
+
+
+def remove_duplicate_clicks(apps, schema_editor):
+    EmailClickTracking = apps.get_model('emails', 'EmailClickTracking')
+    duplicates = (
+        EmailClickTracking.objects
+        .values('lead_id', 'email_log_id', 'link')
+        .annotate(count=models.Count('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        clicks = EmailClickTracking.objects.filter(
+            lead_id=duplicate['lead_id'],
+            email_log_id=duplicate['email_log_id'],
+            link=duplicate['link']
+        )
+        # Resta il primo click registrato
+        kept = clicks.order_by('-clicked', 'clicked_at', 'id').first()
+        clicks.exclude(id=kept.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0008_emaillog_message_id_normalized_subject'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_clicks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='emailclicktracking',
+            constraint=models.UniqueConstraint(fields=('lead', 'email_log', 'link'), name='unique_click_lead_email_log_link'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2025-04-19 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emails', '0009_emailclicktracking_unique_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emaillog',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emaillog',
+            name='status',
+            field=models.CharField(choices=[('sent', 'Sent'), ('pending', 'Pending'), ('queued', 'Queued'), ('sending', 'Sending'), ('failed', 'Failed'), ('opened', 'Opened'), ('clicked', 'Clicked'), ('replied', 'Replied'), ('bounced', 'Bounced')], default='pending', max_length=50),
+        ),
+    ]
@@ -4,10 +4,15 @@ from django.utils.timezone import now
 from datetime import timedelta
 from leads.models import Lead
 from connected_accounts.models import ConnectedAccount
+from emails.utils.message_ids import generate_message_id, normalize_subject
+from campaigns.stats import increment_daily_stats
 
 class EmailStatus(models.TextChoices):
     SENT = "sent", "Sent"
     PENDING = "pending", "Pending"
+    QUEUED = "queued", "Queued"  # Pronta, in attesa dell'invio in batch
+    SENDING = "sending", "Sending"  # In coda, presa in carico da un worker di invio
+    FAILED = "failed", "Failed"
     OPENED = "opened", "Opened"
     CLICKED = "clicked", "Clicked"
     REPLIED = "replied", "Replied"
@@ -20,11 +25,31 @@ class EmailLog(models.Model):
     sent_at = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=50, choices=EmailStatus.choices, default=EmailStatus.PENDING)
     sender = models.EmailField()
+    message_id = models.CharField(max_length=255, unique=True, null=True, blank=True)  # Message-ID dell'email inviata
+    normalized_subject = models.CharField(max_length=255, blank=True, default="")  # Oggetto senza "Re:" per abbinare le risposte
+    claimed_at = models.DateTimeField(null=True, blank=True)  # Presa in carico (SENDING) da un worker di invio
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sender", "normalized_subject"]),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Message-ID generato alla creazione: le risposte vengono abbinate tramite In-Reply-To/References
+        if not self.message_id:
+            self.message_id = generate_message_id(self.sender)
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "message_id"}
+        self.normalized_subject = normalize_subject(self.subject)
+        if kwargs.get("update_fields") is not None and "subject" in kwargs["update_fields"]:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "normalized_subject"}
+        super().save(*args, **kwargs)
 
     def mark_sent(self):
         self.status = EmailStatus.SENT
         self.sent_at = now()
         self.save()
+        increment_daily_stats(self.lead.campaign_id, sent=1)
 
     def mark_failed(self):
         self.status = EmailStatus.FAILED
@@ -45,6 +70,12 @@ class EmailClickTracking(models.Model):
     def __str__(self):
         return f"Lead {self.lead.email} - Clicked: {self.clicked}"
 
+    class Meta:
+        constraints = [
+            # Un record per link di ogni email inviata al lead
+            models.UniqueConstraint(fields=["lead", "email_log", "link"], name="unique_click_lead_email_log_link"),
+        ]
+
 
 class EmailOpenTracking(models.Model):
     lead = models.ForeignKey(Lead, on_delete=models.CASCADE, related_name="email_opens")
@@ -98,4 +129,20 @@ class ThrottleStatus(models.Model):
         self.last_error_at = now()
         if self.consecutive_failures >= 3:
             self.paused_until = now() + timedelta(minutes=10)
-        self.save()
\ No newline at end of file
+        self.save()
+
+
+class MailboxSyncState(models.Model):
+    """
+    Cursore della sincronizzazione incrementale delle risposte per account:
+    a ogni controllo vengono letti solo i messaggi arrivati dopo l'ultimo.
+    """
+    account = models.OneToOneField(ConnectedAccount, on_delete=models.CASCADE, related_name="sync_state")
+    gmail_history_id = models.CharField(max_length=64, null=True, blank=True)  # Ultimo historyId di Gmail
+    outlook_delta_link = models.TextField(null=True, blank=True)  # deltaLink di Microsoft Graph
+    imap_uidvalidity = models.BigIntegerField(null=True, blank=True)  # UIDVALIDITY della INBOX IMAP
+    imap_last_uid = models.BigIntegerField(null=True, blank=True)  # Ultimo UID IMAP elaborato
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Sync state for {self.account.email_address}"
@@ -1,88 +1,218 @@
-import requests
 import datetime
-from celery import shared_task
+import time
+import uuid
+from celery import group, shared_task
 from django.utils.timezone import make_aware, is_naive
-from django.utils.timezone import now
+from django.utils.timezone import localdate, now
 from django.conf import settings
-from django.db import IntegrityError
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+from django.db import IntegrityError, transaction
+from django.core.cache import cache
 from connected_accounts.models import ConnectedAccount, Provider
-from emails.models import EmailLog
-from leads.models import Lead
+from emails.models import EmailLog, EmailStatus, MailboxSyncState
+from emails.email_sender import send_emails_bulk
 from .models import EmailReplyTracking
-import imaplib
+from workflows.tasks.events import on_email_replied
+from utils.http_client import http_get
+from connected_accounts.tokens import get_access_token
+from campaigns.stats import increment_daily_stats
+from emails.utils.imap_sync import open_imap_connection, sync_imap_replies
+from emails.utils.message_ids import normalize_subject, parse_message_ids
+from emails.utils.tracking_events import ack_tracking_events, peek_tracking_events, save_tracking_events, TRACKING_FLUSH_BATCH_SIZE
+from email.utils import parseaddr
 import json
-import email
 
-GMAIL_TOKEN_URL = "https://oauth2.googleapis.com/token"
 GMAIL_API_URL = "https://www.googleapis.com/gmail/v1/users/me/messages"
-MICROSOFT_TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-OUTLOOK_API_URL = "https://graph.microsoft.com/v1.0/me/messages"
+GMAIL_HISTORY_URL = "https://www.googleapis.com/gmail/v1/users/me/history"
+GMAIL_PROFILE_URL = "https://www.googleapis.com/gmail/v1/users/me/profile"
+OUTLOOK_DELTA_URL = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+
+BULK_SEND_MAX_PER_RUN = 500  # Messaggi in coda inviati per account a ogni esecuzione
+BULK_SEND_LOCK_TIMEOUT = 300
+BULK_SEND_CLAIM_TIMEOUT = datetime.timedelta(minutes=30)  # Email SENDING di un worker terminato: rimesse in coda
+
+REPLY_POLL_INTERVAL = 300  # Secondi tra due cicli di `check_email_replies` (PeriodicTask in emails/signals.py)
+REPLY_POLL_GROUP_SIZE = 500  # Subtask pubblicati per ogni group Celery
+REPLY_POLL_LOCK_TIMEOUT = 900  # Durata massima della sincronizzazione di un account
+REPLY_POLL_CYCLE_TIMEOUT = 3600
+REPLY_POLL_SLOW_ACCOUNT = 60  # Secondi oltre i quali la sincronizzazione di un account viene segnalata
+REPLY_POLL_METRICS_KEY = "reply_poll:last_cycle"
+REPLY_POLL_CYCLE_LOCK_KEY = "reply_poll:running_cycle"  # Ciclo in corso: il successivo non parte finché non termina
+
+TRACKING_FLUSH_LOCK_KEY = "flush_tracking_events_lock"
+TRACKING_FLUSH_TIME_BUDGET = 20  # Secondi massimi di scrittura per esecuzione del task periodico
+
+
+def get_bulk_send_lock_key(sender):
+    # Condiviso con il worker asyncio (`run_send_worker`): un solo processo per account alla volta
+    return f"bulk_send_lock:{sender}"
+
+def acquire_bulk_send_lock(sender):
+    """
+    Lock dell'account con un token del processo; restituisce il token o None se l'account è già in carico.
+    """
+    token = uuid.uuid4().hex
+    if cache.add(get_bulk_send_lock_key(sender), token, timeout=BULK_SEND_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def release_bulk_send_lock(sender, token):
+    # Solo se il lock è ancora nostro: scaduto potrebbe essere già di un altro processo
+    lock_key = get_bulk_send_lock_key(sender)
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def claim_queued_emails(sender, limit=BULK_SEND_MAX_PER_RUN):
+    """
+    Prende in carico le email in coda dell'account segnandole SENDING, con lock pessimista sulle righe:
+    anche se il lock dell'account scade durante l'invio nessun altro processo può riprenderle.
+    """
+    with transaction.atomic():
+        email_log_ids = list(
+            EmailLog.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=EmailStatus.QUEUED, sender=sender)
+            .order_by("id")
+            .values_list("id", flat=True)[:limit]
+        )
+        EmailLog.objects.filter(id__in=email_log_ids).update(status=EmailStatus.SENDING, claimed_at=now())
+    return list(EmailLog.objects.filter(id__in=email_log_ids).select_related("lead").order_by("id"))
+
+
+def release_claimed_emails(email_logs):
+    """
+    Rimette in coda le email prese in carico e non inviate né fallite (errori temporanei, throttling).
+    """
+    EmailLog.objects.filter(id__in=[email_log.id for email_log in email_logs], status=EmailStatus.SENDING).update(
+        status=EmailStatus.QUEUED, claimed_at=None
+    )
+
+
+def requeue_stale_claims():
+    """
+    Email rimaste SENDING oltre BULK_SEND_CLAIM_TIMEOUT (processo terminato durante l'invio): di nuovo in coda.
+    """
+    requeued = EmailLog.objects.filter(status=EmailStatus.SENDING, claimed_at__lt=now() - BULK_SEND_CLAIM_TIMEOUT).update(
+        status=EmailStatus.QUEUED, claimed_at=None
+    )
+    if requeued:
+        print(f"🧹 {requeued} emails claimed by a stopped worker queued again")
+
+
+def get_reply_poll_lock_key(account_id):
+    return f"reply_poll_lock:{account_id}"
+
+
+def get_reply_poll_cycle_key(cycle_id):
+    return f"reply_poll_cycle:{cycle_id}"
+
 
 @shared_task
 def check_email_replies():
     """
-    Task Celery per controllare le risposte alle email inviate dal workflow.
+    Task Celery per controllare le risposte alle email inviate dal workflow:
+    un subtask per account (group Celery), così il ciclo dura quanto l'account più lento.
     """
     connected_accounts = ConnectedAccount.objects.filter(is_active=True)
+    if settings.IMAP_IDLE_ENABLED:
+        # Le risposte IMAP arrivano dalle sessioni IDLE di `run_imap_idle`
+        connected_accounts = connected_accounts.exclude(provider=Provider.IMAP_SMTP)
 
-    for account in connected_accounts:
-        if account.provider in [Provider.GMAIL, Provider.OUTLOOK]:
-            check_oauth_replies(account)
-        else:
-            check_imap_replies(account)
+    account_ids = list(connected_accounts.values_list("id", flat=True))
+    if not account_ids:
+        return
 
-def refresh_gmail_token(account):
-    """ Aggiorna il token di accesso per Gmail. """
-    if not account.refresh_token:
-        print(f"No refresh token available for {account.email_address}. User must reconnect the account.")
-        return None
+    # Subtask ancora da completare: l'ultimo registra la durata del ciclo e libera il lock
+    cycle = {"id": str(uuid.uuid4()), "started_at": time.time(), "accounts": len(account_ids)}
+    # Il lock scade con quello dei singoli account: un ciclo con subtask persi non blocca il polling
+    if not cache.add(REPLY_POLL_CYCLE_LOCK_KEY, cycle["id"], timeout=REPLY_POLL_LOCK_TIMEOUT):
+        print("⏭️ Previous reply polling cycle still running, skipping.")
+        return
 
-    data = {
-        "client_id": settings.GOOGLE_CLIENT_ID,
-        "client_secret": settings.GOOGLE_CLIENT_SECRET,
-        "refresh_token": account.refresh_token,
-        "grant_type": "refresh_token",
-    }
+    cycle_key = get_reply_poll_cycle_key(cycle["id"])
+    cache.set_many({cycle_key: len(account_ids), f"{cycle_key}:skipped": 0}, timeout=REPLY_POLL_CYCLE_TIMEOUT)
 
-    response = requests.post(GMAIL_TOKEN_URL, data=data)
-    if response.status_code == 200:
-        token_data = response.json()
-        account.access_token = token_data["access_token"]
-        account.token_expires_at = now()
-        account.save()
-        print(f"Gmail token refreshed for {account.email_address}")
-        return account.access_token
-    else:
-        print(f"Failed to refresh Gmail token for {account.email_address}. Error: {response.text}")
-        return None
+    for i in range(0, len(account_ids), REPLY_POLL_GROUP_SIZE):
+        group(
+            check_account_replies.s(account_id, cycle)
+            for account_id in account_ids[i:i + REPLY_POLL_GROUP_SIZE]
+        ).apply_async()
 
-def refresh_outlook_token(account):
-    """ Aggiorna il token di accesso per Outlook. """
-    if not account.refresh_token:
-        print(f"No refresh token available for {account.email_address}. User must reconnect the account.")
-        return None
+    print(f"📨 Reply polling dispatched for {len(account_ids)} accounts")
+
+
+@shared_task
+def check_account_replies(account_id, cycle=None):
+    """
+    Controlla le risposte di un singolo account. Se l'account è ancora in sincronizzazione
+    da un ciclo precedente (lock in cache) viene saltato.
+    """
+    lock_key = get_reply_poll_lock_key(account_id)
+    lock_id = str(uuid.uuid4())
+    started = time.monotonic()
+    skipped = False
 
-    data = {
-        "client_id": settings.MICROSOFT_CLIENT_ID,
-        "client_secret": settings.MICROSOFT_CLIENT_SECRET,
-        "refresh_token": account.refresh_token,
-        "grant_type": "refresh_token",
-        "scope": "https://graph.microsoft.com/.default",
+    try:
+        if not cache.add(lock_key, lock_id, timeout=REPLY_POLL_LOCK_TIMEOUT):
+            print(f"⏭️ Account {account_id} is still syncing from a previous cycle, skipping.")
+            skipped = True
+            return
+
+        try:
+            account = ConnectedAccount.objects.filter(id=account_id, is_active=True).first()
+            if not account:
+                return
+
+            if account.provider in [Provider.GMAIL, Provider.OUTLOOK]:
+                check_oauth_replies(account)
+            else:
+                check_imap_replies(account)
+        finally:
+            if cache.get(lock_key) == lock_id:
+                cache.delete(lock_key)
+    finally:
+        duration = time.monotonic() - started
+        if duration > REPLY_POLL_SLOW_ACCOUNT:
+            print(f"🐢 Reply polling for account {account_id} took {duration:.1f}s")
+        if cycle:
+            finish_reply_poll_cycle(cycle, skipped)
+
+
+def finish_reply_poll_cycle(cycle, skipped):
+    """
+    Segna come completato il subtask di un account; l'ultimo salva le metriche del ciclo
+    in cache (`REPLY_POLL_METRICS_KEY`) e libera il lock del ciclo.
+    """
+    cycle_key = get_reply_poll_cycle_key(cycle["id"])
+    try:
+        if skipped:
+            cache.incr(f"{cycle_key}:skipped")
+        remaining = cache.decr(cycle_key)
+    except ValueError:
+        remaining = None  # Contatori scaduti: ciclo troppo lungo, metriche non disponibili
+
+    if remaining is not None and remaining > 0:
+        return
+
+    if cache.get(REPLY_POLL_CYCLE_LOCK_KEY) == cycle["id"]:
+        cache.delete(REPLY_POLL_CYCLE_LOCK_KEY)
+    if remaining is None:
+        return
+
+    duration = time.time() - cycle["started_at"]
+    metrics = {
+        "finished_at": now().isoformat(),
+        "duration": round(duration, 1),
+        "accounts": cycle["accounts"],
+        "skipped": cache.get(f"{cycle_key}:skipped", 0),
     }
+    cache.set(REPLY_POLL_METRICS_KEY, metrics, timeout=None)
+    cache.delete_many([cycle_key, f"{cycle_key}:skipped"])
 
-    response = requests.post(MICROSOFT_TOKEN_URL, data=data)
-    if response.status_code == 200:
-        token_data = response.json()
-        account.access_token = token_data["access_token"]
-        account.token_expires_at = now()
-        account.save()
-        print(f"Outlook token refreshed for {account.email_address}")
-        return account.access_token
-    else:
-        print(f"Failed to refresh Outlook token for {account.email_address}. Error: {response.text}")
-        return None
+    print(f"📊 Reply polling cycle completed in {duration:.1f}s ({metrics['accounts']} accounts, {metrics['skipped']} skipped)")
+    if duration > REPLY_POLL_INTERVAL:
+        print(f"⚠️ Reply polling cycle longer than its interval ({REPLY_POLL_INTERVAL}s)")
 
 def check_oauth_replies(account):
     """
@@ -90,95 +220,171 @@ def check_oauth_replies(account):
     """
     print(f"Checking replies for {account.email_address} ({account.provider})")
 
-    # Se il token è scaduto, aggiorniamolo
-    if account.token_expires_at and now() > account.token_expires_at:
-        print(f"Token expired for {account.email_address}, refreshing...")
-        if account.provider == Provider.GMAIL:
-            new_token = refresh_gmail_token(account)
-        elif account.provider == Provider.OUTLOOK:
-            new_token = refresh_outlook_token(account)
-
-        if not new_token:
-            print(f"Skipping {account.email_address}: unable to refresh token.")
-            return
+    # Token valido dalla cache condivisa, rinnovato solo se sta per scadere
+    access_token = get_access_token(account)
+    if not access_token:
+        print(f"Skipping {account.email_address}: unable to refresh token.")
+        return
 
     if account.provider == Provider.GMAIL:
-        check_gmail_replies(account)
+        check_gmail_replies(account, access_token)
     elif account.provider == Provider.OUTLOOK:
-        check_outlook_replies(account)
+        check_outlook_replies(account, access_token)
+
+def get_sync_state(account):
+    sync_state, _ = MailboxSyncState.objects.get_or_create(account=account)
+    return sync_state
+
+def is_reply_subject(subject):
+    return "re:" in (subject or "").lower()
+
+def get_gmail_history_id(access_token):
+    response = http_get(GMAIL_PROFILE_URL, headers={"Authorization": f"Bearer {access_token}"})
+    if response.status_code == 200:
+        return response.json().get("historyId")
+    return None
 
-def check_gmail_replies(account):
+def list_gmail_new_message_ids(account, access_token, sync_state):
+    """
+    Id dei messaggi arrivati in INBOX dopo l'ultimo historyId salvato e nuovo historyId.
+    Restituisce (None, None) se il cursore è scaduto e serve una sincronizzazione completa.
     """
-    Recupera le risposte per un account Gmail utilizzando l'API di Gmail.
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {
+        "startHistoryId": sync_state.gmail_history_id,
+        "historyTypes": "messageAdded",
+        "labelId": "INBOX",
+    }
+    message_ids = []
+    history_id = sync_state.gmail_history_id
+
+    while True:
+        response = http_get(GMAIL_HISTORY_URL, headers=headers, params=params)
+        if response.status_code == 404:
+            print(f"Gmail history expired for {account.email_address}, running full sync.")
+            return None, None
+        if response.status_code != 200:
+            print(f"Gmail history error for {account.email_address}: {response.text}")
+            return [], sync_state.gmail_history_id
+
+        data = response.json()
+        for history in data.get("history", []):
+            for added in history.get("messagesAdded", []):
+                message_ids.append(added["message"]["id"])
+        history_id = data.get("historyId", history_id)
+
+        if not data.get("nextPageToken"):
+            return list(dict.fromkeys(message_ids)), history_id
+        params["pageToken"] = data["nextPageToken"]
+
+def list_gmail_recent_reply_ids(access_token):
     """
-    headers = {"Authorization": f"Bearer {account.access_token}"}
+    Sincronizzazione completa (primo avvio o cursore scaduto): risposte degli ultimi 5 giorni.
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
     params = {"q": "in:inbox newer_than:5d subject:Re:"}
+    message_ids = []
+
+    while True:
+        response = http_get(GMAIL_API_URL, headers=headers, params=params)
+        if response.status_code != 200:
+            return message_ids
+        data = response.json()
+        message_ids.extend(msg["id"] for msg in data.get("messages", []))
+        if not data.get("nextPageToken"):
+            return message_ids
+        params["pageToken"] = data["nextPageToken"]
+
+def check_gmail_replies(account, access_token):
+    """
+    Recupera le nuove risposte di un account Gmail a partire dall'ultimo historyId (history.list):
+    vengono scaricati solo i messaggi arrivati dopo l'ultimo controllo.
+    """
+    sync_state = get_sync_state(account)
 
-    response = requests.get(GMAIL_API_URL, headers=headers, params=params)
+    message_ids = None
+    history_id = None
+    if sync_state.gmail_history_id:
+        message_ids, history_id = list_gmail_new_message_ids(account, access_token, sync_state)
 
-    if response.status_code == 200:
-        messages = response.json().get("messages", [])
-        for msg in messages:
-            msg_id = msg["id"]
-            email_data = get_gmail_message_details(account, msg_id, account.access_token)
-            if email_data:
-                save_email_reply(email_data, account)
+    if message_ids is None:
+        # historyId letto prima della lista: i messaggi arrivati nel frattempo verranno presi al prossimo giro
+        history_id = get_gmail_history_id(access_token)
+        message_ids = list_gmail_recent_reply_ids(access_token)
+
+    for msg_id in message_ids:
+        email_data = get_gmail_message_details(account, msg_id, access_token)
+        if email_data and is_reply_subject(email_data["subject"]):
+            save_email_reply(email_data, account)
 
-def check_outlook_replies(account):
+    if history_id:
+        sync_state.gmail_history_id = str(history_id)
+        sync_state.last_synced_at = now()
+        sync_state.save(update_fields=["gmail_history_id", "last_synced_at"])
+
+def check_outlook_replies(account, access_token):
     """
-    Recupera le risposte per un account Outlook utilizzando Microsoft Graph API.
+    Recupera le nuove risposte di un account Outlook con le delta query di Microsoft Graph:
+    il deltaLink salvato restituisce solo i messaggi arrivati o modificati dopo l'ultimo controllo.
     """
-    headers = {"Authorization": f"Bearer {account.access_token}"}
-    params = {"$filter": "isRead eq false and startswith(subject, 'Re:')"}
+    sync_state = get_sync_state(account)
+    headers = {"Authorization": f"Bearer {access_token}", "Prefer": "odata.maxpagesize=100"}
+
+    url = sync_state.outlook_delta_link
+    params = None
+    if not url:
+        # Primo avvio: solo i messaggi degli ultimi 5 giorni, come il controllo completo di Gmail
+        since = (now() - datetime.timedelta(days=5)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        url = OUTLOOK_DELTA_URL
+        params = {
+            "$select": "subject,from,body,receivedDateTime,internetMessageHeaders",
+            "$filter": f"receivedDateTime ge {since}",
+        }
 
-    response = requests.get(OUTLOOK_API_URL, headers=headers, params=params)
+    while url:
+        response = http_get(url, headers=headers, params=params)
+        params = None  # nextLink e deltaLink contengono già tutti i parametri
+
+        if response.status_code == 410:
+            print(f"Outlook delta token expired for {account.email_address}, running full sync.")
+            sync_state.outlook_delta_link = None
+            sync_state.save(update_fields=["outlook_delta_link"])
+            return check_outlook_replies(account, access_token)
+        if response.status_code != 200:
+            print(f"Outlook delta error for {account.email_address}: {response.text}")
+            return
 
-    if response.status_code == 200:
-        messages = response.json().get("value", [])
-        for msg in messages:
+        data = response.json()
+        for msg in data.get("value", []):
+            if "@removed" in msg or not is_reply_subject(msg.get("subject")) or not msg.get("from"):
+                continue
+            message_headers = {h["name"].lower(): h["value"] for h in msg.get("internetMessageHeaders") or []}
             email_data = {
                 "lead_email": msg["from"]["emailAddress"]["address"],
                 "subject": msg["subject"],
                 "body": msg["body"]["content"],
-                "received_at": msg["receivedDateTime"]
+                "received_at": msg["receivedDateTime"],
+                "in_reply_to": message_headers.get("in-reply-to"),
+                "references": message_headers.get("references"),
             }
             save_email_reply(email_data, account)
 
+        url = data.get("@odata.nextLink")
+        if not url and data.get("@odata.deltaLink"):
+            sync_state.outlook_delta_link = data["@odata.deltaLink"]
+            sync_state.last_synced_at = now()
+            sync_state.save(update_fields=["outlook_delta_link", "last_synced_at"])
+
 def check_imap_replies(account):
     """
-    Controlla le risposte via IMAP per account personalizzati.
+    Controlla le risposte via IMAP per account personalizzati (sync incrementale per UID).
     """
     try:
-        mail = imaplib.IMAP4_SSL(account.imap_host, account.imap_port)
-        mail.login(account.username, account.password)
-        mail.select("INBOX")
-
-        result, data = mail.search(None, '(UNSEEN SUBJECT "Re:")')
-
-        if result == "OK":
-            for num in data[0].split():
-                result, msg_data = mail.fetch(num, "(RFC822)")
-                if result == "OK":
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    sender = msg["From"]
-                    subject = msg["Subject"]
-                    body = msg.get_payload(decode=True).decode() if not msg.is_multipart() else ""
-
-                    lead = Lead.objects.filter(email=sender).first()
-                    if lead:
-                        email_log = EmailLog.objects.filter(lead=lead).order_by("-id").first()
-                        if email_log:
-                            EmailReplyTracking.objects.create(
-                                lead=lead,
-                                email_log=email_log,
-                                subject=subject,
-                                body=body,
-                                received_at=now()
-                            )
-                            print(f"Reply recorded for {lead.email}")
-
-        mail.logout()
+        mail = open_imap_connection(account)
+        try:
+            sync_imap_replies(account, mail)
+        finally:
+            mail.logout()
     except Exception as e:
         print(f"IMAP error for {account.email_address}: {e}")
 
@@ -199,7 +405,7 @@ def get_gmail_message_details(account, msg_id, access_token):
     url = f"{GMAIL_API_URL}/{msg_id}"
     headers = {"Authorization": f"Bearer {access_token}"}
     
-    response = requests.get(url, headers=headers)
+    response = http_get(url, headers=headers)
     if response.status_code == 200:
         msg_data = response.json()
         headers = {h["name"]: h["value"] for h in msg_data["payload"]["headers"]}
@@ -208,27 +414,55 @@ def get_gmail_message_details(account, msg_id, access_token):
             "lead_email": headers.get("From"),
             "subject": headers.get("Subject"),
             "body": get_email_body(msg_data),
-            "received_at": msg_data["internalDate"]
+            "received_at": msg_data["internalDate"],
+            "in_reply_to": headers.get("In-Reply-To"),
+            "references": headers.get("References"),
         }
     return None
 
+def find_replied_email_log(email_data, account):
+    """
+    EmailLog a cui risponde il messaggio: lookup indicizzato sul Message-ID citato in
+    In-Reply-To/References, altrimenti oggetto normalizzato + mittente della risposta.
+    """
+    # In-Reply-To per primo, poi i References dal più recente (ultimo) al più vecchio
+    message_ids = list(dict.fromkeys(
+        parse_message_ids(email_data.get("in_reply_to")) + parse_message_ids(email_data.get("references"))[::-1]
+    ))
+    if message_ids:
+        email_logs = {
+            email_log.message_id: email_log
+            for email_log in EmailLog.objects.filter(message_id__in=message_ids).select_related("lead")
+        }
+        for message_id in message_ids:
+            if message_id in email_logs:
+                return email_logs[message_id]
+
+    lead_email = parseaddr(email_data["lead_email"] or "")[1]
+    if not lead_email:
+        return None
+
+    return (
+        EmailLog.objects
+        .filter(
+            sender=account.email_address,
+            normalized_subject=normalize_subject(email_data["subject"]),
+            lead__email__iexact=lead_email,
+        )
+        .select_related("lead")
+        .order_by("-id")
+        .first()
+    )
+
 def save_email_reply(email_data, account):
     """
     Salva la risposta solo se proviene da un lead a cui abbiamo inviato un'email e non è già stata salvata.
     """
-    lead = Lead.objects.filter(email=email_data["lead_email"]).first()
-    if not lead:
-        print(f"No lead found for {email_data['lead_email']}. Skipping.")
-        return
-
-    email_log = EmailLog.objects.filter(lead=lead).order_by("-sent_at").first()
+    email_log = find_replied_email_log(email_data, account)
     if not email_log:
-        print(f"No email log found for {lead.email}. Skipping.")
-        return
-
-    if email_log.subject not in email_data["subject"]:
-        print(f"Email reply subject does not match sent email for {lead.email}. Skipping.")
+        print(f"No sent email matches the reply from {email_data['lead_email']}. Skipping.")
         return
+    lead = email_log.lead
 
     # **Gestione della conversione della data**
     received_at_str = email_data["received_at"]
@@ -241,6 +475,8 @@ def save_email_reply(email_data, account):
     if is_naive(received_at):
         received_at = make_aware(received_at)
 
+    first_reply = not EmailReplyTracking.objects.filter(lead=lead).exists()
+
     # **Verifica se la risposta è già stata salvata con un controllo più rigoroso**
     try:
         EmailReplyTracking.objects.create(
@@ -250,6 +486,71 @@ def save_email_reply(email_data, account):
             body=email_data["body"],
             received_at=received_at
         )
+        increment_daily_stats(lead.campaign_id, localdate(received_at), replied=1, replied_leads=int(first_reply))
+        on_email_replied.delay(lead.id)
         print(f"✅ Valid reply recorded for {lead.email}. Workflow will stop for this lead.")
     except IntegrityError:
-        print(f"⚠️ Duplicate reply detected for {lead.email}. Skipping save.")
\ No newline at end of file
+        print(f"⚠️ Duplicate reply detected for {lead.email}. Skipping save.")
+
+
+@shared_task
+def send_queued_emails():
+    """
+    Task periodico: invia in batch (Gmail `batch`, Graph `$batch`, pool SMTP) le email in coda, raggruppate per account.
+    Attivo solo con EMAIL_SEND_MODE = "batch"; in modalità "async" la coda è svuotata da `run_send_worker`.
+    """
+    if settings.EMAIL_SEND_MODE != "batch":
+        return
+
+    requeue_stale_claims()
+    senders = EmailLog.objects.filter(status=EmailStatus.QUEUED).values_list("sender", flat=True).distinct()
+
+    for sender in senders:
+        # Un solo worker per account alla volta
+        token = acquire_bulk_send_lock(sender)
+        if not token:
+            continue
+
+        email_logs = []
+        try:
+            account = ConnectedAccount.objects.filter(email_address=sender, is_active=True).first()
+
+            if not account:
+                print(f"No connected account for {sender}: queued emails marked as failed.")
+                EmailLog.objects.filter(status=EmailStatus.QUEUED, sender=sender).update(status=EmailStatus.FAILED)
+                continue
+
+            email_logs = claim_queued_emails(sender)
+            send_emails_bulk(account, email_logs)
+        finally:
+            release_claimed_emails(email_logs)
+            release_bulk_send_lock(sender, token)
+
+
+@shared_task
+def flush_tracking_events():
+    """
+    Task periodico: salva nel database gli eventi di apertura/click accumulati dalle view di tracking,
+    a blocchi di TRACKING_FLUSH_BATCH_SIZE, finché la lista non è vuota o finisce il tempo del ciclo.
+    """
+    # Un solo flusher alla volta: gli eventi dello stesso link non vengono salvati due volte
+    if not cache.add(TRACKING_FLUSH_LOCK_KEY, True, timeout=TRACKING_FLUSH_TIME_BUDGET * 3):
+        return
+
+    started = time.monotonic()
+    saved = 0
+    try:
+        while time.monotonic() - started < TRACKING_FLUSH_TIME_BUDGET:
+            events = peek_tracking_events()
+            if not events:
+                break
+            # Eventi tolti dalla lista solo dopo il salvataggio: se il database non risponde restano in coda
+            saved += save_tracking_events(events)
+            ack_tracking_events(len(events))
+            if len(events) < TRACKING_FLUSH_BATCH_SIZE:
+                break
+    finally:
+        cache.delete(TRACKING_FLUSH_LOCK_KEY)
+
+    if saved:
+        print(f"👁️ Saved {saved} tracking events in {time.monotonic() - started:.1f}s")
@@ -1,3 +1,853 @@
-from django.test import TestCase
+import base64
+import json
+import re
+import smtplib
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+from unittest import mock
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from campaigns.models import Campaign
+from connected_accounts.models import ConnectedAccount, Provider
+from leads.models import Lead, LeadStatus
+from users.models import User
+from emails import email_sender
+from emails.models import EmailClickTracking, EmailLog, EmailOpenTracking, EmailStatus, MailboxSyncState
+from emails import tasks as email_tasks
+from emails.tasks import (
+    BULK_SEND_CLAIM_TIMEOUT,
+    acquire_bulk_send_lock,
+    claim_queued_emails,
+    flush_tracking_events,
+    release_bulk_send_lock,
+    release_claimed_emails,
+    requeue_stale_claims,
+)
+from emails.utils import tracking_events
+from emails.utils.imap_sync import open_imap_connection, sync_imap_replies, wait_for_new_messages
+from emails.utils.smtp_pool import PooledSMTP, SMTPConnectionPool
+from emails.utils.rate_limiter import MemoryRateLimiterBackend
+from emails.utils.tracking_events import CLICK, CLICK_LINK_MAX_LENGTH, OPEN, save_tracking_events
 
-# Create your tests here.
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class LocalServer(socketserver.ThreadingTCPServer):
+    """
+    Server TCP locale per i test (SMTP/IMAP finti), in ascolto su una porta libera.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler_class):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Server SMTP minimo: `drop_after_data` chiude la connessione dopo aver ricevuto il messaggio
+    senza rispondere (come un timeout dopo il DATA), `close_after_message` chiude la sessione
+    dopo ogni invio (come un server che chiude le sessioni ferme).
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply(b"220 localhost ESMTP")
+        while line := self.rfile.readline():
+            command = line.strip().upper()
+            if command.startswith((b"EHLO", b"HELO")):
+                self.reply(b"250 localhost")
+            elif command.startswith((b"MAIL", b"RCPT", b"RSET", b"NOOP")):
+                self.reply(b"250 OK")
+            elif command == b"DATA":
+                self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while (data_line := self.rfile.readline()) not in (b".\r\n", b""):
+                    lines.append(data_line)
+                server.messages.append(b"".join(lines))
+                if server.drop_after_data:
+                    return
+                self.reply(b"250 OK queued")
+                if server.close_after_message:
+                    return
+            elif command == b"QUIT":
+                self.reply(b"221 Bye")
+                return
+            else:
+                self.reply(b"502 Command not implemented")
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Server IMAP minimo con UID SEARCH/FETCH sui messaggi di `server.messages` {uid: (header, testo)}
+    e IDLE: la notifica EXISTS parte quando viene impostato `server.new_message`.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def search(self, criteria):
+        uids = sorted(self.server.messages)
+        match = re.match(rb"UID (\d+):\*", criteria)
+        if match:
+            # RFC 3501: "N:*" comprende sempre l'ultimo messaggio
+            uids = [uid for uid in uids if uid >= int(match.group(1))] or uids[-1:]
+        return uids
+
+    def fetch(self, uid_set):
+        for sequence, uid in enumerate(int(uid) for uid in uid_set.split(b",")):
+            header, text = self.server.messages[uid]
+            self.wfile.write(
+                b"* %d FETCH (UID %d BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}\r\n%s BODY[TEXT]<0> {%d}\r\n%s)\r\n"
+                % (sequence + 1, uid, len(header), header, len(text), text)
+            )
+
+    def handle(self):
+        server = self.server
+        self.reply(b"* OK IMAP4rev1 ready")
+        while line := self.rfile.readline():
+            tag, command, *args = line.strip().split(b" ", 2)
+            command = command.upper()
+            args = args[0] if args else b""
+            if command == b"CAPABILITY":
+                self.reply(b"* CAPABILITY IMAP4rev1 IDLE")
+            elif command in (b"SELECT", b"EXAMINE"):
+                self.reply(b"* %d EXISTS" % len(server.messages))
+                self.reply(b"* OK [UIDVALIDITY %d] UIDs valid" % server.uidvalidity)
+                self.reply(b"* OK [UIDNEXT %d] Predicted next UID" % (max(server.messages, default=0) + 1))
+            elif command == b"UID":
+                subcommand, _, criteria = args.partition(b" ")
+                server.commands.append(args)
+                if subcommand.upper() == b"SEARCH":
+                    self.reply(b"* SEARCH " + b" ".join(b"%d" % uid for uid in self.search(criteria)))
+                else:
+                    self.fetch(criteria.split(b" ", 1)[0])
+            elif command == b"IDLE":
+                self.reply(b"+ idling")
+                if server.new_message.wait(5):
+                    self.reply(b"* %d EXISTS" % len(server.messages))
+                self.rfile.readline()  # DONE
+            elif command == b"LOGOUT":
+                self.reply(b"* BYE")
+                self.reply(tag + b" OK LOGOUT completed")
+                return
+            self.reply(tag + b" OK " + command + b" completed")
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """
+    Endpoint batch finti di Gmail (multipart/mixed) e Microsoft Graph ($batch JSON).
+    Lo stato HTTP del batch viene preso da `server.batch_statuses` (200 se vuoto), quello di ogni
+    messaggio da `server.message_statuses` {destinatario: status}. Le risposte sono in ordine inverso,
+    come può accadere con i provider reali.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server.requests.append((self.path, self.headers["Authorization"]))
+
+        batch_status = server.batch_statuses.pop(0) if server.batch_statuses else 200
+        if batch_status != 200:
+            return self.respond(batch_status, "application/json", b'{"error": {"message": "Batch rejected"}}')
+
+        if self.path.startswith("/batch/gmail"):
+            self.gmail_batch(body)
+        else:
+            self.graph_batch(json.loads(body))
+
+    def gmail_batch(self, body):
+        request = BytesParser().parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        boundary = "batch_response"
+        parts = []
+        for part in reversed(request.get_payload()):
+            http_request = part.get_payload(decode=True).decode()
+            raw = json.loads(http_request.split("\r\n\r\n", 1)[1])["raw"]
+            recipient = message_from_bytes(base64.urlsafe_b64decode(raw))["To"]
+            status = self.server.message_statuses.get(recipient, 200)
+            content = {"id": "gmail-id"} if status == 200 else {"error": {"code": status, "message": f"Invalid To header ({recipient})"}}
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} {self.responses.get(status, ('',))[0]}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(content)}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        self.respond(200, f"multipart/mixed; boundary={boundary}", "".join(parts).encode())
+
+    def graph_batch(self, payload):
+        responses = []
+        for request in reversed(payload["requests"]):
+            recipient = request["body"]["message"]["toRecipients"][0]["emailAddress"]["address"]
+            status = self.server.message_statuses.get(recipient, 202)
+            response = {"id": request["id"], "status": status, "headers": {}}
+            if status != 202:
+                response["body"] = {"error": {"code": "ErrorInvalidRecipients", "message": f"Recipient {recipient} not found"}}
+            responses.append(response)
+        self.respond(200, "application/json", json.dumps({"responses": responses}).encode())
+
+
+class FakeRedisList:
+    """
+    Lista Redis in memoria con i soli comandi usati dal buffer del tracking.
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def rpush(self, key, value):
+        self.items.append(value)
+
+    def lrange(self, key, start, end):
+        return self.items[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.items = self.items[start:]
+
+
+def make_email_log():
+    user = User.objects.create_user(email="owner@example.com", password="password123")
+    campaign = Campaign.objects.create(user=user, name="Campaign")
+    lead = Lead.objects.create(campaign=campaign, email="lead@example.com")
+    return EmailLog.objects.create(lead=lead, subject="Hello", sender="sender@example.com")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@mock.patch("emails.utils.tracking_events.on_email_clicked")
+class TrackingEventsTests(TestCase):
+    def setUp(self):
+        self.email_log = make_email_log()
+
+    def event(self, event_type, url=None, **extra):
+        return {"type": event_type, "lead_id": self.email_log.lead_id, "email_log_id": self.email_log.id, "url": url, "ts": time.time(), **extra}
+
+    def test_long_click_url_is_truncated(self, on_email_clicked):
+        url = "https://example.com/" + "a" * 300
+
+        save_tracking_events([self.event(CLICK, url)])
+
+        click = EmailClickTracking.objects.get()
+        self.assertEqual(click.link, url[:CLICK_LINK_MAX_LENGTH])
+
+    def test_invalid_event_does_not_discard_the_batch(self, on_email_clicked):
+        events = [self.event(OPEN), self.event(CLICK, "https://example.com", ts="not a timestamp"), self.event(CLICK, "https://example.com/ok")]
+
+        saved = save_tracking_events(events)
+
+        self.assertEqual(saved, 2)
+        self.assertTrue(EmailOpenTracking.objects.filter(email_log=self.email_log, opened=True).exists())
+        self.assertEqual(list(EmailClickTracking.objects.values_list("link", flat=True)), ["https://example.com/ok"])
+        on_email_clicked.delay.assert_called_once()
+
+    def test_repeated_clicks_are_saved_once(self, on_email_clicked):
+        save_tracking_events([self.event(CLICK, "https://example.com")])
+        save_tracking_events([self.event(CLICK, "https://example.com")])
+
+        self.assertEqual(EmailClickTracking.objects.count(), 1)
+        on_email_clicked.delay.assert_called_once()
+
+    def test_flush_keeps_events_when_the_database_fails(self, on_email_clicked):
+        redis_list = FakeRedisList()
+        with mock.patch.object(tracking_events, "get_redis_client", return_value=redis_list):
+            tracking_events.push_tracking_event(OPEN, self.email_log.lead_id, self.email_log.id)
+
+            with mock.patch.object(tracking_events, "save_tracking_batch", side_effect=OperationalError("database down")):
+                with self.assertRaises(OperationalError):
+                    flush_tracking_events()
+            self.assertEqual(len(redis_list.items), 1)
+
+            flush_tracking_events()
+
+        self.assertEqual(redis_list.items, [])
+        self.assertEqual(EmailOpenTracking.objects.count(), 1)
+
+
+class MemoryRateLimiterTests(TestCase):
+    def reserve(self, backend, now_ts, reservation_id=None, max_per_day=100, day_key="day", day_end=None):
+        day_end = day_end if day_end is not None else now_ts + 86400
+        return backend.reserve(day_key, "bucket", "reservations", now_ts, max_per_day, 30, 10, 10 / 60, day_end, reservation_id)
+
+    def test_waiting_callers_get_distinct_slots(self):
+        backend = MemoryRateLimiterBackend()
+
+        slots = [self.reserve(backend, 1000, f"lead-{i}") for i in range(4)]
+
+        self.assertEqual(slots, [None, 1030, 1060, 1090])
+
+    def test_reserved_slot_is_used_when_the_caller_returns(self):
+        backend = MemoryRateLimiterBackend()
+        self.reserve(backend, 1000, "first")
+        slot = self.reserve(backend, 1000, "second")
+
+        # Ripresentandosi prima dello slot riceve lo stesso slot, allo scadere può inviare
+        self.assertEqual(self.reserve(backend, 1010, "second"), slot)
+        self.assertIsNone(self.reserve(backend, slot, "second"))
+        # Lo slot successivo resta libero per un nuovo chiamante
+        self.assertEqual(self.reserve(backend, slot, "third"), slot + 30)
+
+    def test_reservations_count_towards_the_daily_limit(self):
+        backend = MemoryRateLimiterBackend()
+        self.reserve(backend, 1000, "first", max_per_day=2)
+        self.reserve(backend, 1000, "second", max_per_day=2)
+
+        self.assertEqual(self.reserve(backend, 1000, "third", max_per_day=2), 1000 + 86400)
+
+    def test_slot_after_midnight_is_not_charged_to_today(self):
+        backend = MemoryRateLimiterBackend()
+        self.reserve(backend, 1000, "first", day_end=1050)
+        self.reserve(backend, 1000, "second", day_end=1050)
+
+        # Lo slot successivo (1060) cade nel giorno dopo: si riprova domani, senza consumare la quota di oggi
+        self.assertEqual(self.reserve(backend, 1000, "third", day_end=1050), 1050)
+        self.assertEqual(backend.daily["day"], 2)
+        self.assertNotIn("third", backend.reservations["reservations"])
+
+    def test_released_slot_gives_back_the_daily_quota(self):
+        backend = MemoryRateLimiterBackend()
+        self.reserve(backend, 1000, "first", max_per_day=2)
+        self.reserve(backend, 1000, "second", max_per_day=2)
+
+        self.assertTrue(backend.release("reservations", "second"))
+        self.assertFalse(backend.release("reservations", "second"))
+
+        self.assertEqual(backend.daily["day"], 1)
+        self.assertEqual(self.reserve(backend, 1000, "third", max_per_day=2), 1060)
+
+    def test_reservation_from_a_past_day_is_replaced(self):
+        backend = MemoryRateLimiterBackend()
+        self.reserve(backend, 1000, "first", day_key="monday")
+        self.reserve(backend, 1000, "late", day_key="monday")
+
+        # Ripresa dopo la mezzanotte: l'invio pesa sul nuovo giorno
+        self.assertIsNone(self.reserve(backend, 90000, "late", day_key="tuesday"))
+        self.assertEqual((backend.daily["monday"], backend.daily["tuesday"]), (2, 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueuedEmailClaimTests(TestCase):
+    def setUp(self):
+        email_log = make_email_log()
+        self.email_logs = [email_log] + [
+            EmailLog.objects.create(lead=email_log.lead, subject="Hello", sender=email_log.sender, status=EmailStatus.QUEUED)
+            for _ in range(2)
+        ]
+        EmailLog.objects.filter(id=email_log.id).update(status=EmailStatus.QUEUED)
+        self.sender = email_log.sender
+
+    def test_claimed_emails_are_not_claimed_again(self):
+        claimed = claim_queued_emails(self.sender)
+
+        self.assertEqual(len(claimed), 3)
+        # Lock dell'account scaduto: un altro processo non trova email da inviare
+        self.assertEqual(claim_queued_emails(self.sender), [])
+
+    def test_unsent_claims_go_back_to_the_queue(self):
+        claimed = claim_queued_emails(self.sender)
+        EmailLog.objects.filter(id=claimed[0].id).update(status=EmailStatus.SENT)
+
+        release_claimed_emails(claimed)
+
+        self.assertEqual(EmailLog.objects.filter(status=EmailStatus.QUEUED).count(), 2)
+        self.assertEqual(EmailLog.objects.get(id=claimed[0].id).status, EmailStatus.SENT)
+
+    def test_stale_claims_are_requeued(self):
+        claim_queued_emails(self.sender)
+        EmailLog.objects.update(claimed_at=now() - BULK_SEND_CLAIM_TIMEOUT)
+
+        requeue_stale_claims()
+
+        self.assertEqual(EmailLog.objects.filter(status=EmailStatus.QUEUED).count(), 3)
+
+    def test_lock_is_released_only_by_its_owner(self):
+        token = acquire_bulk_send_lock(self.sender)
+        self.assertIsNone(acquire_bulk_send_lock(self.sender))
+
+        release_bulk_send_lock(self.sender, "another-token")
+        self.assertIsNone(acquire_bulk_send_lock(self.sender))
+
+        release_bulk_send_lock(self.sender, token)
+        self.assertIsNotNone(acquire_bulk_send_lock(self.sender))
+        cache.clear()
+
+
+class SMTPConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.account = SimpleNamespace(pk=1, smtp_host="127.0.0.1", smtp_port=None, username="user", password="secret", email_address="sender@example.com")
+        self.pool = SMTPConnectionPool(max_connections=2, max_idle=60, max_messages=100)
+
+    def start_server(self, drop_after_data=False, close_after_message=False):
+        server = LocalServer(FakeSMTPHandler)
+        server.connections = 0
+        server.messages = []
+        server.drop_after_data = drop_after_data
+        server.close_after_message = close_after_message
+        self.account.smtp_port = server.port
+        # Server di test senza STARTTLS né AUTH: sessione in chiaro
+        patcher = mock.patch.object(
+            SMTPConnectionPool, "open_connection",
+            staticmethod(lambda account: PooledSMTP(account.smtp_host, account.smtp_port, timeout=5))
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.pool.close_all)
+        return server
+
+    def send(self):
+        self.pool.sendmail(self.account, "sender@example.com", ["lead@example.com"], "Subject: Hello\r\n\r\nHi")
+
+    def test_session_is_reused(self):
+        with self.start_server() as server:
+            self.send()
+            self.send()
+
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.messages), 2)
+
+    def test_session_closed_by_the_server_is_reopened(self):
+        with self.start_server(close_after_message=True) as server:
+            self.send()
+            self.send()
+
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(len(server.messages), 2)
+
+    def test_disconnect_after_data_is_not_retried(self):
+        with self.start_server(drop_after_data=True) as server:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                self.send()
+
+        # Il server potrebbe aver accettato il messaggio: nessun secondo invio
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.messages), 1)
+
+
+REPLY_HEADER = b"From: Lead <lead@example.com>\r\nSubject: Re: Hello\r\nDate: Tue, 15 Apr 2025 10:00:00 +0200\r\n\r\n"
+
+
+class ImapSyncTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.server = LocalServer(FakeIMAPHandler)
+        self.server.uidvalidity = 7
+        self.server.messages = {10: (REPLY_HEADER, b"First reply"), 12: (REPLY_HEADER, b"Second reply")}
+        self.server.commands = []
+        self.server.new_message = threading.Event()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.account = ConnectedAccount.objects.create(
+            user=user, provider=Provider.IMAP_SMTP, email_address="sender@example.com",
+            username="user", password="secret", imap_host="127.0.0.1", imap_port=self.server.port
+        )
+
+    def sync(self):
+        mail = open_imap_connection(self.account)
+        try:
+            sync_imap_replies(self.account, mail)
+        finally:
+            mail.logout()
+
+    @mock.patch("emails.tasks.save_email_reply")
+    def test_sync_fetches_only_new_uids(self, save_email_reply):
+        self.sync()
+
+        self.assertEqual([call.args[0]["body"] for call in save_email_reply.call_args_list], ["First reply", "Second reply"])
+        sync_state = MailboxSyncState.objects.get(account=self.account)
+        self.assertEqual((sync_state.imap_uidvalidity, sync_state.imap_last_uid), (7, 12))
+
+        self.server.messages[13] = (REPLY_HEADER, b"Third reply")
+        self.server.commands.clear()
+        save_email_reply.reset_mock()
+        self.sync()
+
+        self.assertEqual(self.server.commands[0], b"SEARCH UID 13:*")
+        self.assertTrue(self.server.commands[1].startswith(b"FETCH 13 "))
+        self.assertEqual([call.args[0]["body"] for call in save_email_reply.call_args_list], ["Third reply"])
+
+    @mock.patch("emails.tasks.save_email_reply")
+    def test_nothing_is_fetched_without_new_messages(self, save_email_reply):
+        self.sync()
+        self.server.commands.clear()
+        save_email_reply.reset_mock()
+
+        self.sync()
+
+        self.assertEqual(self.server.commands, [b"SEARCH UID 13:*"])
+        save_email_reply.assert_not_called()
+
+    def test_idle_returns_on_new_message(self):
+        mail = open_imap_connection(self.account)
+        self.addCleanup(mail.logout)
+        mail.select("INBOX", readonly=True)
+
+        threading.Timer(0.2, self.server.new_message.set).start()
+
+        self.assertTrue(wait_for_new_messages(mail, timeout=5))
+        self.assertEqual(mail.noop()[0], "OK")
+
+    def test_uidvalidity_change_restarts_from_the_mailbox(self):
+        MailboxSyncState.objects.create(account=self.account, imap_uidvalidity=3, imap_last_uid=500)
+
+        with mock.patch("emails.tasks.save_email_reply") as save_email_reply:
+            self.sync()
+
+        self.assertTrue(self.server.commands[0].startswith(b"SEARCH (SINCE "))
+        self.assertEqual(save_email_reply.call_count, 2)
+        sync_state = MailboxSyncState.objects.get(account=self.account)
+        self.assertEqual((sync_state.imap_uidvalidity, sync_state.imap_last_uid), (7, 12))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProviderBatchSendTests(TestCase):
+    RECIPIENTS = ["ok@example.com", "invalid@example.com", "busy@example.com", "down@example.com"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.campaign = Campaign.objects.create(user=self.user, name="Campaign")
+        self.server = LocalServer(FakeProviderHandler)
+        self.server.requests = []
+        self.server.batch_statuses = []
+        self.server.message_statuses = {}
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+        base_url = f"http://127.0.0.1:{self.server.port}"
+        for name, url in (("GMAIL_BATCH_API_URL", f"{base_url}/batch/gmail/v1"), ("GRAPH_BATCH_API_URL", f"{base_url}/v1.0/$batch")):
+            patcher = mock.patch.object(email_sender, name, url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch("emails.email_sender.get_access_token", side_effect=lambda account, force_refresh=False: "new-token" if force_refresh else "token")
+        self.get_access_token = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, provider, recipients=RECIPIENTS):
+        account = ConnectedAccount.objects.create(user=self.user, provider=provider, email_address=f"{provider}@example.com")
+        email_logs = [
+            EmailLog.objects.create(
+                lead=Lead.objects.create(campaign=self.campaign, email=recipient),
+                subject="Hello", body="Hi", sender=account.email_address, status=EmailStatus.QUEUED
+            )
+            for recipient in recipients
+        ]
+        return account, list(EmailLog.objects.filter(id__in=[email_log.id for email_log in email_logs]).select_related("lead").order_by("id"))
+
+    def statuses(self, email_logs):
+        return {email_log.lead.email: EmailLog.objects.get(id=email_log.id).status for email_log in email_logs}
+
+    def assert_results_mapped_per_message(self, provider, success_status):
+        self.server.message_statuses = {
+            "ok@example.com": success_status, "invalid@example.com": 400, "busy@example.com": 429, "down@example.com": 503,
+        }
+        account, email_logs = self.queue(provider)
+
+        email_sender.send_emails_bulk(account, email_logs)
+
+        self.assertEqual(self.statuses(email_logs), {
+            "ok@example.com": EmailStatus.SENT,
+            "invalid@example.com": EmailStatus.FAILED,
+            "busy@example.com": EmailStatus.QUEUED,
+            "down@example.com": EmailStatus.QUEUED,
+        })
+        self.assertIsNotNone(EmailLog.objects.get(id=email_logs[0].id).sent_at)
+        self.assertEqual(Lead.objects.get(email="invalid@example.com").status, LeadStatus.BOUNCED)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_gmail_results_are_mapped_by_content_id(self):
+        self.assert_results_mapped_per_message(Provider.GMAIL, 200)
+
+    def test_graph_results_are_mapped_by_request_id(self):
+        self.assert_results_mapped_per_message(Provider.OUTLOOK, 202)
+
+    def test_rejected_batch_leaves_the_rest_queued(self):
+        for provider in (Provider.GMAIL, Provider.OUTLOOK):
+            with self.subTest(provider=provider), mock.patch.dict(
+                email_sender.BATCH_SENDERS, {provider: (email_sender.BATCH_SENDERS[provider][0], 2)}
+            ):
+                cache.clear()
+                self.server.batch_statuses = [200, 503]
+                account, email_logs = self.queue(provider, [f"{provider}-{index}@example.com" for index in range(4)])
+
+                email_sender.send_emails_bulk(account, email_logs)
+
+                self.assertEqual(
+                    [EmailLog.objects.get(id=email_log.id).status for email_log in email_logs],
+                    [EmailStatus.SENT, EmailStatus.SENT, EmailStatus.QUEUED, EmailStatus.QUEUED]
+                )
+
+    def test_unauthorized_batch_is_retried_once_with_a_refreshed_token(self):
+        self.server.batch_statuses = [401]
+        account, email_logs = self.queue(Provider.GMAIL, ["ok@example.com"])
+
+        email_sender.send_emails_bulk(account, email_logs)
+
+        self.assertEqual([authorization for _, authorization in self.server.requests], ["Bearer token", "Bearer new-token"])
+        self.get_access_token.assert_called_with(account, force_refresh=True)
+        self.assertEqual(self.statuses(email_logs), {"ok@example.com": EmailStatus.SENT})
+
+    def test_second_unauthorized_response_keeps_emails_queued(self):
+        self.server.batch_statuses = [401, 401]
+        account, email_logs = self.queue(Provider.OUTLOOK, ["ok@example.com"])
+
+        email_sender.send_emails_bulk(account, email_logs)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.get_access_token.call_count, 2)
+        self.assertEqual(self.statuses(email_logs), {"ok@example.com": EmailStatus.QUEUED})
+
+
+class FakeProviderApi:
+    """
+    Risposte di `http_get` per URL, restituite in ordine; registra URL e parametri di ogni chiamata.
+    """
+
+    def __init__(self, responses):
+        self.responses = {url: list(items) for url, items in responses.items()}
+        self.calls = []
+
+    def __call__(self, url, headers=None, params=None, **kwargs):
+        self.calls.append((url, dict(params) if params else None))
+        status_code, data = self.responses[url].pop(0)
+        return SimpleNamespace(status_code=status_code, json=lambda: data, text=json.dumps(data))
+
+    def urls(self):
+        return [url for url, _ in self.calls]
+
+
+def gmail_message(msg_id, subject="Re: Hello"):
+    return 200, {
+        "id": msg_id, "internalDate": "1744700000000",
+        "payload": {"headers": [{"name": "From", "value": "lead@example.com"}, {"name": "Subject", "value": subject}]},
+    }
+
+
+def outlook_message(subject="Re: Hello", **extra):
+    return {
+        "subject": subject, "from": {"emailAddress": {"address": "lead@example.com"}},
+        "body": {"content": "Thanks"}, "receivedDateTime": "2025-04-15T10:00:00Z", **extra,
+    }
+
+
+@mock.patch("emails.tasks.save_email_reply")
+class MailboxCursorSyncTests(TestCase):
+    DELTA_LINK = "https://graph.example.com/delta?$deltatoken=abc"
+    NEXT_LINK = "https://graph.example.com/delta?$skiptoken=page2"
+
+    def setUp(self):
+        user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.account = ConnectedAccount.objects.create(user=user, provider=Provider.GMAIL, email_address="sender@example.com")
+
+    def sync(self, check_replies, responses):
+        api = FakeProviderApi(responses)
+        with mock.patch("emails.tasks.http_get", side_effect=api):
+            check_replies(self.account, "token")
+        return api
+
+    def sync_state(self):
+        return MailboxSyncState.objects.get(account=self.account)
+
+    def test_gmail_first_sync_stores_the_history_id(self, save_email_reply):
+        api = self.sync(email_tasks.check_gmail_replies, {
+            email_tasks.GMAIL_PROFILE_URL: [(200, {"historyId": "100"})],
+            email_tasks.GMAIL_API_URL: [(200, {"messages": [{"id": "m1"}, {"id": "m2"}]})],
+            f"{email_tasks.GMAIL_API_URL}/m1": [gmail_message("m1")],
+            f"{email_tasks.GMAIL_API_URL}/m2": [gmail_message("m2", subject="Newsletter")],
+        })
+
+        self.assertNotIn(email_tasks.GMAIL_HISTORY_URL, api.urls())
+        self.assertEqual(save_email_reply.call_count, 1)
+        self.assertEqual(self.sync_state().gmail_history_id, "100")
+        self.assertIsNotNone(self.sync_state().last_synced_at)
+
+    def test_gmail_incremental_sync_reads_history_pages(self, save_email_reply):
+        MailboxSyncState.objects.create(account=self.account, gmail_history_id="100")
+
+        api = self.sync(email_tasks.check_gmail_replies, {
+            email_tasks.GMAIL_HISTORY_URL: [
+                (200, {"history": [{"messagesAdded": [{"message": {"id": "m3"}}]}], "historyId": "110", "nextPageToken": "p2"}),
+                (200, {"history": [{"messagesAdded": [{"message": {"id": "m3"}}, {"message": {"id": "m4"}}]}], "historyId": "120"}),
+            ],
+            f"{email_tasks.GMAIL_API_URL}/m3": [gmail_message("m3")],
+            f"{email_tasks.GMAIL_API_URL}/m4": [gmail_message("m4")],
+        })
+
+        self.assertEqual(api.calls[0], (email_tasks.GMAIL_HISTORY_URL, {"startHistoryId": "100", "historyTypes": "messageAdded", "labelId": "INBOX"}))
+        self.assertEqual(api.calls[1][1]["pageToken"], "p2")
+        self.assertNotIn(email_tasks.GMAIL_API_URL, api.urls())  # Nessuna lista completa
+        self.assertEqual(save_email_reply.call_count, 2)  # m3 una sola volta
+        self.assertEqual(self.sync_state().gmail_history_id, "120")
+
+    def test_gmail_expired_history_runs_a_full_resync(self, save_email_reply):
+        MailboxSyncState.objects.create(account=self.account, gmail_history_id="5")
+
+        api = self.sync(email_tasks.check_gmail_replies, {
+            email_tasks.GMAIL_HISTORY_URL: [(404, {"error": {"message": "Requested entity was not found."}})],
+            email_tasks.GMAIL_PROFILE_URL: [(200, {"historyId": "150"})],
+            email_tasks.GMAIL_API_URL: [(200, {"messages": [{"id": "m5"}]})],
+            f"{email_tasks.GMAIL_API_URL}/m5": [gmail_message("m5")],
+        })
+
+        self.assertEqual(api.urls()[:3], [email_tasks.GMAIL_HISTORY_URL, email_tasks.GMAIL_PROFILE_URL, email_tasks.GMAIL_API_URL])
+        self.assertEqual(save_email_reply.call_count, 1)
+        self.assertEqual(self.sync_state().gmail_history_id, "150")
+
+    def test_gmail_history_error_keeps_the_cursor(self, save_email_reply):
+        MailboxSyncState.objects.create(account=self.account, gmail_history_id="100")
+
+        self.sync(email_tasks.check_gmail_replies, {email_tasks.GMAIL_HISTORY_URL: [(500, {"error": "backend"})]})
+
+        save_email_reply.assert_not_called()
+        self.assertEqual(self.sync_state().gmail_history_id, "100")
+
+    def test_outlook_first_sync_follows_pages_and_stores_the_delta_link(self, save_email_reply):
+        api = self.sync(email_tasks.check_outlook_replies, {
+            email_tasks.OUTLOOK_DELTA_URL: [(200, {"value": [outlook_message(), outlook_message(subject="Offer")], "@odata.nextLink": self.NEXT_LINK})],
+            self.NEXT_LINK: [(200, {"value": [outlook_message(), {"id": "x", "@removed": {"reason": "deleted"}}], "@odata.deltaLink": self.DELTA_LINK})],
+        })
+
+        self.assertIn("$filter", api.calls[0][1])
+        self.assertIsNone(api.calls[1][1])
+        self.assertEqual(save_email_reply.call_count, 2)
+        self.assertEqual(self.sync_state().outlook_delta_link, self.DELTA_LINK)
+
+    def test_outlook_incremental_sync_uses_the_delta_link(self, save_email_reply):
+        MailboxSyncState.objects.create(account=self.account, outlook_delta_link=self.DELTA_LINK)
+        next_delta = "https://graph.example.com/delta?$deltatoken=def"
+
+        api = self.sync(email_tasks.check_outlook_replies, {
+            self.DELTA_LINK: [(200, {"value": [outlook_message()], "@odata.deltaLink": next_delta})],
+        })
+
+        self.assertEqual(api.calls, [(self.DELTA_LINK, None)])
+        self.assertEqual(save_email_reply.call_count, 1)
+        self.assertEqual(self.sync_state().outlook_delta_link, next_delta)
+
+    def test_outlook_expired_delta_restarts_the_sync(self, save_email_reply):
+        MailboxSyncState.objects.create(account=self.account, outlook_delta_link=self.DELTA_LINK)
+
+        api = self.sync(email_tasks.check_outlook_replies, {
+            self.DELTA_LINK: [(410, {"error": {"code": "SyncStateNotFound"}})],
+            email_tasks.OUTLOOK_DELTA_URL: [(200, {"value": [outlook_message()], "@odata.deltaLink": self.NEXT_LINK})],
+        })
+
+        self.assertEqual(api.urls(), [self.DELTA_LINK, email_tasks.OUTLOOK_DELTA_URL])
+        self.assertIn("$filter", api.calls[1][1])
+        self.assertEqual(save_email_reply.call_count, 1)
+        self.assertEqual(self.sync_state().outlook_delta_link, self.NEXT_LINK)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, IMAP_IDLE_ENABLED=False)
+@mock.patch("emails.tasks.check_oauth_replies")
+@mock.patch("emails.tasks.group")
+class ReplyPollCycleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.account_ids = [
+            ConnectedAccount.objects.create(user=user, provider=Provider.GMAIL, email_address=f"sender{i}@example.com").id
+            for i in range(3)
+        ]
+
+    def dispatch(self, group):
+        group.reset_mock()
+        email_tasks.check_email_replies()
+        if not group.called:
+            return None
+        return [signature.args for signature in group.call_args.args[0]]
+
+    def run_accounts(self, subtasks):
+        for account_id, cycle in subtasks:
+            email_tasks.check_account_replies(account_id, cycle)
+
+    def test_overlapping_cycle_is_not_dispatched(self, group, check_oauth_replies):
+        subtasks = self.dispatch(group)
+        self.assertEqual([account_id for account_id, _ in subtasks], self.account_ids)
+
+        self.assertIsNone(self.dispatch(group))  # Subtask del primo ciclo ancora in corso
+
+        self.run_accounts(subtasks)
+        self.assertIsNotNone(self.dispatch(group))  # L'ultimo subtask ha liberato il lock
+
+    def test_cycle_metrics_are_saved_by_the_last_account(self, group, check_oauth_replies):
+        cache.add(email_tasks.get_reply_poll_lock_key(self.account_ids[0]), "previous-cycle")
+        subtasks = self.dispatch(group)
+
+        self.run_accounts(subtasks[:2])
+        self.assertIsNone(cache.get(email_tasks.REPLY_POLL_METRICS_KEY))
+
+        self.run_accounts(subtasks[2:])
+        metrics = cache.get(email_tasks.REPLY_POLL_METRICS_KEY)
+        self.assertEqual((metrics["accounts"], metrics["skipped"]), (3, 1))
+        self.assertEqual(check_oauth_replies.call_count, 2)
+        self.assertIsNone(cache.get(email_tasks.REPLY_POLL_CYCLE_LOCK_KEY))
+
+    def test_expired_cycle_counters_release_the_lock(self, group, check_oauth_replies):
+        subtasks = self.dispatch(group)
+        cache.delete(email_tasks.get_reply_poll_cycle_key(subtasks[0][1]["id"]))
+
+        self.run_accounts(subtasks[:1])
+
+        self.assertIsNone(cache.get(email_tasks.REPLY_POLL_METRICS_KEY))
+        self.assertIsNotNone(self.dispatch(group))
+
+
+class FindRepliedEmailLogTests(TestCase):
+    def setUp(self):
+        self.first = make_email_log()
+        self.second = EmailLog.objects.create(lead=self.first.lead, subject="Follow-up", sender=self.first.sender)
+        self.account = SimpleNamespace(email_address=self.first.sender)
+
+    def find(self, subject="Re: Something else", lead_email="Lead <LEAD@example.com>", **headers):
+        email_data = {"subject": subject, "lead_email": lead_email, **headers}
+        return email_tasks.find_replied_email_log(email_data, self.account)
+
+    def test_in_reply_to_message_id_is_matched_first(self):
+        email_log = self.find(in_reply_to=self.first.message_id, references=f"{self.first.message_id} {self.second.message_id}")
+
+        self.assertEqual(email_log, self.first)
+
+    def test_references_are_matched_from_the_newest(self):
+        references = f"{self.first.message_id} <unknown@example.com> {self.second.message_id} <other@example.com>"
+
+        self.assertEqual(self.find(references=references), self.second)
+        self.assertEqual(self.find(in_reply_to="<missing@example.com>", references=self.first.message_id), self.first)
+
+    def test_subject_and_sender_fallback(self):
+        self.assertEqual(self.find(subject="RE: Re:  follow-UP"), self.second)
+        self.assertEqual(self.find(subject="R: Hello", in_reply_to="<missing@example.com>"), self.first)
+
+    def test_no_match(self):
+        self.assertIsNone(self.find(subject="Re: Hello", lead_email="other@example.com"))
+        self.assertIsNone(self.find(subject="Re: Hello", lead_email=None))
+        self.account.email_address = "another-sender@example.com"
+        self.assertIsNone(self.find(subject="Re: Hello"))
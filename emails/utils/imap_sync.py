@@ -0,0 +1,268 @@
+import email
+import imaplib
+import re
+import select
+import time
+from datetime import timedelta
+from email.header import decode_header, make_header
+from email.utils import parseaddr, parsedate_to_datetime
+from django.db import close_old_connections
+from django.utils.timezone import now
+from emails.models import MailboxSyncState
+
+IMAP_TIMEOUT = 30  # Secondi per connessione e comandi IMAP
+IMAP_FETCH_BATCH_SIZE = 50  # UID per singolo UID FETCH
+IMAP_BODY_MAX_BYTES = 65536  # Byte del testo scaricati per messaggio
+IMAP_BOOTSTRAP_DAYS = 5  # Primo avvio o UIDVALIDITY cambiata: risposte degli ultimi N giorni
+IMAP_IDLE_TIMEOUT = 29 * 60  # RFC 2177: rinnovare l'IDLE prima dei 30 minuti
+IMAP_IDLE_CHECK_INTERVAL = 5  # Secondi tra due controlli dello stop durante l'IDLE
+IMAP_POLL_INTERVAL = 60  # Server senza IDLE: secondi tra due sincronizzazioni
+IMAP_RECONNECT_DELAY = 30  # Secondi di attesa prima di riaprire una sessione caduta
+
+# Solo header utili e testo, senza scaricare allegati; PEEK non imposta il flag \Seen
+IMAP_FETCH_ITEMS = (
+    f"(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES "
+    f"CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT]<0.{IMAP_BODY_MAX_BYTES}>)"
+)
+
+UID_PATTERN = re.compile(rb"UID (\d+)")
+MESSAGE_START_PATTERN = re.compile(rb"^\d+ \(")
+
+
+def open_imap_connection(account):
+    """
+    Sessione IMAP autenticata: SSL sulla porta 993, altrimenti STARTTLS se il server lo supporta.
+    """
+    if account.imap_port == 993:
+        mail = imaplib.IMAP4_SSL(account.imap_host, account.imap_port, timeout=IMAP_TIMEOUT)
+    else:
+        mail = imaplib.IMAP4(account.imap_host, account.imap_port, timeout=IMAP_TIMEOUT)
+        if "STARTTLS" in mail.capabilities:
+            mail.starttls()
+    mail.login(account.username, account.password)
+    return mail
+
+
+def decode_header_value(value):
+    if not value:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except (UnicodeDecodeError, LookupError):
+        return value
+
+
+def get_text_body(message):
+    """
+    Corpo testuale del messaggio (prima parte text/plain se multipart).
+    """
+    parts = message.walk() if message.is_multipart() else [message]
+    for part in parts:
+        if part.get_content_type() == "text/plain" and not part.is_multipart():
+            payload = part.get_payload(decode=True) or b""
+            return payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+    return ""
+
+
+def parse_fetch_response(data):
+    """
+    Raggruppa la risposta di UID FETCH per messaggio: [(uid, header_bytes, text_bytes)].
+    """
+    messages = []
+    current = None
+
+    def flush():
+        if current and current["uid"] is not None:
+            messages.append((current["uid"], current["header"], current["text"]))
+
+    for item in data:
+        if isinstance(item, tuple):
+            descriptor, content = item
+            if MESSAGE_START_PATTERN.match(descriptor):
+                flush()
+                current = {"uid": None, "header": b"", "text": b""}
+            if current is None:
+                continue
+            uid = UID_PATTERN.search(descriptor)
+            if uid:
+                current["uid"] = int(uid.group(1))
+            if b"HEADER.FIELDS" in descriptor.upper():
+                current["header"] = content
+            elif b"TEXT" in descriptor.upper():
+                current["text"] = content
+        elif isinstance(item, bytes) and current is not None:
+            uid = UID_PATTERN.search(item)
+            if uid and current["uid"] is None:
+                current["uid"] = int(uid.group(1))
+
+    flush()
+    return messages
+
+
+def build_reply_data(header, text):
+    message = email.message_from_bytes(header.rstrip(b"\r\n") + b"\r\n\r\n" + text)
+    received_at = now()
+    if message["Date"]:
+        try:
+            received_at = parsedate_to_datetime(message["Date"])
+        except (TypeError, ValueError):
+            pass
+
+    return {
+        "lead_email": parseaddr(message["From"] or "")[1],
+        "subject": decode_header_value(message["Subject"]),
+        "body": get_text_body(message),
+        "received_at": received_at.isoformat(),
+        "in_reply_to": message["In-Reply-To"],
+        "references": message["References"],
+    }
+
+
+def get_select_value(mail, name):
+    _, values = mail.response(name)
+    if values and values[0]:
+        return int(values[0])
+    return None
+
+
+def sync_imap_replies(account, mail):
+    """
+    Sincronizzazione incrementale della INBOX: UID SEARCH solo oltre l'ultimo UID salvato
+    (se UIDVALIDITY non è cambiata) e UID FETCH a blocchi di header e testo.
+    La cartella è aperta in sola lettura: i messaggi non vengono segnati come letti.
+    """
+    from emails.tasks import is_reply_subject, save_email_reply
+
+    sync_state, _ = MailboxSyncState.objects.get_or_create(account=account)
+
+    result, _ = mail.select("INBOX", readonly=True)
+    if result != "OK":
+        print(f"IMAP: unable to open INBOX for {account.email_address}")
+        return
+    uidvalidity = get_select_value(mail, "UIDVALIDITY")
+    uidnext = get_select_value(mail, "UIDNEXT")
+
+    incremental = sync_state.imap_uidvalidity == uidvalidity and sync_state.imap_last_uid is not None
+    if incremental:
+        last_uid = sync_state.imap_last_uid
+        result, data = mail.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+    else:
+        # Primo avvio o mailbox ricreata: gli UID salvati non sono più validi
+        last_uid = (uidnext - 1) if uidnext else 0
+        since = (now() - timedelta(days=IMAP_BOOTSTRAP_DAYS)).strftime("%d-%b-%Y")
+        result, data = mail.uid("SEARCH", None, f'(SINCE {since} SUBJECT "Re:")')
+
+    if result != "OK":
+        print(f"IMAP: search failed for {account.email_address}")
+        return
+
+    uids = sorted(int(value) for value in data[0].split())
+    if incremental:
+        # "N:*" restituisce sempre almeno l'ultimo messaggio, anche se già elaborato
+        uids = [uid for uid in uids if uid > last_uid]
+
+    for start in range(0, len(uids), IMAP_FETCH_BATCH_SIZE):
+        batch = uids[start:start + IMAP_FETCH_BATCH_SIZE]
+        result, data = mail.uid("FETCH", ",".join(str(uid) for uid in batch), IMAP_FETCH_ITEMS)
+        if result != "OK":
+            print(f"IMAP: fetch failed for {account.email_address}")
+            return
+
+        for uid, header, text in parse_fetch_response(data):
+            email_data = build_reply_data(header, text)
+            if is_reply_subject(email_data["subject"]):
+                save_email_reply(email_data, account)
+            last_uid = max(last_uid, uid)
+
+        # Avanzamento salvato a ogni blocco: dopo un errore i messaggi già elaborati non vengono riletti
+        save_imap_cursor(sync_state, uidvalidity, last_uid)
+
+    if not uids:
+        save_imap_cursor(sync_state, uidvalidity, last_uid)
+
+
+def save_imap_cursor(sync_state, uidvalidity, last_uid):
+    sync_state.imap_uidvalidity = uidvalidity
+    sync_state.imap_last_uid = last_uid
+    sync_state.last_synced_at = now()
+    sync_state.save(update_fields=["imap_uidvalidity", "imap_last_uid", "last_synced_at"])
+
+
+def wait_for_new_messages(mail, timeout=IMAP_IDLE_TIMEOUT, stop_event=None):
+    """
+    IMAP IDLE (RFC 2177): attende una notifica EXISTS dal server, lo scadere del timeout
+    o lo stop del processo. Restituisce True se sono arrivati nuovi messaggi.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    if not mail.readline().startswith(b"+"):
+        raise imaplib.IMAP4.error("IDLE not accepted by the server")
+
+    new_messages = False
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline and not (stop_event and stop_event.is_set()):
+            # select() e non un timeout sul socket: dopo un timeout imaplib non può più leggere
+            wait = min(deadline - time.monotonic(), IMAP_IDLE_CHECK_INTERVAL)
+            readable, _, _ = select.select([mail.sock], [], [], max(wait, 0))
+            if not readable:
+                continue
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(b"*") and b"EXISTS" in line:
+                new_messages = True
+                break
+    finally:
+        mail.send(b"DONE\r\n")
+        # Consuma le risposte fino a quella con il tag dell'IDLE
+        while True:
+            line = mail.readline()
+            if not line or line.startswith(tag):
+                break
+
+    return new_messages
+
+
+class ImapIdleSession:
+    """
+    Sessione IMAP persistente per un account: sincronizza la INBOX e resta in IDLE,
+    risincronizzando a ogni nuovo messaggio. Se il server non supporta IDLE
+    la sincronizzazione avviene ogni `IMAP_POLL_INTERVAL` secondi sulla stessa connessione.
+    """
+
+    def __init__(self, account, stop_event):
+        self.account = account
+        self.stop_event = stop_event
+
+    def run(self):
+        while not self.stop_event.is_set():
+            mail = None
+            try:
+                mail = open_imap_connection(self.account)
+                supports_idle = "IDLE" in mail.capabilities
+                print(f"📬 IMAP session opened for {self.account.email_address} (IDLE: {supports_idle})")
+
+                sync_imap_replies(self.account, mail)
+                while not self.stop_event.is_set():
+                    if supports_idle:
+                        new_messages = wait_for_new_messages(mail, stop_event=self.stop_event)
+                    else:
+                        new_messages = not self.stop_event.wait(IMAP_POLL_INTERVAL)
+                    if new_messages:
+                        sync_imap_replies(self.account, mail)
+                    elif not self.stop_event.is_set():
+                        mail.noop()  # Mantiene viva la sessione
+            except (imaplib.IMAP4.error, OSError) as e:
+                print(f"IMAP session error for {self.account.email_address}: {e}")
+                self.stop_event.wait(IMAP_RECONNECT_DELAY)
+            except Exception as e:
+                print(f"❌ IMAP sync error for {self.account.email_address}: {e}")
+                self.stop_event.wait(IMAP_RECONNECT_DELAY)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except (imaplib.IMAP4.error, OSError):
+                        pass
+                close_old_connections()
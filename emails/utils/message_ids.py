@@ -0,0 +1,34 @@
+import re
+from email.utils import make_msgid
+
+MESSAGE_ID_PATTERN = re.compile(r"<[^<>\s]+>")
+# Prefissi di risposta/inoltro ripetuti, anche localizzati (Re:, R:, RIF:, AW:, SV:, Fwd:, I:, ...)
+REPLY_PREFIX_PATTERN = re.compile(r"^\s*((re|r|rif|aw|sv|vs|antw|fwd?|i|tr|wg)(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NORMALIZED_SUBJECT_MAX_LENGTH = 255
+
+
+def generate_message_id(sender):
+    """
+    Message-ID univoco (RFC 5322) nel dominio del mittente, es. <1713..@example.com>.
+    """
+    domain = sender.rsplit("@", 1)[-1] if sender and "@" in sender else None
+    return make_msgid(domain=domain)
+
+
+def parse_message_ids(*headers):
+    """
+    Message-ID contenuti negli header In-Reply-To/References, nell'ordine in cui compaiono.
+    """
+    message_ids = []
+    for header in headers:
+        message_ids.extend(MESSAGE_ID_PATTERN.findall(header or ""))
+    return list(dict.fromkeys(message_ids))
+
+
+def normalize_subject(subject):
+    """
+    Oggetto senza prefissi di risposta, spazi multipli e maiuscole: "RE: Re:  Ciao" -> "ciao".
+    """
+    subject = REPLY_PREFIX_PATTERN.sub("", subject or "")
+    return WHITESPACE_PATTERN.sub(" ", subject).strip().lower()[:NORMALIZED_SUBJECT_MAX_LENGTH]
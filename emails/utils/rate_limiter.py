@@ -0,0 +1,272 @@
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+from django.conf import settings
+from django.utils.timezone import localtime, now
+from redis.exceptions import RedisError
+from connected_accounts.models import Provider
+from utils.redis_client import get_redis_client
+
+# Burst massimo per provider: (token, secondi per ricaricare l'intero bucket)
+PROVIDER_BURST_LIMITS = {
+    Provider.GMAIL: (20, 60),
+    Provider.OUTLOOK: (30, 60),
+    Provider.IMAP_SMTP: (10, 60),
+}
+
+# Controllo atomico di limite giornaliero, pausa minima e burst del provider.
+# Ogni chiamata riserva uno slot distinto: subito ("0") oppure nel futuro, avanzando `next_free`
+# di `min_interval` e consumando il token (il bucket può andare in negativo: debito ripagato dalla ricarica).
+# Lo slot futuro resta assegnato a `reservation_id` ("slot|day_key") e viene usato quando il chiamante
+# si ripresenta; uno slot che cadrebbe dopo la mezzanotte non viene riservato né addebitato, così ogni
+# invio pesa sul contatore del giorno in cui parte.
+# Restituisce "0" se si può inviare subito, altrimenti il timestamp dello slot riservato
+# (o della fine del giorno se il limite giornaliero è raggiunto o lo slot cade nel giorno dopo).
+RESERVE_SLOT_SCRIPT = """
+local day_key = KEYS[1]
+local bucket_key = KEYS[2]
+local reservations_key = KEYS[3]
+local now = tonumber(ARGV[1])
+local max_per_day = tonumber(ARGV[2])
+local min_interval = tonumber(ARGV[3])
+local capacity = tonumber(ARGV[4])
+local refill_rate = tonumber(ARGV[5])
+local day_end = tonumber(ARGV[6])
+local reservation_id = ARGV[7]
+
+if reservation_id ~= '' then
+    local entry = redis.call('HGET', reservations_key, reservation_id)
+    if entry then
+        local separator = string.find(entry, '|', 1, true)
+        local reserved = tonumber(string.sub(entry, 1, separator - 1))
+        if string.sub(entry, separator + 1) == day_key and reserved > now then
+            return tostring(reserved)
+        end
+        redis.call('HDEL', reservations_key, reservation_id)
+        if string.sub(entry, separator + 1) == day_key then
+            return '0'
+        end
+        -- Slot di un giorno ormai passato (ripresa in ritardo): se ne riserva uno nuovo per oggi
+    end
+end
+
+local sent_today = tonumber(redis.call('GET', day_key) or '0')
+if sent_today >= max_per_day then
+    return tostring(day_end)
+end
+
+local state = redis.call('HMGET', bucket_key, 'tokens', 'ts', 'next_free')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local next_free = tonumber(state[3]) or 0
+tokens = math.min(capacity, tokens + (now - ts) * refill_rate)
+
+local slot = math.max(now, next_free)
+if tokens < 1 then
+    slot = math.max(slot, now + (1 - tokens) / refill_rate)
+end
+if slot >= day_end then
+    return tostring(day_end)
+end
+
+redis.call('HSET', bucket_key, 'tokens', tokens - 1, 'ts', now, 'next_free', slot + min_interval)
+redis.call('EXPIRE', bucket_key, 86400)
+redis.call('INCR', day_key)
+redis.call('EXPIREAT', day_key, math.ceil(day_end) + 3600)
+
+if slot <= now then
+    return '0'
+end
+if reservation_id ~= '' then
+    redis.call('HSET', reservations_key, reservation_id, tostring(slot) .. '|' .. day_key)
+    redis.call('EXPIRE', reservations_key, 2 * 86400)
+end
+return tostring(slot)
+"""
+
+# Rilascio di uno slot riservato e non usato (lead che ha risposto, disiscritto, nodo fallito):
+# la prenotazione viene rimossa e il contatore del giorno dello slot torna indietro di uno.
+RELEASE_SLOT_SCRIPT = """
+local reservations_key = KEYS[1]
+local day_key = KEYS[2]
+local reservation_id = ARGV[1]
+
+local entry = redis.call('HGET', reservations_key, reservation_id)
+if not entry or string.sub(entry, string.find(entry, '|', 1, true) + 1) ~= day_key then
+    return 0
+end
+redis.call('HDEL', reservations_key, reservation_id)
+if tonumber(redis.call('GET', day_key) or '0') > 0 then
+    redis.call('DECR', day_key)
+end
+return 1
+"""
+
+
+class MemoryRateLimiterBackend:
+    """
+    Stessa logica degli script Redis, valida solo nel processo corrente (test e sviluppo).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.daily = {}
+        self.buckets = {}
+        self.reservations = {}
+
+    def seed_daily_count(self, day_key, count):
+        with self.lock:
+            self.daily.setdefault(day_key, count)
+
+    def has_daily_count(self, day_key):
+        return day_key in self.daily
+
+    def reserve(self, day_key, bucket_key, reservations_key, now_ts, max_per_day, min_interval, capacity, refill_rate, day_end_ts, reservation_id=None):
+        with self.lock:
+            reservations = self.reservations.setdefault(reservations_key, {})
+            if reservation_id and reservation_id in reservations:
+                reserved, reserved_day_key = reservations[reservation_id]
+                if reserved_day_key == day_key and reserved > now_ts:
+                    return reserved
+                del reservations[reservation_id]
+                if reserved_day_key == day_key:
+                    return None
+
+            if self.daily.get(day_key, 0) >= max_per_day:
+                return day_end_ts
+
+            tokens, ts, next_free = self.buckets.get(bucket_key, (capacity, now_ts, 0))
+            tokens = min(capacity, tokens + (now_ts - ts) * refill_rate)
+
+            slot = max(now_ts, next_free)
+            if tokens < 1:
+                slot = max(slot, now_ts + (1 - tokens) / refill_rate)
+            if slot >= day_end_ts:
+                return day_end_ts
+
+            self.buckets[bucket_key] = (tokens - 1, now_ts, slot + min_interval)
+            self.daily[day_key] = self.daily.get(day_key, 0) + 1
+
+            if slot <= now_ts:
+                return None
+            if reservation_id:
+                reservations[reservation_id] = (slot, day_key)
+            return slot
+
+    def release(self, reservations_key, reservation_id):
+        with self.lock:
+            reservation = self.reservations.get(reservations_key, {}).pop(reservation_id, None)
+            if reservation is None:
+                return False
+            day_key = reservation[1]
+            if self.daily.get(day_key, 0) > 0:
+                self.daily[day_key] -= 1
+            return True
+
+
+class RedisRateLimiterBackend:
+    """
+    Token bucket condiviso tra tutti i worker Celery.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.script = client.register_script(RESERVE_SLOT_SCRIPT)
+        self.release_script = client.register_script(RELEASE_SLOT_SCRIPT)
+
+    def seed_daily_count(self, day_key, count):
+        self.client.set(day_key, count, nx=True, ex=2 * 86400)
+
+    def has_daily_count(self, day_key):
+        return bool(self.client.exists(day_key))
+
+    def reserve(self, day_key, bucket_key, reservations_key, now_ts, max_per_day, min_interval, capacity, refill_rate, day_end_ts, reservation_id=None):
+        result = float(self.script(
+            keys=[day_key, bucket_key, reservations_key],
+            args=[now_ts, max_per_day, min_interval, capacity, refill_rate, day_end_ts, reservation_id or ""]
+        ))
+        return result or None
+
+    def release(self, reservations_key, reservation_id):
+        entry = self.client.hget(reservations_key, reservation_id)
+        if entry is None:
+            return False
+        # Il giorno addebitato è scritto nella prenotazione; lo script lo ricontrolla in modo atomico
+        day_key = (entry.decode() if isinstance(entry, bytes) else entry).split("|", 1)[1]
+        return bool(self.release_script(keys=[reservations_key, day_key], args=[reservation_id]))
+
+
+_memory_backend = MemoryRateLimiterBackend()
+_redis_backend = None
+
+
+def get_rate_limiter_backend():
+    global _redis_backend
+    if getattr(settings, "SEND_RATE_LIMITER_BACKEND", "redis") == "memory":
+        return _memory_backend
+
+    if _redis_backend is None:
+        client = get_redis_client()
+        if client is None:
+            return _memory_backend
+        _redis_backend = RedisRateLimiterBackend(client)
+    return _redis_backend
+
+
+def get_reservations_key(account):
+    return f"send_limit:{account.id}:reservations"
+
+
+def reserve_send_slot(account, max_per_day, min_interval, user_timezone, reservation_id=None):
+    """
+    Riserva uno slot di invio per l'account rispettando limite giornaliero (nel fuso dell'utente),
+    pausa minima tra due email e burst del provider.
+    Restituisce None se si può inviare subito, altrimenti il datetime dello slot riservato:
+    ogni chiamante in attesa riceve uno slot diverso. Con `reservation_id` (es. lead e nodo)
+    lo slot resta assegnato al chiamante, che allo scadere invia senza riservarne un altro.
+    """
+    from emails.models import EmailLog
+
+    local_now = localtime(now(), user_timezone)
+    day_start = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    day_end = day_start + timedelta(days=1)
+
+    day_key = f"send_limit:{account.id}:day:{day_start.date().isoformat()}"
+    bucket_key = f"send_limit:{account.id}:bucket"
+    reservations_key = get_reservations_key(account)
+    capacity, period = PROVIDER_BURST_LIMITS.get(account.provider, (10, 60))
+
+    backend = get_rate_limiter_backend()
+    try:
+        # Primo invio del giorno: il contatore parte dalle email già registrate (una sola COUNT al giorno)
+        if not backend.has_daily_count(day_key):
+            sent_today = EmailLog.objects.filter(sender=account.email_address, sent_at__gte=day_start).count()
+            backend.seed_daily_count(day_key, sent_today)
+
+        next_slot = backend.reserve(
+            day_key, bucket_key, reservations_key, time.time(), max_per_day, min_interval or 0,
+            capacity, capacity / period, day_end.timestamp(), reservation_id
+        )
+    except RedisError as e:
+        print(f"⚠️ Rate limiter Redis non disponibile, uso il limiter locale: {e}")
+        backend = _memory_backend
+        next_slot = backend.reserve(
+            day_key, bucket_key, reservations_key, time.time(), max_per_day, min_interval or 0,
+            capacity, capacity / period, day_end.timestamp(), reservation_id
+        )
+
+    if next_slot is None:
+        return None
+    return datetime.fromtimestamp(next_slot, tz=day_start.tzinfo)
+
+
+def release_send_slot(account, reservation_id):
+    """
+    Libera lo slot riservato da `reservation_id` quando il chiamante non invierà più l'email,
+    restituendo la quota al giorno a cui era stato addebitato. Senza prenotazione non fa nulla.
+    """
+    try:
+        return get_rate_limiter_backend().release(get_reservations_key(account), reservation_id)
+    except RedisError as e:
+        print(f"⚠️ Rate limiter Redis non disponibile, slot {reservation_id} non rilasciato: {e}")
+        return _memory_backend.release(get_reservations_key(account), reservation_id)
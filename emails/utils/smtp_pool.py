@@ -0,0 +1,231 @@
+import os
+import smtplib
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+
+SMTP_TIMEOUT = 30  # Secondi per connessione e comandi SMTP
+SMTP_NOOP_AFTER = 10  # Una sessione ferma da più di N secondi viene verificata con NOOP prima dell'uso
+SMTP_ACQUIRE_TIMEOUT = 60  # Attesa massima di una connessione libera quando il pool è pieno
+
+SESSION_SAFE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class StaleSMTPSession(Exception):
+    """
+    Sessione chiusa dal server prima del DATA: il messaggio non è stato trasmesso, l'invio si può ritentare.
+    """
+
+
+class DataTrackingMixin:
+    """
+    Segna l'inizio del DATA: dopo, un errore di rete non dice se il server ha accettato il messaggio.
+    """
+    data_started = False
+
+    def data(self, msg):
+        self.data_started = True
+        return super().data(msg)
+
+
+class PooledSMTP(DataTrackingMixin, smtplib.SMTP):
+    pass
+
+
+class PooledSMTP_SSL(DataTrackingMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class PooledSMTPConnection:
+    def __init__(self, key, server):
+        self.key = key
+        self.server = server
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+
+    def is_alive(self):
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                self.server.close()
+            except OSError:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Sessioni SMTP autenticate riutilizzate tra un invio e l'altro, per account e per processo worker.
+    Limita le connessioni aperte per account, chiude quelle ferme da troppo tempo o che hanno
+    inviato troppi messaggi e si riconnette in automatico se il server chiude la sessione.
+    """
+
+    def __init__(self, max_connections=None, max_idle=None, max_messages=None):
+        self.max_connections = max_connections or getattr(settings, "SMTP_POOL_MAX_CONNECTIONS", 2)
+        self.max_idle = max_idle or getattr(settings, "SMTP_POOL_MAX_IDLE", 60)
+        self.max_messages = max_messages or getattr(settings, "SMTP_POOL_MAX_MESSAGES", 100)
+        self.idle = {}  # key -> [PooledSMTPConnection]
+        self.in_use = {}  # key -> numero di connessioni in uso
+        self.lock = Lock()
+        self.available = Condition(self.lock)
+        self.pid = os.getpid()
+
+    @staticmethod
+    def get_key(account):
+        # Credenziali o server diversi = sessioni diverse
+        return (account.pk, account.smtp_host, account.smtp_port, account.username, account.password)
+
+    @staticmethod
+    def open_connection(account):
+        if account.smtp_port == 465:
+            server = PooledSMTP_SSL(account.smtp_host, account.smtp_port, timeout=SMTP_TIMEOUT)
+        else:
+            server = PooledSMTP(account.smtp_host, account.smtp_port, timeout=SMTP_TIMEOUT)
+            server.starttls()
+        server.login(account.username, account.password)
+        return server
+
+    def _check_fork(self):
+        # Dopo un fork (prefork di Celery) le socket del processo padre non vanno riutilizzate
+        if self.pid != os.getpid():
+            self.idle = {}
+            self.in_use = {}
+            self.pid = os.getpid()
+
+    def _prune(self, key):
+        """
+        Chiude le sessioni ferme da più di `max_idle` secondi (da chiamare con il lock preso).
+        """
+        expired = []
+        alive = []
+        for connection in self.idle.get(key, []):
+            if time.monotonic() - connection.last_used > self.max_idle:
+                expired.append(connection)
+            else:
+                alive.append(connection)
+        self.idle[key] = alive
+        return expired
+
+    def acquire(self, account):
+        key = self.get_key(account)
+        deadline = time.monotonic() + SMTP_ACQUIRE_TIMEOUT
+
+        while True:
+            with self.lock:
+                self._check_fork()
+                expired = self._prune(key)
+                connection = None
+                create = False
+
+                while True:
+                    if self.idle[key]:
+                        connection = self.idle[key].pop()
+                        break
+                    if self.in_use.get(key, 0) < self.max_connections:
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No SMTP connection available for {account.email_address}")
+                    self.available.wait(remaining)
+                    expired.extend(self._prune(key))
+
+                self.in_use[key] = self.in_use.get(key, 0) + 1
+
+            for expired_connection in expired:
+                expired_connection.close()
+
+            if create:
+                try:
+                    return PooledSMTPConnection(key, self.open_connection(account))
+                except Exception:
+                    self._forget(key)
+                    raise
+
+            if time.monotonic() - connection.last_used < SMTP_NOOP_AFTER or connection.is_alive():
+                return connection
+
+            # Sessione chiusa dal server: la scartiamo e ne prendiamo un'altra
+            connection.close()
+            self._forget(key)
+
+    def _forget(self, key):
+        with self.lock:
+            self.in_use[key] = max(self.in_use.get(key, 0) - 1, 0)
+            self.available.notify()
+
+    def release(self, connection, discard=False):
+        if discard or connection.messages_sent >= self.max_messages:
+            connection.close()
+            self._forget(connection.key)
+            return
+
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            connection.last_used = time.monotonic()
+            self.in_use[connection.key] = max(self.in_use.get(connection.key, 0) - 1, 0)
+            self.idle.setdefault(connection.key, []).append(connection)
+            self.available.notify()
+
+    @contextmanager
+    def connection(self, account):
+        connection = self.acquire(account)
+        try:
+            yield connection
+        except SESSION_SAFE_ERRORS:
+            # Destinatario o mittente rifiutato: smtplib ha già fatto RSET, la sessione resta valida
+            self.release(connection)
+            raise
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        else:
+            self.release(connection)
+
+    def sendmail(self, account, from_addr, to_addrs, message):
+        """
+        Invia il messaggio su una sessione del pool. Se il server aveva già chiuso la sessione
+        (errore prima del DATA) ritenta una volta su una sessione nuova; errori durante o dopo
+        il DATA (es. timeout in attesa della risposta) non vengono ritentati, il messaggio
+        potrebbe essere già stato accettato.
+        """
+        for attempt in range(2):
+            try:
+                with self.connection(account) as connection:
+                    server = connection.server
+                    server.data_started = False
+                    try:
+                        result = server.sendmail(from_addr, to_addrs, message)
+                    except smtplib.SMTPServerDisconnected as e:
+                        if attempt or server.data_started:
+                            raise
+                        raise StaleSMTPSession(str(e)) from e
+                    connection.messages_sent += 1
+                    return result
+            except StaleSMTPSession:
+                print(f"🔌 SMTP: connection lost for {account.email_address}, reconnecting...")
+
+    def close_all(self):
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle = {}
+        for connection in connections:
+            connection.close()
+
+
+smtp_pool = SMTPConnectionPool()
+
+
+@worker_process_shutdown.connect
+def close_smtp_pool(**kwargs):
+    smtp_pool.close_all()
@@ -0,0 +1,170 @@
+import json
+import time
+from datetime import datetime, timezone
+from django.db import DataError, IntegrityError, transaction
+from django.utils.timezone import localdate
+from redis.exceptions import RedisError
+from emails.models import EmailClickTracking, EmailLog, EmailOpenTracking
+from campaigns.stats import increment_daily_stats_bulk
+from utils.redis_client import get_redis_client
+from workflows.tasks.events import on_email_clicked
+
+TRACKING_EVENTS_KEY = "tracking_events"  # Lista Redis con gli eventi di apertura/click da salvare
+TRACKING_FLUSH_BATCH_SIZE = 1000  # Eventi letti dalla lista per ogni scrittura nel database
+CLICK_LINK_MAX_LENGTH = EmailClickTracking._meta.get_field("link").max_length
+
+OPEN = "open"
+CLICK = "click"
+
+
+def push_tracking_event(event_type, lead_id, email_log_id, url=None):
+    """
+    Percorso veloce delle view di tracking: l'evento finisce in una lista Redis e viene salvato
+    da `flush_tracking_events`. Se Redis non è disponibile l'evento è salvato subito.
+    """
+    event = {"type": event_type, "lead_id": lead_id, "email_log_id": email_log_id, "url": url, "ts": time.time()}
+    client = get_redis_client()
+    if client is not None:
+        try:
+            client.rpush(TRACKING_EVENTS_KEY, json.dumps(event))
+            return
+        except RedisError as e:
+            print(f"⚠️ Tracking buffer unavailable, saving event directly: {e}")
+    save_tracking_events([event])
+
+
+def peek_tracking_events(count=TRACKING_FLUSH_BATCH_SIZE):
+    """
+    Legge fino a `count` eventi dalla testa della lista senza rimuoverli:
+    vengono tolti con `ack_tracking_events` solo dopo il salvataggio.
+    """
+    raw_events = get_redis_client().lrange(TRACKING_EVENTS_KEY, 0, count - 1)
+    return [json.loads(raw_event) for raw_event in raw_events]
+
+
+def ack_tracking_events(count):
+    """
+    Rimuove dalla testa della lista i `count` eventi già salvati
+    (un solo flusher alla volta, i nuovi eventi sono aggiunti in coda).
+    """
+    get_redis_client().ltrim(TRACKING_EVENTS_KEY, count, -1)
+
+
+def save_tracking_events(events):
+    """
+    Salva un blocco di eventi; se un dato non valido fa fallire la scrittura gli eventi
+    sono salvati uno alla volta, così una riga non valida non fa perdere tutto il blocco.
+    Gli errori di connessione al database sono rilanciati: gli eventi restano nella lista Redis.
+    Restituisce il numero di eventi salvati.
+    """
+    try:
+        return save_tracking_batch(events)
+    except (DataError, IntegrityError, KeyError, TypeError, ValueError) as e:
+        if len(events) == 1:
+            print(f"❌ Tracking event discarded {events[0]}: {e}")
+            return 0
+        print(f"⚠️ Tracking batch failed, saving {len(events)} events one by one: {e}")
+        return sum(save_tracking_events([event]) for event in events)
+
+
+def save_tracking_batch(events):
+    """
+    Salva un blocco di eventi con poche query: eventi duplicati (proxy delle immagini, scanner)
+    ridotti al primo, righe nuove con bulk_create ed esistenti con bulk_update.
+    Le scritture sono in un'unica transazione: in caso di errore non resta nulla di salvato a metà.
+    """
+    email_log_ids = {event["email_log_id"] for event in events}
+    email_logs = {
+        email_log_id: (lead_id, campaign_id)
+        for email_log_id, lead_id, campaign_id in EmailLog.objects.filter(id__in=email_log_ids).values_list("id", "lead_id", "lead__campaign_id")
+    }
+
+    opens = {}
+    clicks = {}
+    for event in sorted(events, key=lambda event: event["ts"]):
+        if email_logs.get(event["email_log_id"], (None, None))[0] != event["lead_id"]:
+            continue  # Email eliminata o dati non coerenti
+        happened_at = datetime.fromtimestamp(event["ts"], tz=timezone.utc)
+        if event["type"] == OPEN:
+            opens.setdefault((event["lead_id"], event["email_log_id"]), happened_at)
+        elif event["type"] == CLICK and event["url"]:
+            # Link oltre la lunghezza della colonna: salvato troncato invece di far fallire il blocco
+            url = event["url"][:CLICK_LINK_MAX_LENGTH]
+            clicks.setdefault((event["lead_id"], event["email_log_id"], url), happened_at)
+
+    with transaction.atomic():
+        first_opens = save_open_events(opens)
+        first_clicks = save_click_events(clicks)
+
+        # Metriche giornaliere delle campagne: solo prime aperture e primi click
+        increments = {}
+        for field, keys, happened in (("opened", first_opens, opens), ("clicked", first_clicks, clicks)):
+            for key in keys:
+                stats_key = (email_logs[key[1]][1], localdate(happened[key]))
+                counts = increments.setdefault(stats_key, {"opened": 0, "clicked": 0})
+                counts[field] += 1
+        increment_daily_stats_bulk(increments)
+
+    # Primo click sul link: il workflow del lead può reagire subito (CHECK_LINK_CLICKED)
+    for lead_id, email_log_id, url in first_clicks:
+        on_email_clicked.delay(lead_id, email_log_id, url)
+
+    return len(opens) + len(clicks)
+
+
+def save_open_events(opens):
+    """
+    Registra le aperture {(lead_id, email_log_id): data}; restituisce le chiavi delle prime aperture.
+    """
+    if not opens:
+        return []
+
+    new_opens = dict(opens)
+    existing = EmailOpenTracking.objects.filter(email_log_id__in={email_log_id for _, email_log_id in opens})
+    to_update = []
+    for tracking in existing:
+        opened_at = new_opens.pop((tracking.lead_id, tracking.email_log_id), None)
+        if opened_at and not tracking.opened:
+            tracking.opened = True
+            tracking.opened_at = opened_at
+            to_update.append(tracking)
+
+    EmailOpenTracking.objects.bulk_update(to_update, ["opened", "opened_at"])
+    EmailOpenTracking.objects.bulk_create(
+        [
+            EmailOpenTracking(lead_id=lead_id, email_log_id=email_log_id, opened=True, opened_at=opened_at)
+            for (lead_id, email_log_id), opened_at in new_opens.items()
+        ],
+        ignore_conflicts=True,  # unique (lead, email_log)
+    )
+
+    return list(new_opens) + [(tracking.lead_id, tracking.email_log_id) for tracking in to_update]
+
+
+def save_click_events(clicks):
+    """
+    Registra i click {(lead_id, email_log_id, url): data}; restituisce le chiavi dei primi click.
+    """
+    if not clicks:
+        return []
+
+    new_clicks = dict(clicks)
+    existing = EmailClickTracking.objects.filter(email_log_id__in={email_log_id for _, email_log_id, _ in clicks})
+    to_update = []
+    for tracking in existing:
+        clicked_at = new_clicks.pop((tracking.lead_id, tracking.email_log_id, tracking.link), None)
+        if clicked_at and not tracking.clicked:
+            tracking.clicked = True
+            tracking.clicked_at = clicked_at
+            to_update.append(tracking)
+
+    EmailClickTracking.objects.bulk_update(to_update, ["clicked", "clicked_at"])
+    EmailClickTracking.objects.bulk_create(
+        [
+            EmailClickTracking(lead_id=lead_id, email_log_id=email_log_id, link=url, clicked=True, clicked_at=clicked_at)
+            for (lead_id, email_log_id, url), clicked_at in new_clicks.items()
+        ],
+        ignore_conflicts=True,  # unique (lead, email_log, link): click salvato in contemporanea dal percorso sincrono
+    )
+
+    return list(new_clicks) + [(tracking.lead_id, tracking.email_log_id, tracking.link) for tracking in to_update]
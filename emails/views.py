@@ -15,9 +15,10 @@ from rest_framework.views import APIView
 
 from connected_accounts.models import ConnectedAccount, Provider
 from leads.models import Lead
-from .models import EmailClickTracking, EmailLog, EmailOpenTracking, EmailReplyTracking, EmailStatus
+from .models import EmailLog, EmailReplyTracking, EmailStatus
 from .serializers import EmailLogSerializer, EmailReplyTrackingSerializer
 from .email_sender import send_email_gmail, send_email_outlook, send_email_smtp
+from emails.utils.tracking_events import CLICK, OPEN, push_tracking_event
 
 class EmailLogViewSet(viewsets.ModelViewSet):
     queryset = EmailLog.objects.all()
@@ -31,6 +32,8 @@ class EmailLogViewSet(viewsets.ModelViewSet):
         user = self.request.user
         return EmailLog.objects.filter(lead__campaign__user=user)
 
+TRACKING_PIXEL_GIF = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw==")  # pixel 1x1 GIF trasparente
+
 @csrf_exempt
 def track_email_click(request, signed_data):
     try:
@@ -38,27 +41,11 @@ def track_email_click(request, signed_data):
         lead_id = data["lead_id"]
         email_log_id = data["email_log_id"]
         target_url = data["url"]
-    except signing.BadSignature:
+    except (signing.BadSignature, KeyError):
         raise Http404("Invalid or tampered tracking link.")
 
-    try:
-        lead = Lead.objects.get(id=lead_id)
-        email_log = EmailLog.objects.get(id=email_log_id)
-    except (Lead.DoesNotExist, EmailLog.DoesNotExist):
-        raise Http404("Invalid tracking data")
-
-    # Evita registrazioni duplicate
-    tracking, created = EmailClickTracking.objects.get_or_create(
-        lead=lead,
-        email_log=email_log,
-        link=target_url,
-        defaults={"clicked": True, "clicked_at": now()}
-    )
-
-    if not created and not tracking.clicked:
-        tracking.clicked = True
-        tracking.clicked_at = now()
-        tracking.save()
+    # Nessuna query: il click viene salvato da `flush_tracking_events` (e il workflow avvisato al primo click)
+    push_tracking_event(CLICK, lead_id, email_log_id, target_url)
 
     return HttpResponseRedirect(target_url)
 
@@ -68,31 +55,14 @@ def track_email_open(request, signed_data):
         data = signing.loads(signed_data)
         email_log_id = data["email_log_id"]
         lead_id = data["lead_id"]
-    except signing.BadSignature:
+    except (signing.BadSignature, KeyError):
         raise Http404("Invalid or tampered tracking link.")
 
-    try:
-        email_log = EmailLog.objects.get(id=email_log_id)
-        lead = Lead.objects.get(id=lead_id)
-    except (EmailLog.DoesNotExist, Lead.DoesNotExist):
-        raise Http404("Invalid data.")
-
-    tracking, created = EmailOpenTracking.objects.get_or_create(
-        email_log=email_log,
-        lead=lead,
-        defaults={"opened": True, "opened_at": now()}
-    )
-
-    if not created and not tracking.opened:
-        tracking.opened = True
-        tracking.opened_at = now()
-        tracking.save()
-
-    # pixel 1x1 GIF trasparente
-    pixel_gif = base64.b64decode(
-        "R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=="
-    )
-    return HttpResponse(pixel_gif, content_type="image/gif")
+    push_tracking_event(OPEN, lead_id, email_log_id)
+
+    response = HttpResponse(TRACKING_PIXEL_GIF, content_type="image/gif")
+    response["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+    return response
 
 class StandardPagination(PageNumberPagination):
     page_size = 10
@@ -155,6 +155,9 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATIC_URL = 'static/'
 
+# File caricati (es. CSV dei lead in attesa di import): web e worker Celery devono condividere lo storage
+MEDIA_ROOT = env.str("MEDIA_ROOT", os.path.join(BASE_DIR, 'media'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -222,6 +225,60 @@ CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 
+# Cache condivisa tra web e worker (piani dei workflow, progress degli upload, lock)
+REDIS_URL = env.str("REDIS_URL", CELERY_BROKER_URL)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
+# Rate limiter degli invii per account ("redis" condiviso tra i worker, "memory" solo per processo)
+SEND_RATE_LIMITER_BACKEND = env.str("SEND_RATE_LIMITER_BACKEND", "redis")
+
+# Pool delle sessioni SMTP per account (per processo worker)
+SMTP_POOL_MAX_CONNECTIONS = env.int("SMTP_POOL_MAX_CONNECTIONS", 2)
+SMTP_POOL_MAX_IDLE = env.int("SMTP_POOL_MAX_IDLE", 60)  # Secondi
+SMTP_POOL_MAX_MESSAGES = env.int("SMTP_POOL_MAX_MESSAGES", 100)  # Messaggi per sessione prima di riconnettersi
+
+# Invio delle email dei workflow:
+# "direct" = inviate dallo step, "batch" = in coda e spedite in batch da `send_queued_emails`,
+# "async" = in coda e spedite dal worker asyncio (`python manage.py run_send_worker`)
+EMAIL_SEND_MODE = env.str("EMAIL_SEND_MODE", "direct")
+
+# Risposte degli account IMAP in tempo reale tramite sessioni IDLE (`python manage.py run_imap_idle`):
+# se attivo, `check_email_replies` non interroga più questi account
+IMAP_IDLE_ENABLED = env.bool("IMAP_IDLE_ENABLED", False)
+
+# Task periodici (sincronizzati nel DatabaseScheduler di django_celery_beat)
+CELERY_BEAT_SCHEDULE = {
+    'resume-waiting-leads': {
+        'task': 'workflows.tasks.scheduler.resume_waiting_leads',
+        'schedule': 60.0,
+    },
+    'reset-stuck-queue': {
+        'task': 'workflows.tasks.scheduler.reset_stuck_queue',
+        'schedule': 120.0,
+    },
+    'send-queued-emails': {
+        'task': 'emails.tasks.send_queued_emails',
+        'schedule': 10.0,
+    },
+    'flush-tracking-events': {
+        'task': 'emails.tasks.flush_tracking_events',
+        'schedule': 5.0,
+    },
+    'reconcile-campaign-counters': {
+        'task': 'campaigns.tasks.reconcile_campaign_counters',
+        'schedule': 3600.0,
+    },
+    'cleanup-csv-error-reports': {
+        'task': 'leads.tasks.cleanup_csv_error_reports',
+        'schedule': 3600.0,
+    },
+}
+
 
 OAUTH2_PROVIDERS = {
     'gmail': {
@@ -0,0 +1,110 @@
+# Generated by Django 4.2 on 2025-04-18 16:05
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def normalize_email(email):
+    # Copia di leads.utils.normalize_email al momento della migrazione: le migrazioni non importano il codice dell'app
+    email = (email or '').strip()
+    if email.lower().startswith('mailto:'):
+        email = email[len('mailto:'):]
+    return email.strip('<> ').lower()
+
+
+def count_per_lead(model):
+    counts = model.objects.filter(lead_id=models.OuterRef('pk')).order_by().values('lead_id').annotate(count=models.Count('id')).values('count')
+    return Coalesce(models.Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+def move_to_kept_lead(model, duplicate_ids, kept_id, key_fields):
+    """
+    Sposta sul lead tenuto le righe dei duplicati; quelle con la stessa chiave di una riga già presente
+    (vincolo unico con il lead) vengono eliminate. Un DELETE e un UPDATE in blocco.
+    """
+    kept_keys = set(model.objects.filter(lead_id=kept_id).values_list(*key_fields))
+    moved_ids = []
+    dropped_ids = []
+    for row_id, *key in model.objects.filter(lead_id__in=duplicate_ids).order_by('id').values_list('id', *key_fields):
+        key = tuple(key)
+        if key in kept_keys:
+            dropped_ids.append(row_id)
+        else:
+            kept_keys.add(key)
+            moved_ids.append(row_id)
+    model.objects.filter(id__in=dropped_ids).delete()
+    model.objects.filter(id__in=moved_ids).update(lead_id=kept_id)
+
+
+def normalize_emails(Lead):
+    batch = []
+    for lead in Lead.objects.only('id', 'email').iterator(chunk_size=2000):
+        email = normalize_email(lead.email)
+        if email != lead.email:
+            lead.email = email
+            batch.append(lead)
+        if len(batch) >= 2000:
+            Lead.objects.bulk_update(batch, ['email'])
+            batch = []
+    if batch:
+        Lead.objects.bulk_update(batch, ['email'])
+
+
+def merge_duplicate_leads(apps, schema_editor):
+    Lead = apps.get_model('leads', 'Lead')
+    EmailLog = apps.get_model('emails', 'EmailLog')
+    EmailOpenTracking = apps.get_model('emails', 'EmailOpenTracking')
+    EmailClickTracking = apps.get_model('emails', 'EmailClickTracking')
+    EmailReplyTracking = apps.get_model('emails', 'EmailReplyTracking')
+    LeadStepStatus = apps.get_model('workflows', 'LeadStepStatus')
+    WorkflowQueue = apps.get_model('workflows', 'WorkflowQueue')
+
+    normalize_emails(Lead)
+
+    duplicates = (
+        Lead.objects
+        .values('campaign_id', 'email')
+        .annotate(count=models.Count('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        # Resta il lead con più attività (email e stati del workflow), a parità il primo creato
+        leads = list(
+            Lead.objects
+            .filter(campaign_id=duplicate['campaign_id'], email=duplicate['email'])
+            .annotate(activity=count_per_lead(EmailLog) + count_per_lead(LeadStepStatus))
+            .order_by('-activity', 'id')
+        )
+        kept = leads[0]
+        duplicate_ids = [lead.id for lead in leads[1:]]
+
+        # Email e tracking seguono il lead: i vincoli unici includono l'EmailLog, non possono collidere
+        for model in (EmailLog, EmailOpenTracking, EmailClickTracking, EmailReplyTracking):
+            model.objects.filter(lead_id__in=duplicate_ids).update(lead_id=kept.id)
+
+        # Stati del workflow e coda: vale quello del lead tenuto, gli altri vengono spostati
+        move_to_kept_lead(LeadStepStatus, duplicate_ids, kept.id, ('workflow_id', 'step_id'))
+        move_to_kept_lead(WorkflowQueue, duplicate_ids, kept.id, ('workflow_execution_id',))
+
+        # Disiscrizione di uno qualsiasi dei duplicati: vale per il lead tenuto
+        if any(lead.unsubscribed for lead in leads) and not kept.unsubscribed:
+            Lead.objects.filter(id=kept.id).update(unsubscribed=True)
+
+        Lead.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leads', '0009_remove_lead_name_lead_first_name_lead_last_name_and_more'),
+        ('emails', '0010_emaillog_claimed_at'),
+        ('workflows', '0007_workflowqueue_lease'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_leads, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='lead',
+            constraint=models.UniqueConstraint(fields=('campaign', 'email'), name='unique_lead_campaign_email'),
+        ),
+    ]
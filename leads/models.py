@@ -1,5 +1,6 @@
 from django.db import models
 from campaigns.models import Campaign
+from leads.utils import normalize_email
 
 
 class LeadStatus(models.TextChoices):
@@ -30,6 +31,16 @@ class Lead(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     workflow_status = models.CharField(max_length=50, choices=LeadWorkflowExecutionStatus.choices, default=LeadWorkflowExecutionStatus.PENDING)
 
+    class Meta:
+        constraints = [
+            # Email sempre salvata normalizzata (minuscola): un lead per indirizzo in ogni campagna
+            models.UniqueConstraint(fields=["campaign", "email"], name="unique_lead_campaign_email"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.email = normalize_email(self.email)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.first_name} {self.last_name} - {self.email}"
 
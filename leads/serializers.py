@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Lead
+from .utils import normalize_email
 from campaigns.models import Campaign
 
 
@@ -12,4 +13,8 @@ class LeadSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'campaign', 'first_name', 'last_name', 'email', 'phone', 'company', 'website', 'status', 'status_display', 'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
\ No newline at end of file
+        read_only_fields = ['id', 'created_at', 'updated_at']
+
+    def validate_email(self, value):
+        # Normalizzata prima del controllo di unicità (campagna, email)
+        return normalize_email(value)
\ No newline at end of file
@@ -1,5 +1,7 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils.timezone import localdate
+from campaigns.stats import increment_daily_stats
 from workflows.models import Workflow, WorkflowExecution, WorkflowSettings, WorkflowStatus
 from workflows.tasks.worker import execute_workflow
 from .models import Lead, LeadStatus
@@ -11,11 +13,13 @@ def process_new_lead(sender, instance, created, **kwargs):
     Signal per gestire i nuovi lead con status='new'.
     Recupera la campagna ID e le impostazioni di workflow associate.
     """
+    if created:
+        increment_daily_stats(instance.campaign_id, localdate(instance.created_at), leads=1)
+
     if created and instance.status == LeadStatus.NEW:
-        print(f"👉 Nuovo lead aggiunto: {instance.name} ({instance.email})")
         # Ottenere l'ID della campagna
-        campaign_id = instance.campaign.id
-        print(f"Nuovo lead aggiunto: {instance.name} ({instance.email}), Campagna ID: {campaign_id}")
+        campaign_id = instance.campaign_id
+        print(f"👉 Nuovo lead aggiunto: {instance}, Campagna ID: {campaign_id}")
 
         # Trovare il workflow attivo associato alla campagna (se esiste)
         workflow = Workflow.objects.filter(campaign_id=campaign_id, status=WorkflowStatus.PUBLISHED).first()
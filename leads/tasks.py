@@ -1,56 +1,214 @@
 import csv
 import io
+import tempfile
+from itertools import islice
 from celery import shared_task
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.validators import URLValidator, validate_email
+from django.db import transaction
+from django.utils.timezone import now, timedelta
 from .models import Lead, LeadStatus
+from .utils import normalize_email
 from campaigns.models import Campaign
+from campaigns.stats import increment_daily_stats
+
+CSV_UPLOAD_DIR = "csv_imports"  # Cartella dello storage con i CSV in attesa di import
+CSV_ERRORS_DIR = f"{CSV_UPLOAD_DIR}/errors"  # Report delle righe scartate, scaricabili da `upload-errors`
+CSV_BATCH_SIZE = 500  # Lead salvati per ogni bulk_create
+CSV_PROGRESS_TIMEOUT = 600
+CSV_ERRORS_TIMEOUT = 60 * 60 * 24  # Il report delle righe scartate resta scaricabile per un giorno
+LEAD_CSV_FIELDS = ("first_name", "last_name", "phone", "company", "website")  # Colonne del CSV oltre a "email"
+
+validate_url = URLValidator()
+
+
+def get_csv_progress_key(task_id):
+    return f"csv_progress_{task_id}"
+
+
+def get_csv_errors_key(task_id):
+    return f"csv_errors_{task_id}"
+
+
+def open_csv_reader(file):
+    """
+    Lettore CSV in streaming sul file binario (BOM di Excel incluso).
+    """
+    return csv.DictReader(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+
+
+def iter_batches(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def get_update_fields(fieldnames):
+    """
+    Campi aggiornati sui lead già presenti: solo le colonne presenti nel CSV, per non cancellare i dati esistenti.
+    """
+    columns = set(fieldnames or [])
+    if "name" in columns:
+        columns |= {"first_name", "last_name"}
+    return [field for field in LEAD_CSV_FIELDS if field in columns]
+
+
+def parse_lead_row(row):
+    """
+    Dati del lead dalla riga del CSV: (dati, None) se la riga è valida, altrimenti (None, errore).
+    """
+    email = normalize_email(row.get("email"))
+    if not email:
+        return None, "Missing email"
+    try:
+        validate_email(email)
+    except ValidationError:
+        return None, "Invalid email"
+
+    data = {"email": email}
+    for field in LEAD_CSV_FIELDS:
+        data[field] = (row.get(field) or "").strip() or None
+
+    # Vecchi CSV con la sola colonna "name"
+    if row.get("name") and not (data["first_name"] or data["last_name"]):
+        first_name, _, last_name = row["name"].strip().partition(" ")
+        data["first_name"], data["last_name"] = first_name or None, last_name.strip() or None
+
+    for field in LEAD_CSV_FIELDS:
+        max_length = Lead._meta.get_field(field).max_length
+        if data[field] and len(data[field]) > max_length:
+            return None, f"{field} longer than {max_length} characters"
+
+    if data["website"]:
+        try:
+            validate_url(data["website"])
+        except ValidationError:
+            return None, "Invalid website"
+
+    return data, None
+
+
+def upsert_leads(campaign, leads_data, update_fields):
+    """
+    Inserisce i lead nuovi e aggiorna quelli già presenti nella campagna con un solo INSERT ... ON CONFLICT
+    sull'indice unico (campagna, email). Restituisce (creati, aggiornati).
+    Lettura dei lead esistenti e upsert avvengono nella stessa transazione, con il lock sulla campagna:
+    due import concorrenti nella stessa campagna non possono contare due volte lo stesso lead come nuovo.
+    """
+    leads = [Lead(campaign=campaign, **data) for data in leads_data.values()]
+
+    with transaction.atomic():
+        list(Campaign.objects.select_for_update().filter(pk=campaign.pk).values_list("pk", flat=True))
+        existing = Lead.objects.filter(campaign=campaign, email__in=leads_data).count()
+
+        if update_fields:
+            Lead.objects.bulk_create(
+                leads,
+                update_conflicts=True,
+                unique_fields=["campaign", "email"],
+                update_fields=[*update_fields, "updated_at"],
+            )
+        else:
+            Lead.objects.bulk_create(leads, ignore_conflicts=True)
+
+    return len(leads) - existing, existing
+
 
 @shared_task(bind=True)
-def process_csv_leads(self, file_data, campaign_id, user_id):
+def process_csv_leads(self, file_path, campaign_id, user_id):
     """
     Task Celery per elaborare il CSV e salvare i lead in modo asincrono.
+    Il file è letto in streaming dallo storage (`file_path`) a blocchi di CSV_BATCH_SIZE righe:
+    la memoria usata non dipende dalla dimensione del file. L'avanzamento è calcolato sui byte letti.
+    Le email sono normalizzate e validate, i lead già presenti nella campagna aggiornati (upsert);
+    le righe scartate finiscono in un report CSV scaricabile da `upload-errors`.
     """
-    from django.contrib.auth import get_user_model
-    User = get_user_model()
+    progress_key = get_csv_progress_key(self.request.id)
+    created_count = 0
+    updated_count = 0
+    error_count = 0
+    errors_path = None
+
+    try:
+        try:
+            campaign = Campaign.objects.get(id=campaign_id, user_id=user_id)
+        except Campaign.DoesNotExist:
+            return {"error": "Campaign not found or unauthorized."}
+
+        total_bytes = default_storage.size(file_path) or 1
 
+        with default_storage.open(file_path, "rb") as file, tempfile.TemporaryFile("w+", newline="", encoding="utf-8") as error_file:
+            reader = open_csv_reader(file)
+            update_fields = get_update_fields(reader.fieldnames)
+            error_writer = csv.writer(error_file)
+            error_writer.writerow(["line", "email", "error"])
+
+            for rows in iter_batches(((reader.line_num, row) for row in reader), CSV_BATCH_SIZE):
+                # Email ripetute nello stesso blocco: vale l'ultima riga (ON CONFLICT non può aggiornare due volte la stessa riga)
+                leads_data = {}
+                lines = {}
+                for line, row in rows:
+                    data, error = parse_lead_row(row)
+                    if error:
+                        error_writer.writerow([line, row.get("email") or "", error])
+                        error_count += 1
+                        continue
+                    email = data["email"]
+                    if email in leads_data:
+                        error_writer.writerow([lines[email], email, f"Duplicate email, replaced by line {line}"])
+                        error_count += 1
+                    leads_data[email] = data
+                    lines[email] = line
+
+                if leads_data:
+                    created, updated = upsert_leads(campaign, leads_data, update_fields)
+                    created_count += created
+                    updated_count += updated
+
+                # Percentuale sui byte letti (il lettore CSV legge in anticipo al massimo qualche KB)
+                cache.set(progress_key, min(99, int(file.tell() * 100 / total_bytes)), timeout=CSV_PROGRESS_TIMEOUT)
+
+            if error_count:
+                error_file.seek(0)
+                errors_path = default_storage.save(f"{CSV_ERRORS_DIR}/{self.request.id}.csv", File(error_file))
+                cache.set(get_csv_errors_key(self.request.id), {"path": errors_path, "user_id": user_id}, timeout=CSV_ERRORS_TIMEOUT)
+
+        # bulk_create non invia i post_save: metriche giornaliere aggiornate qui, solo con i lead nuovi
+        increment_daily_stats(campaign.id, leads=created_count)
+    finally:
+        cache.set(progress_key, 100, timeout=CSV_PROGRESS_TIMEOUT)
+        default_storage.delete(file_path)
+
+    return {
+        "status": "completed",
+        "created": created_count,
+        "updated": updated_count,
+        "errors": error_count,
+        "errors_path": errors_path,
+    }
+
+
+@shared_task
+def cleanup_csv_error_reports():
+    """
+    Task periodico: elimina dallo storage i report delle righe scartate più vecchi di CSV_ERRORS_TIMEOUT,
+    quando il riferimento in cache è scaduto e non sono più scaricabili.
+    """
     try:
-        campaign = Campaign.objects.get(id=campaign_id, user_id=user_id)
-    except Campaign.DoesNotExist:
-        return {"error": "Campaign not found or unauthorized."}
-
-    csv_reader = csv.DictReader(io.StringIO(file_data))
-    total_rows = sum(1 for row in csv_reader)  # Conta il numero di righe
-    csv_reader = csv.DictReader(io.StringIO(file_data))  # Rilegge dall'inizio
-
-    leads = []
-    errors = []
-    processed_count = 0
-
-    for row in csv_reader:
-        # status_value = row.get('status', LeadStatus.NEW).strip().lower()
-        # if status_value not in dict(LeadStatus.choices):
-        #     errors.append(f"Invalid status '{status_value}' for lead {row.get('email')}")
-        #     continue
-
-        lead = Lead(
-            campaign=campaign,
-            name=row.get('name', '').strip(),
-            email=row.get('email', '').strip(),
-            phone=row.get('phone', '').strip() if 'phone' in row else None,
-            company=row.get('company', '').strip() if 'company' in row else None,
-        )
-        leads.append(lead)
-        processed_count += 1
-
-        # Aggiorna la cache con la percentuale di avanzamento
-        cache.set(f"csv_progress_{self.request.id}", int((processed_count / total_rows) * 100), timeout=600)
-
-        # Salvataggio ogni 500 leads per evitare memory overflow
-        if processed_count % 500 == 0:
-            Lead.objects.bulk_create(leads)
-            leads = []
-
-    if leads:
-        Lead.objects.bulk_create(leads)
-
-    return {"status": "completed", "processed": processed_count, "errors": errors}
+        _, file_names = default_storage.listdir(CSV_ERRORS_DIR)
+    except FileNotFoundError:
+        return
+
+    expired_before = now() - timedelta(seconds=CSV_ERRORS_TIMEOUT)
+    deleted = 0
+    for file_name in file_names:
+        file_path = f"{CSV_ERRORS_DIR}/{file_name}"
+        if default_storage.get_modified_time(file_path) < expired_before:
+            default_storage.delete(file_path)
+            deleted += 1
+
+    if deleted:
+        print(f"🧹 Deleted {deleted} expired CSV error reports")
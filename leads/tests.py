@@ -1,3 +1,125 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from unittest import mock
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.utils.timezone import now, timedelta
+from campaigns.models import Campaign
+from users.models import User
+from .models import Lead
+from . import tasks
+from .tasks import CSV_BATCH_SIZE, CSV_ERRORS_DIR, CSV_ERRORS_TIMEOUT, CSV_UPLOAD_DIR, cleanup_csv_error_reports, process_csv_leads
 
-# Create your tests here.
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class StorageTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, CACHES=LOCMEM_CACHES)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class CsvImportTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(email="owner@example.com", password="password123")
+        self.campaign = Campaign.objects.create(user=self.user, name="Campaign")
+
+    def import_csv(self, content, encoding="utf-8", task_id=None):
+        file_path = default_storage.save(f"{CSV_UPLOAD_DIR}/leads.csv", ContentFile(content.encode(encoding)))
+        return process_csv_leads.apply(args=[file_path, self.campaign.id, self.user.id], task_id=task_id).get()
+
+    def test_import_normalizes_dedupes_and_reports_invalid_rows(self):
+        result = self.import_csv(
+            "name,email,company\n"
+            "Mario Rossi,Mario@Example.com,Acme\n"
+            "Luigi Verdi,not-an-email,Acme\n"
+            "Mario R.,mailto:mario@example.com,Acme Srl\n"
+        )
+
+        self.assertEqual((result["created"], result["updated"], result["errors"]), (1, 0, 2))
+        lead = Lead.objects.get(campaign=self.campaign)
+        self.assertEqual((lead.email, lead.first_name, lead.last_name, lead.company), ("mario@example.com", "Mario", "R.", "Acme Srl"))
+
+        report = default_storage.open(result["errors_path"]).read().decode()
+        self.assertIn("not-an-email,Invalid email", report)
+        self.assertIn("Duplicate email", report)
+
+    def test_reimport_updates_only_columns_in_the_file(self):
+        Lead.objects.create(campaign=self.campaign, email="mario@example.com", first_name="Mario", phone="123")
+
+        result = self.import_csv("email,company\nMARIO@example.com,Acme\nluigi@example.com,Acme\n")
+
+        self.assertEqual((result["created"], result["updated"], result["errors"]), (1, 1, 0))
+        lead = Lead.objects.get(email="mario@example.com")
+        self.assertEqual((lead.first_name, lead.phone, lead.company), ("Mario", "123", "Acme"))
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.leads_total, 2)
+
+    def test_excel_bom_is_stripped_from_the_header(self):
+        result = self.import_csv("email,first_name\nmario@example.com,Mario\n", encoding="utf-8-sig")
+
+        self.assertEqual((result["created"], result["errors"]), (1, 0))
+        self.assertEqual(Lead.objects.get(campaign=self.campaign).first_name, "Mario")
+
+    def test_duplicates_in_different_batches_keep_the_last_row(self):
+        rows = [f"lead{i}@example.com,Lead" for i in range(CSV_BATCH_SIZE - 1)]
+        rows += ["dup@example.com,First", "DUP@example.com,Last"]  # Ultima riga del primo blocco, prima del secondo
+
+        result = self.import_csv("email,first_name\n" + "\n".join(rows) + "\n")
+
+        self.assertEqual((result["created"], result["updated"], result["errors"]), (CSV_BATCH_SIZE, 1, 0))
+        self.assertEqual(Lead.objects.get(campaign=self.campaign, email="dup@example.com").first_name, "Last")
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.leads_total, CSV_BATCH_SIZE)
+
+    def test_invalid_rows_are_written_to_the_error_report(self):
+        result = self.import_csv(
+            "email,first_name,website\n"
+            ",Nobody,\n"
+            "valid@example.com,Valid,https://example.com\n"
+            "site@example.com,Site,not a url\n"
+            f"long@example.com,{'x' * 300},\n",
+            task_id="import-task",
+        )
+
+        self.assertEqual((result["created"], result["errors"]), (1, 3))
+        report = default_storage.open(result["errors_path"]).read().decode().splitlines()
+        self.assertEqual(report[:3], ["line,email,error", "2,,Missing email", "4,site@example.com,Invalid website"])
+        self.assertTrue(report[3].startswith("5,long@example.com,first_name longer than"))
+        self.assertEqual(cache.get(tasks.get_csv_errors_key("import-task")), {"path": result["errors_path"], "user_id": self.user.id})
+
+    def test_progress_is_based_on_the_bytes_read(self):
+        content = "email,company\n" + "".join(f"lead{i}@example.com,{'Company ' * 5}\n" for i in range(CSV_BATCH_SIZE * 4))
+
+        with mock.patch.object(tasks.cache, "set", wraps=tasks.cache.set) as cache_set:
+            self.import_csv(content, task_id="import-task")
+
+        progress_key = tasks.get_csv_progress_key("import-task")
+        progress = [call.args[1] for call in cache_set.call_args_list if call.args[0] == progress_key]
+        self.assertEqual(len(progress), 5)  # Un aggiornamento per blocco, poi il 100% finale
+        self.assertEqual(progress, sorted(progress))
+        self.assertLess(progress[0], 50)
+        self.assertEqual(progress[-2:], [99, 100])
+
+
+class CsvErrorReportCleanupTests(StorageTestCase):
+    def test_expired_reports_are_deleted(self):
+        expired = default_storage.save(f"{CSV_ERRORS_DIR}/expired.csv", ContentFile(b"line,email,error\n"))
+        recent = default_storage.save(f"{CSV_ERRORS_DIR}/recent.csv", ContentFile(b"line,email,error\n"))
+        expired_at = (now() - timedelta(seconds=CSV_ERRORS_TIMEOUT + 60)).timestamp()
+        os.utime(default_storage.path(expired), (expired_at, expired_at))
+
+        cleanup_csv_error_reports()
+
+        self.assertFalse(default_storage.exists(expired))
+        self.assertTrue(default_storage.exists(recent))
+
+    def test_missing_directory_is_ignored(self):
+        cleanup_csv_error_reports()
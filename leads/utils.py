@@ -0,0 +1,8 @@
+def normalize_email(email):
+    """
+    Forma canonica dell'indirizzo usata per salvare e confrontare i lead: senza spazi, "mailto:" e <>, minuscola.
+    """
+    email = (email or "").strip()
+    if email.lower().startswith("mailto:"):
+        email = email[len("mailto:"):]
+    return email.strip("<> ").lower()
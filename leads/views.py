@@ -1,4 +1,7 @@
+import uuid
+from django.http import FileResponse
 from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.db.models import Count
 from django.utils.timezone import now, timedelta
 from django.utils.http import urlsafe_base64_decode
@@ -11,11 +14,12 @@ from rest_framework.decorators import action
 from django_filters.rest_framework import DjangoFilterBackend
 from .models import Lead, LeadStatus
 from .serializers import LeadSerializer
-from campaigns.models import Campaign
+from campaigns.models import Campaign, CampaignDailyStats
+from campaigns.stats import increment_campaign_counters
 from campaigns.pagination import CustomPageNumberPagination
 from rest_framework.filters import SearchFilter, OrderingFilter
 from emails.models import EmailLog, EmailReplyTracking, EmailOpenTracking, EmailStatus
-from .tasks import process_csv_leads
+from .tasks import CSV_UPLOAD_DIR, get_csv_errors_key, get_csv_progress_key, process_csv_leads
 
 
 class LeadViewSet(viewsets.ModelViewSet):
@@ -80,6 +84,8 @@ class LeadViewSet(viewsets.ModelViewSet):
         except Lead.DoesNotExist:
             return Response({'error': 'Lead not found.'}, status=status.HTTP_404_NOT_FOUND)
 
+        if not lead.unsubscribed:
+            increment_campaign_counters(lead.campaign_id, unsubscribed=1)
         lead.unsubscribed = True
         lead.save()
 
@@ -141,24 +147,20 @@ class LeadViewSet(viewsets.ModelViewSet):
             # return Response({'error': "Campaign not found or not authorized."}, status=status.HTTP_403_FORBIDDEN)
             raise serializers.ValidationError({'error': "Campaign not found or not authorized."}, code=status.HTTP_403_FORBIDDEN)
 
-        # Aggregazione dati
-        total_leads = Lead.objects.filter(campaign=campaign).count()
-        contacted_leads = Lead.objects.filter(campaign=campaign, status=LeadStatus.CONTACTED).count()
-
-        opened_emails = EmailOpenTracking.objects.filter(lead__campaign=campaign, opened=True).count()
-        replied_emails = EmailReplyTracking.objects.filter(lead__campaign=campaign).count()
-
+        # Contatori denormalizzati della campagna (nessuna aggregazione sugli eventi)
         return Response({
-            "leads": total_leads,
-            "contacted": contacted_leads,
-            "opened": opened_emails,
-            "replied": replied_emails
+            "leads": campaign.leads_total,
+            "contacted": campaign.contacted,
+            "opened": campaign.opened,
+            "replied": campaign.replied
         })
 
     @action(detail=False, methods=['get'], url_path='campaign-analytics')
     def campaign_analytics(self, request):
         """
         Returns analytics data for a campaign, ensuring all days in the requested period are included.
+        Per day: leads contacted for the first time, first opens and replies received
+        (`contacted` no longer counts leads created that day that are still in the contacted status).
         """
         campaign_id = request.query_params.get('campaign_id')
         period = request.query_params.get('period', '90')  # Default: Last 3 months
@@ -183,31 +185,15 @@ class LeadViewSet(viewsets.ModelViewSet):
         # Creiamo un dizionario con tutte le date inizializzate a zero
         analytics_data = {date: {"date": date, "contacted": 0, "opened": 0, "replied": 0} for date in date_range}
 
-        # Aggrega i dati per giorno
-        contacted = Lead.objects.filter(campaign=campaign, status=LeadStatus.CONTACTED, created_at__date__gte=start_date) \
-            .values('created_at__date') \
-            .annotate(count=Count('id'))
-        
-        opened = EmailOpenTracking.objects.filter(lead__campaign=campaign, opened_at__date__gte=start_date) \
-            .values('opened_at__date') \
-            .annotate(count=Count('id'))
-        
-        replied = EmailReplyTracking.objects.filter(lead__campaign=campaign, received_at__date__gte=start_date) \
-            .values('received_at__date') \
-            .annotate(count=Count('id'))
+        # Metriche giornaliere già aggregate (una riga per giorno)
+        daily_stats = CampaignDailyStats.objects.filter(campaign=campaign, date__gte=start_date) \
+            .values('date', 'contacted', 'opened', 'replied')
 
         # Inseriamo i valori nei dati già inizializzati
-        for entry in contacted:
-            date_str = entry['created_at__date'].isoformat()
-            analytics_data[date_str]['contacted'] = entry['count']
-        
-        for entry in opened:
-            date_str = entry['opened_at__date'].isoformat()
-            analytics_data[date_str]['opened'] = entry['count']
-        
-        for entry in replied:
-            date_str = entry['received_at__date'].isoformat()
-            analytics_data[date_str]['replied'] = entry['count']
+        for entry in daily_stats:
+            date_str = entry['date'].isoformat()
+            if date_str in analytics_data:
+                analytics_data[date_str].update(contacted=entry['contacted'], opened=entry['opened'], replied=entry['replied'])
 
         # Convertiamo il dizionario in lista ordinata
         return Response(list(analytics_data.values()))    
@@ -221,11 +207,12 @@ class LeadViewSet(viewsets.ModelViewSet):
             # return Response({'error': "File or campaign_id missing."}, status=status.HTTP_400_BAD_REQUEST)
             raise serializers.ValidationError({'error': "File or campaign_id missing."}, code=status.HTTP_400_BAD_REQUEST)
 
-        # Leggi il file come stringa
-        file_data = file.read().decode('utf-8')
+        # Il file viene salvato nello storage (a blocchi, senza leggerlo tutto in memoria):
+        # al task Celery passa solo il percorso, non il contenuto
+        file_path = default_storage.save(f"{CSV_UPLOAD_DIR}/{uuid.uuid4().hex}.csv", file)
 
         # Avvia il task Celery
-        task = process_csv_leads.delay(file_data, campaign_id, request.user.id)
+        task = process_csv_leads.delay(file_path, campaign_id, request.user.id)
 
         return Response({"task_id": task.id, "message": "CSV processing started."}, status=status.HTTP_202_ACCEPTED)
 
@@ -236,5 +223,20 @@ class LeadViewSet(viewsets.ModelViewSet):
             # return Response({'error': "Task ID missing."}, status=status.HTTP_400_BAD_REQUEST)
             raise serializers.ValidationError({'error': "Task ID missing."}, code=status.HTTP_400_BAD_REQUEST)
 
-        progress = cache.get(f"csv_progress_{task_id}", 0)
-        return Response({"progress": progress})
\ No newline at end of file
+        progress = cache.get(get_csv_progress_key(task_id), 0)
+        return Response({"progress": progress})
+
+    @action(detail=False, methods=['get'], url_path='upload-errors', permission_classes=[permissions.IsAuthenticated])
+    def upload_errors(self, request):
+        """
+        Report CSV delle righe scartate da un import (riga, email, motivo).
+        """
+        task_id = request.query_params.get("task_id")
+        if not task_id:
+            raise serializers.ValidationError({'error': "Task ID missing."}, code=status.HTTP_400_BAD_REQUEST)
+
+        errors = cache.get(get_csv_errors_key(task_id))
+        if not errors or errors["user_id"] != request.user.id or not default_storage.exists(errors["path"]):
+            return Response({"error": "No error report for this import."}, status=status.HTTP_404_NOT_FOUND)
+
+        return FileResponse(default_storage.open(errors["path"], "rb"), as_attachment=True, filename=f"lead_import_errors_{task_id}.csv")
\ No newline at end of file
@@ -0,0 +1,97 @@
+import os
+from threading import Lock
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+HTTP_TIMEOUT = (5, 30)  # Secondi: (connessione, lettura)
+HTTP_POOL_SIZE = 10  # Connessioni keep-alive per host
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5  # 0.5s, 1s, 2s...
+HTTP_RETRY_AFTER_MAX = 60  # Attesa massima concessa a un Retry-After, in secondi
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = Lock()
+_sessions_pid = os.getpid()
+
+
+class ProviderRetry(Retry):
+    """
+    Retry con backoff che rispetta Retry-After, ma senza bloccare il worker oltre HTTP_RETRY_AFTER_MAX.
+    """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+
+class ProviderSession(requests.Session):
+    """
+    Session con timeout di default: nessuna chiamata verso i provider può restare appesa.
+    """
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def build_session(idempotent=True):
+    if idempotent:
+        retry = ProviderRetry(
+            total=HTTP_MAX_RETRIES,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=None,  # Anche POST (refresh dei token, letture)
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+    else:
+        # Invii e scambi di codici OAuth: si ritenta solo quando la richiesta non è arrivata
+        # al provider (errore di connessione) o è stata rifiutata esplicitamente (429)
+        retry = ProviderRetry(
+            total=HTTP_MAX_RETRIES,
+            read=0,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=(429,),
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+
+    session = ProviderSession()
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url, idempotent=True):
+    """
+    Session condivisa per host e per processo worker (connessioni TCP/TLS riutilizzate).
+    """
+    global _sessions, _sessions_pid
+
+    key = (urlsplit(url).netloc, idempotent)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Processo figlio (prefork): non riutilizziamo le socket del padre
+            _sessions = {}
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(key)
+        if session is None:
+            session = build_session(idempotent)
+            _sessions[key] = session
+    return session
+
+
+def http_get(url, idempotent=True, **kwargs):
+    return get_session(url, idempotent).get(url, **kwargs)
+
+
+def http_post(url, idempotent=True, **kwargs):
+    return get_session(url, idempotent).post(url, **kwargs)
@@ -0,0 +1,17 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+
+def get_redis_client():
+    """
+    Client Redis condiviso dal processo (connessioni in pool), None se Redis non è configurato.
+    """
+    global _client
+    if _client is None:
+        redis_url = getattr(settings, "REDIS_URL", None)
+        if not redis_url:
+            return None
+        _client = redis.Redis.from_url(redis_url)
+    return _client
@@ -0,0 +1,52 @@
+import time
+from django.conf import settings as ingegno_settings
+from django.core.management.base import BaseCommand
+from leads.models import Lead
+from workflows.utils.email_placeholders import replace_placeholders
+from workflows.utils.email_tracking import prepare_email_body
+from workflows.utils.email_template import get_email_template
+
+
+def build_benchmark_body(size, links):
+    paragraph = "<p>Ciao {first_name}, ti scrivo per conto di {company}. Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+    parts = []
+    for index in range(links):
+        parts.append(f'<p><a href="https://example.com/page/{index}?utm_source=ingegno">Link {index}</a></p>\n')
+    while sum(len(part) for part in parts) < size:
+        parts.append(paragraph)
+    parts.append('<p><a href="{unsubscribe_link}">Disiscriviti</a></p>')
+    return "".join(parts)
+
+
+class Command(BaseCommand):
+    help = "Confronta il render delle email (placeholder + link tracciati) con e senza template compilato"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--leads", type=int, default=100000)
+        parser.add_argument("--size", type=int, default=5000, help="Dimensione del body in byte")
+        parser.add_argument("--links", type=int, default=10)
+
+    def handle(self, *args, **options):
+        domain = ingegno_settings.DOMAIN
+        body = build_benchmark_body(options["size"], options["links"])
+        leads = [
+            Lead(id=index, first_name=f"Lead {index}", email=f"lead{index}@example.com", company="ACME")
+            for index in range(1, options["leads"] + 1)
+        ]
+
+        self.stdout.write(f"Body: {len(body)} byte, {options['links']} link, {len(leads)} lead")
+
+        started = time.perf_counter()
+        for lead in leads:
+            prepare_email_body(replace_placeholders(body, lead), lead.id, lead.id, domain)
+        legacy = time.perf_counter() - started
+
+        started = time.perf_counter()
+        template = get_email_template(body, True, domain)
+        for lead in leads:
+            template.render(lead, lead.id)
+        compiled = time.perf_counter() - started
+
+        self.stdout.write(f"replace_placeholders + prepare_email_body: {legacy:.2f}s ({len(leads) / legacy:.0f} email/s)")
+        self.stdout.write(f"Template compilato: {compiled:.2f}s ({len(leads) / compiled:.0f} email/s)")
+        self.stdout.write(self.style.SUCCESS(f"Speedup: {legacy / compiled:.1f}x"))
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2025-04-10 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0003_workflowqueue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leadstepstatus',
+            name='resume_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='leadstepstatus',
+            name='status',
+            field=models.CharField(choices=[('CREATED', 'Created'), ('PENDING', 'Pending'), ('RUNNING', 'Running'), ('WAITING', 'Waiting'), ('COMPLETED', 'Completed'), ('FAILED', 'Failed'), ('SKIPPED', 'Skipped')], default='CREATED', max_length=50),
+        ),
+    ]
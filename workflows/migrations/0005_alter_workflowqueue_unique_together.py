@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2025-04-11 09:27
+
+from django.db import migrations
+from django.db.models import Min
+
+
+def remove_duplicate_queue_items(apps, schema_editor):
+    WorkflowQueue = apps.get_model('workflows', 'WorkflowQueue')
+    duplicates = (
+        WorkflowQueue.objects
+        .values('lead_id', 'workflow_execution_id')
+        .annotate(first_id=Min('id'))
+    )
+    keep_ids = [item['first_id'] for item in duplicates]
+    WorkflowQueue.objects.exclude(id__in=keep_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leads', '0009_remove_lead_name_lead_first_name_lead_last_name_and_more'),
+        ('workflows', '0004_leadstepstatus_resume_at_alter_leadstepstatus_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_queue_items, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='workflowqueue',
+            unique_together={('lead', 'workflow_execution')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2025-04-11 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0005_alter_workflowqueue_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='workflowqueue',
+            index=models.Index(fields=['processed', 'processing', 'created_at'], name='workflowqueue_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2025-04-14 10:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0006_workflowqueue_workflowqueue_pending_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowqueue',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workflowqueue',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='workflowqueue',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='workflowqueue',
+            name='worker_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2025-04-20 09:15
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0007_workflowqueue_lease'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='workflowqueue',
+            name='updated_at',
+        ),
+    ]
@@ -80,6 +80,7 @@ class WorkflowExecutionStepStatus(models.TextChoices):
     CREATED = 'CREATED'
     PENDING = 'PENDING'
     RUNNING = 'RUNNING'
+    WAITING = 'WAITING'
     COMPLETED = 'COMPLETED'
     FAILED = 'FAILED'
     SKIPPED = 'SKIPPED'
@@ -110,9 +111,20 @@ class WorkflowQueue(models.Model):
     processed = models.BooleanField(default=False)
     processing = models.BooleanField(default=False)
 
+    # Lease del worker che sta eseguendo il workflow: scaduto il lease il lead viene ridistribuito
+    worker_id = models.CharField(max_length=255, null=True, blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+
     created_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        unique_together = ("lead", "workflow_execution")  # Un lead viene accodato una sola volta per esecuzione
+        indexes = [
+            models.Index(fields=["processed", "processing", "created_at"], name="workflowqueue_pending_idx"),
+        ]
+
     def __str__(self):
         return f"Queue: {self.lead.email} - {self.workflow_execution.workflow.name}"    
 
@@ -129,6 +141,7 @@ class LeadStepStatus(models.Model):
     condition = models.CharField(max_length=50, blank=True, null=True)
     started_at = models.DateTimeField(null=True, blank=True)
     completed_at = models.DateTimeField(null=True, blank=True)
+    resume_at = models.DateTimeField(null=True, blank=True, db_index=True)  # Timer dei nodi WAIT
     email_log = models.ForeignKey(EmailLog, null=True, blank=True, on_delete=models.SET_NULL)
 
 
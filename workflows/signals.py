@@ -1,8 +1,18 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from workflows.models import Workflow, WorkflowExecution, WorkflowQueue, WorkflowSettings, WorkflowStatus
+from workflows.models import Workflow, WorkflowExecution, WorkflowExecutionStep, WorkflowSettings, WorkflowStatus
+from workflows.tasks.enqueue import enqueue_workflow_leads
+from workflows.utils.execution_plan import invalidate_execution_plan
 from utils.utils import serialize_workflow_settings
 
+@receiver([post_save, post_delete], sender=WorkflowExecutionStep)
+def invalidate_workflow_plan(sender, instance, **kwargs):
+    """
+    Signal per invalidare il piano compilato quando gli step vengono ricreati (create_with_steps) o modificati.
+    """
+    invalidate_execution_plan(instance.workflow_execution_id)
+
 @receiver(post_save, sender=Workflow)
 def process_workflow(sender, instance, **kwargs):
     """
@@ -15,20 +25,15 @@ def process_workflow(sender, instance, **kwargs):
         settings_dict = serialize_workflow_settings(workflow_settings)
         if workflow_settings and workflow_settings.start == "all":
             # Avvia il workflow per tutti i lead che sono presenti nella campagna e per i futuri nuovi leads
-            leads = instance.campaign.leads.all()
-
             try:
                 workflow_execution = instance.execution
             except WorkflowExecution.DoesNotExist:
                 print("❌ Nessuna WorkflowExecution trovata per questo Workflow.")
                 return
 
-            for lead in leads:
-                # execute_workflow.delay(workflow_execution.id, lead.id, settings_dict)
-                WorkflowQueue.objects.create(
-                    lead=lead,
-                    workflow_execution=workflow_execution,
-                    settings=settings_dict
-                )
-                
-                
+            # Accodamento in background a blocchi: la richiesta di pubblicazione non attende i lead.
+            # Il task è idempotente, salvare due volte il workflow non duplica la coda.
+            workflow_execution_id = workflow_execution.id
+            transaction.on_commit(
+                lambda: enqueue_workflow_leads.delay(workflow_execution_id, settings_dict)
+            )
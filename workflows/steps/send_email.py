@@ -1,116 +1,187 @@
-import pytz
-from datetime import time as dt_time
-from django.utils.timezone import now, localtime
+from django.utils.timezone import now
 from django.conf import settings as ingegno_settings
-from django.core import signing
-from django.urls import reverse
 
-from workflows.models import WorkflowExecutionStepStatus, LeadStepStatus
-from leads.models import Lead, LeadStatus
+from workflows.models import WorkflowExecutionStepStatus
+from leads.models import LeadStatus
 from emails.models import EmailLog, EmailStatus
 from emails.utils.throttling import is_account_throttled
+from emails.utils.rate_limiter import release_send_slot, reserve_send_slot
 from emails.email_sender import send_email_gmail, send_email_outlook, send_email_smtp
 from connected_accounts.models import Provider
+from campaigns.stats import increment_daily_stats
 
-from workflows.utils.email_placeholders import replace_placeholders
-from workflows.utils.email_tracking import prepare_email_body
+from workflows.utils.email_template import get_email_template
 from workflows.utils.helpers import get_connected_account
+from workflows.utils.send_window import get_next_send_time
 
 MAX_RETRIES = 3
 
-def execute_send_email(step, lead_id, settings, task, node_data):
-    lead = Lead.objects.get(id=lead_id, unsubscribed=False)
 
-    lead_step_status, _ = LeadStepStatus.objects.get_or_create(
-        lead=lead,
-        workflow=step.workflow_execution.workflow,
-        step=step
-    )
+def defer_send_email(state, lead_step_status, resume_at):
+    """
+    Rimanda l'invio senza occupare il worker: il nodo resta WAITING e verrà rieseguito a `resume_at`.
+    """
+    lead_step_status.status = WorkflowExecutionStepStatus.WAITING
+    lead_step_status.resume_at = resume_at
+    state.save(lead_step_status)
+    return WorkflowExecutionStepStatus.WAITING
+
+
+def get_slot_reservation_id(lead_id, step):
+    return f"{lead_id}:{step.id}"
 
-    timezone = step.workflow_execution.workflow.user.timezone
-    user_timezone = pytz.timezone(timezone)
-    local_now = localtime(now(), user_timezone)
 
-    current_day = local_now.strftime("%A").lower()
-    start_time = dt_time.fromisoformat(settings.get("sending_time_start"))
-    end_time = dt_time.fromisoformat(settings.get("sending_time_end"))
-    start_of_day = now().replace(hour=0, minute=0, second=0, microsecond=0)
-    current_time = local_now.time()
+def release_send_email_slot(lead_id, step, email_account, connected_account=None):
+    """
+    Libera lo slot di invio riservato dal nodo in un rinvio precedente: l'email non partirà in quello slot
+    e la quota giornaliera torna disponibile.
+    """
+    connected_account = connected_account or get_connected_account(email_account)
+    if connected_account:
+        release_send_slot(connected_account, get_slot_reservation_id(lead_id, step))
+
+
+def complete_send_email(state, lead_step_status, email_log):
+    """
+    Completa il nodo e salva subito lo stato: un'esecuzione ripresa dopo un crash non rispedisce l'email.
+    """
+    lead_step_status.email_log = email_log
+    lead_step_status.status = WorkflowExecutionStepStatus.COMPLETED
+    lead_step_status.completed_at = now()
+    state.save(lead_step_status)
+    state.flush()
+    return True
+
+
+def execute_send_email(step, state, settings, task, node_data):
+    lead = state.lead
+    lead_id = lead.id
+    email_account = node_data["data"]["settings"]["email_account"]
+    # Nodo già rinviato almeno una volta: può avere uno slot riservato da liberare se non invia
+    deferred = getattr(state.get(step.id), "resume_at", None) is not None
+
+    if lead.unsubscribed:
+        print(f"Lead {lead_id} unsubscribed. Skipping SEND_EMAIL.")
+        if deferred:
+            release_send_email_slot(lead_id, step, email_account)
+        return False
+
+    lead_step_status = state.get_or_create(step)
+
+    # Email già inviata da un'esecuzione interrotta prima di completare il nodo (es. worker terminato):
+    # il nodo viene completato senza inviarla di nuovo
+    email_log = lead_step_status.email_log
+    if email_log and email_log.status in (EmailStatus.SENT, EmailStatus.QUEUED, EmailStatus.SENDING):
+        print(f"Lead {lead_id}: email {email_log.id} already sent, completing SEND_EMAIL.")
+        return complete_send_email(state, lead_step_status, email_log)
+
+    user_timezone = state.user_timezone
 
     if settings.get("reply_action") == 'stop':
         from emails.models import EmailReplyTracking
         if EmailReplyTracking.objects.filter(lead_id=lead_id).exists():
             print(f"Lead {lead_id} has replied to an email. Stopping execution.")
+            if deferred:
+                release_send_email_slot(lead_id, step, email_account)
             lead_step_status.status = WorkflowExecutionStepStatus.COMPLETED
-            lead_step_status.save()
+            state.save(lead_step_status)
             return True
 
     lead_step_status.status = WorkflowExecutionStepStatus.RUNNING
     lead_step_status.started_at = now()
-    lead_step_status.save()
-
-    subject = replace_placeholders(node_data["data"]["settings"]["subject"], lead)
-    body = replace_placeholders(node_data["data"]["settings"]["body"], lead)
-    email_account = node_data["data"]["settings"]["email_account"]
-
-    email_log = EmailLog.objects.create(
-        lead=lead,
-        subject=subject,
-        sender=email_account,
-        status=EmailStatus.PENDING
-    )
-
-    signed_data = signing.dumps({"lead_id": lead.id, "email_log_id": email_log.id})
-    tracking_pixel_url = f"https://{ingegno_settings.DOMAIN}{reverse('track_email_open', args=[signed_data])}"
-    print(f"Tracking pixel URL: {tracking_pixel_url}")
-
-    body = prepare_email_body(body, lead.id, email_log.id, ingegno_settings.DOMAIN)
-
-    if current_day not in settings.get("sending_days", []):
-        print(f"❌ Today ({current_day}) is not allowed for sending.")
-        raise task.retry(countdown=18000)
-
-    if not (start_time <= current_time <= end_time):
-        print(f"❌ Current time ({current_time}) is outside allowed window ({start_time} - {end_time})")
-        raise task.retry(countdown=3600)
+    state.save(lead_step_status)
+
+    # Fuori dalla finestra di invio: il nodo riprende esattamente alla prossima apertura
+    try:
+        next_window = get_next_send_time(settings, user_timezone)
+    except ValueError as e:
+        print(f"❌ Lead {lead_id}: {e}.")
+        if deferred:
+            release_send_email_slot(lead_id, step, email_account)
+        lead_step_status.status = WorkflowExecutionStepStatus.FAILED
+        state.save(lead_step_status)
+        return False
 
-    count_email_logs = EmailLog.objects.filter(sender=email_account, sent_at__gte=start_of_day).count()
-    if count_email_logs >= settings.get("max_emails_per_day"):
-        print(f"⚠️ Max emails/day reached for {email_account}.")
-        raise task.retry(countdown=86400, max_retries=MAX_RETRIES, exc=Exception("Max emails reached"))
+    if next_window:
+        print(f"❌ Outside sending window, next window opens at {next_window}.")
+        if deferred:
+            release_send_email_slot(lead_id, step, email_account)
+        return defer_send_email(state, lead_step_status, next_window)
 
     connected_account = get_connected_account(email_account)
     if not connected_account:
         print(f"No connected account for {email_account}")
         lead_step_status.status = WorkflowExecutionStepStatus.FAILED
-        lead_step_status.save()
+        state.save(lead_step_status)
         return False
 
     if is_account_throttled(connected_account):
         print(f"🔁 {connected_account.email_address} in throttling.")
+        if deferred:
+            release_send_email_slot(lead_id, step, email_account, connected_account)
         lead_step_status.status = WorkflowExecutionStepStatus.SKIPPED
         lead_step_status.completed_at = now()
-        lead_step_status.save()
+        state.save(lead_step_status)
         return False
 
-    print(f"Sending email via {connected_account.provider} to {lead.email}: {subject}")
+    # Limite giornaliero, pausa tra le email e burst del provider condivisi tra tutti i worker
+    next_slot = reserve_send_slot(
+        connected_account,
+        settings.get("max_emails_per_day"),
+        settings.get("pause_between_emails"),
+        user_timezone,
+        reservation_id=get_slot_reservation_id(lead_id, step)
+    )
+    if next_slot:
+        # Se il prossimo slot cade fuori finestra (es. limite giornaliero raggiunto) si riprende all'apertura,
+        # senza tenere occupato uno slot che non verrà usato
+        next_window = get_next_send_time(settings, user_timezone, reference=next_slot)
+        if next_window:
+            release_send_email_slot(lead_id, step, email_account, connected_account)
+            next_slot = next_window
+        print(f"⏳ Rate limit for {email_account}: next slot at {next_slot}.")
+        return defer_send_email(state, lead_step_status, next_slot)
+
+    # Template compilati una volta per nodo: il render per lead è una join con i soli link da firmare
+    subject = get_email_template(node_data["data"]["settings"]["subject"]).render(lead)
+    body_template = get_email_template(node_data["data"]["settings"]["body"], True, ingegno_settings.DOMAIN)
+
+    email_log = EmailLog.objects.create(
+        lead=lead,
+        subject=subject,
+        sender=email_account,
+        status=EmailStatus.PENDING
+    )
+
+    body = body_template.render(lead, email_log.id)
 
-    if connected_account.provider == Provider.GMAIL:
-        send_email_gmail(connected_account, lead.email, subject, body)
-    elif connected_account.provider == Provider.OUTLOOK:
-        send_email_outlook(connected_account, lead.email, subject, body)
+    # EmailLog collegata al nodo prima dell'invio: se l'esecuzione si interrompe il nodo non la rispedisce
+    lead_step_status.email_log = email_log
+    state.save(lead_step_status)
+    state.flush()
+
+    if ingegno_settings.EMAIL_SEND_MODE != "direct":
+        # Email in coda: spedita in batch da `send_queued_emails` o dal worker asyncio `run_send_worker`
+        print(f"Queueing email via {connected_account.provider} to {lead.email}: {subject}")
+        email_log.body = body
+        email_log.status = EmailStatus.QUEUED
+        email_log.save(update_fields=["body", "status"])
     else:
-        send_email_smtp(connected_account, lead.email, subject, body)
+        print(f"Sending email via {connected_account.provider} to {lead.email}: {subject}")
 
-    email_log.body = body
-    email_log.mark_sent()
+        if connected_account.provider == Provider.GMAIL:
+            send_email_gmail(connected_account, lead.email, subject, body, email_log.message_id)
+        elif connected_account.provider == Provider.OUTLOOK:
+            send_email_outlook(connected_account, lead.email, subject, body, email_log.message_id)
+        else:
+            send_email_smtp(connected_account, lead.email, subject, body, email_log.message_id)
 
+        email_log.body = body
+        email_log.mark_sent()
+
+    if lead.status == LeadStatus.NEW:
+        increment_daily_stats(lead.campaign_id, contacted=1)
     lead.status = LeadStatus.CONTACTED
     lead.save()
 
-    lead_step_status.email_log = email_log
-    lead_step_status.status = WorkflowExecutionStepStatus.COMPLETED
-    lead_step_status.completed_at = now()
-    lead_step_status.save()
-
-    return True
+    return complete_send_email(state, lead_step_status, email_log)
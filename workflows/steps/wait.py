@@ -1,32 +1,42 @@
-import time
+from datetime import timedelta
 from django.utils.timezone import now
 from workflows.models import WorkflowExecutionStepStatus
-from workflows.utils.helpers import get_or_create_lead_step_status
-from leads.models import Lead
 
+# Secondi per ciascuna unità di attesa configurabile nel nodo
+WAIT_FORMAT_SECONDS = {
+    "Minutes": 60,
+    "Hours": 3600,
+    "Days": 86400,
+}
 
-def execute_wait(step, lead_id, node_data):
-    lead = Lead.objects.get(id=lead_id)
-
-    lead_step_status = get_or_create_lead_step_status(lead, step)
-
-    lead_step_status.status = WorkflowExecutionStepStatus.RUNNING
-    lead_step_status.started_at = now()
-    lead_step_status.save()
 
+def get_wait_delay(node_data):
     delay = node_data["data"]["settings"].get("delay", 0)
     format = node_data["data"]["settings"].get("format", "Minutes")
-    print(f"Waiting for {delay} {format}")
+    return timedelta(seconds=delay * WAIT_FORMAT_SECONDS.get(format, 0))
+
+
+def execute_wait(step, state, node_data):
+    """
+    Non blocca il worker: al primo passaggio salva `resume_at` e restituisce WAITING,
+    il workflow verrà ripreso dal timer. Al passaggio successivo, se il timer è scaduto,
+    il nodo viene completato.
+    """
+    lead_step_status = state.get_or_create(step)
+
+    if lead_step_status.resume_at is None:
+        delay = get_wait_delay(node_data)
+        lead_step_status.started_at = now()
+        lead_step_status.resume_at = lead_step_status.started_at + delay
+        print(f"Waiting until {lead_step_status.resume_at} ({delay}) for lead {state.lead.id}")
 
-    if format == "Minutes":
-        time.sleep(delay * 60)
-    elif format == "Hours":
-        time.sleep(delay * 3600)
-    elif format == "Days":
-        time.sleep(delay * 86400)
+    if now() < lead_step_status.resume_at:
+        lead_step_status.status = WorkflowExecutionStepStatus.WAITING
+        state.save(lead_step_status)
+        return WorkflowExecutionStepStatus.WAITING
 
     lead_step_status.status = WorkflowExecutionStepStatus.COMPLETED
     lead_step_status.completed_at = now()
-    lead_step_status.save()
+    state.save(lead_step_status)
 
-    return True
\ No newline at end of file
+    return True
@@ -1 +1,3 @@
-from .scheduler import schedule_workflow_batch
\ No newline at end of file
+from .scheduler import schedule_workflow_batch
+from .enqueue import enqueue_workflow_leads
+from .events import on_email_clicked, on_email_replied
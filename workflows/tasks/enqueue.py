@@ -0,0 +1,66 @@
+from celery import shared_task
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+from leads.models import Lead
+from workflows.models import LeadStepStatus, WorkflowExecution, WorkflowQueue
+
+ENQUEUE_CHUNK_SIZE = 2000  # Lead inseriti nella WorkflowQueue per ogni bulk_create
+ENQUEUE_LOCK_TIMEOUT = 60 * 60
+
+
+def get_enqueue_progress_key(workflow_execution_id):
+    return f"workflow_enqueue_progress_{workflow_execution_id}"
+
+
+@shared_task(bind=True, name="workflows.tasks.enqueue.enqueue_workflow_leads")
+def enqueue_workflow_leads(self, workflow_execution_id, settings):
+    """
+    Task Celery che accoda nella WorkflowQueue tutti i lead della campagna (start="all"),
+    a blocchi e senza caricare i lead in memoria. Idempotente: salta i lead già in coda
+    o già avviati per questo workflow.
+    """
+    lock_key = f"workflow_enqueue_lock_{workflow_execution_id}"
+    if not cache.add(lock_key, self.request.id, timeout=ENQUEUE_LOCK_TIMEOUT):
+        print(f"⏭️ Accodamento già in corso per l'esecuzione {workflow_execution_id}.")
+        return
+
+    progress_key = get_enqueue_progress_key(workflow_execution_id)
+
+    try:
+        workflow_execution = WorkflowExecution.objects.select_related("workflow").get(id=workflow_execution_id)
+        workflow = workflow_execution.workflow
+
+        lead_ids = (
+            Lead.objects
+            .filter(campaign_id=workflow.campaign_id)
+            .exclude(Exists(WorkflowQueue.objects.filter(lead=OuterRef("pk"), workflow_execution=workflow_execution)))
+            .exclude(Exists(LeadStepStatus.objects.filter(lead=OuterRef("pk"), workflow=workflow)))
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+
+        total = lead_ids.count()
+        queued = 0
+        chunk = []
+
+        cache.set(progress_key, 0 if total else 100, timeout=ENQUEUE_LOCK_TIMEOUT)
+
+        for lead_id in lead_ids.iterator(chunk_size=ENQUEUE_CHUNK_SIZE):
+            chunk.append(WorkflowQueue(lead_id=lead_id, workflow_execution=workflow_execution, settings=settings))
+
+            if len(chunk) >= ENQUEUE_CHUNK_SIZE:
+                WorkflowQueue.objects.bulk_create(chunk, ignore_conflicts=True)
+                queued += len(chunk)
+                chunk = []
+                cache.set(progress_key, int((queued / total) * 100), timeout=ENQUEUE_LOCK_TIMEOUT)
+
+        if chunk:
+            WorkflowQueue.objects.bulk_create(chunk, ignore_conflicts=True)
+            queued += len(chunk)
+
+        cache.set(progress_key, 100, timeout=ENQUEUE_LOCK_TIMEOUT)
+        print(f"📥 Accodati {queued} lead per il workflow {workflow.name}.")
+        return {"status": "completed", "queued": queued}
+
+    finally:
+        cache.delete(lock_key)
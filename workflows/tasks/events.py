@@ -0,0 +1,87 @@
+import json
+from celery import shared_task
+from django.utils.timezone import now
+from leads.models import Lead, LeadWorkflowExecutionStatus
+from workflows.models import LeadStepStatus, WorkflowExecutionStepStatus
+from workflows.steps.send_email import release_send_email_slot
+from workflows.tasks.worker import execute_workflow
+from workflows.utils.execution_plan import get_execution_plan
+from workflows.utils.lead_state import LeadState
+from utils.utils import serialize_workflow_settings
+
+# Stati di un nodo con un timer attivo (WAITING) o con una ripresa già programmata (PENDING)
+WAITING_STATUSES = [WorkflowExecutionStepStatus.WAITING, WorkflowExecutionStepStatus.PENDING]
+
+
+@shared_task(name="workflows.tasks.events.on_email_clicked")
+def on_email_clicked(lead_id, email_log_id, url):
+    """
+    Evento click: se il lead è in attesa su un nodo seguito da un CHECK_LINK_CLICKED
+    per lo stesso link e la stessa email, l'attesa viene interrotta e il ramo YES parte subito.
+    """
+    waiting_statuses = LeadStepStatus.objects.filter(
+        lead_id=lead_id,
+        status__in=WAITING_STATUSES,
+        resume_at__gt=now()
+    ).select_related("lead", "step", "workflow__settings")
+
+    # Un solo snapshot degli stati del lead per workflow, condiviso da tutti i nodi in attesa
+    states = {}
+    for lead_step_status in waiting_statuses:
+        plan = get_execution_plan(lead_step_status.step.workflow_execution_id)
+        node = plan.get(lead_step_status.step_id)
+        if not node:
+            continue
+
+        checks_link = any(
+            child.type == "CHECK_LINK_CLICKED" and child.settings.get("link_url") == url
+            for child in node.children
+        )
+        if not checks_link:
+            continue
+
+        state = states.get(lead_step_status.workflow_id)
+        if state is None:
+            state = states[lead_step_status.workflow_id] = LeadState(plan, lead_step_status.lead)
+        email_log = state.find_previous_email_log(node)
+        if email_log is None or email_log.id != email_log_id:
+            continue
+
+        lead_step_status.status = WorkflowExecutionStepStatus.PENDING
+        lead_step_status.resume_at = now()
+        lead_step_status.save(update_fields=["status", "resume_at"])
+
+        settings = serialize_workflow_settings(getattr(lead_step_status.workflow, "settings", None))
+        execute_workflow.apply_async(
+            args=[plan.workflow_execution.id, lead_id, settings],
+            kwargs={"node_ids": [str(node.id)]}
+        )
+        print(f"🖱️ Lead {lead_id}: click su {url}, attesa interrotta per step {node.id}")
+
+
+@shared_task(name="workflows.tasks.events.on_email_replied")
+def on_email_replied(lead_id):
+    """
+    Evento risposta: nei workflow con reply_action='stop' i timer del lead vengono annullati subito,
+    senza aspettare che il prossimo SEND_EMAIL se ne accorga.
+    """
+    waiting_statuses = LeadStepStatus.objects.filter(
+        lead_id=lead_id,
+        status__in=WAITING_STATUSES,
+        workflow__settings__reply_action="stop"
+    )
+
+    # Invii rinviati che non partiranno più: gli slot riservati tornano disponibili
+    for lead_step_status in waiting_statuses.filter(resume_at__isnull=False).select_related("step"):
+        node_data = lead_step_status.step.node
+        if isinstance(node_data, str):
+            node_data = json.loads(node_data)
+        if node_data.get("type") == "SEND_EMAIL":
+            email_account = node_data.get("data", {}).get("settings", {}).get("email_account")
+            release_send_email_slot(lead_id, lead_step_status.step, email_account)
+
+    stopped = waiting_statuses.update(status=WorkflowExecutionStepStatus.SKIPPED, resume_at=None, completed_at=now())
+
+    if stopped:
+        Lead.objects.filter(id=lead_id).update(workflow_status=LeadWorkflowExecutionStatus.COMPLETED)
+        print(f"✉️ Lead {lead_id}: risposta ricevuta, workflow fermato ({stopped} timer annullati)")
@@ -1,66 +1,205 @@
-from celery import shared_task
+import time
+import uuid
+from celery import current_app, group, shared_task
 from django.db import transaction
+from django.db.models import F, Q
 from django.utils.timezone import now, timedelta
-from workflows.models import WorkflowExecution, WorkflowQueue
-from workflows.tasks.worker import execute_workflow
+from workflows.models import LeadStepStatus, WorkflowExecutionStepStatus, WorkflowQueue, WorkflowSettings
+from workflows.tasks.worker import DISPATCH_WORKER_PREFIX, execute_workflow
+from utils.utils import serialize_workflow_settings
 
 
-BATCH_SIZE = 200  # Numero di lead da processare per ciclo
+MIN_BATCH_SIZE = 100  # Lead minimi prelevati dalla WorkflowQueue per ciclo
+MAX_BATCH_SIZE = 5000  # Lead massimi prelevati dalla WorkflowQueue per ciclo
+DISPATCH_GROUP_SIZE = 500  # Task execute_workflow pubblicati per ogni group Celery
+DISPATCH_TIME_BUDGET = 50  # Secondi massimi di dispatch per esecuzione del task periodico
+BROKER_BACKLOG_LIMIT = 20000  # Oltre questa soglia di messaggi in coda i worker sono saturi
+RESUME_BATCH_SIZE = 500  # Numero di timer scaduti da riprendere per ciclo
+RESUME_GRACE_PERIOD = timedelta(minutes=15)  # Oltre questo ritardo una ripresa PENDING è considerata persa
+DISPATCH_LEASE_DURATION = timedelta(minutes=30)  # Tempo concesso a un worker per prendere in carico il lead
+MAX_QUEUE_ATTEMPTS = 5  # Dopo questi tentativi falliti il lead viene scartato dalla coda
 
-@shared_task(name="workflows.tasks.scheduler.schedule_workflow_batch")
-def schedule_workflow_batch():
+
+def get_broker_backlog(queue_name="celery"):
+    """
+    Messaggi in attesa nella coda del broker: indica quanto i worker sono già carichi.
+    """
+    try:
+        with current_app.connection_for_read() as connection:
+            return connection.default_channel.queue_declare(queue=queue_name, passive=True).message_count
+    except Exception as e:
+        print(f"⚠️ Impossibile leggere la coda del broker: {e}")
+        return None
+
+
+def get_batch_size():
+    """
+    Dimensione del batch adattiva: cresce con la profondità della WorkflowQueue
+    e si riduce quando la coda del broker indica che i worker non stanno al passo.
+    """
+    pending = WorkflowQueue.objects.filter(processed=False, processing=False)[:MAX_BATCH_SIZE * 4].count()
+    if not pending:
+        return 0
+
+    batch_size = max(MIN_BATCH_SIZE, pending // 4)
+
+    backlog = get_broker_backlog()
+    if backlog is not None:
+        batch_size = min(batch_size, BROKER_BACKLOG_LIMIT - backlog)
+
+    return min(batch_size, MAX_BATCH_SIZE, pending)
+
+
+def get_claimable_ids(batch_size):
     """
-    Task periodico che preleva un batch di lead dalla WorkflowQueue con lock pessimista
-    e lancia i workflow senza rischi di concorrenza.
+    Id dei primi elementi liberi della WorkflowQueue, saltando quelli bloccati da un altro dispatcher.
     """
+    return list(
+        WorkflowQueue.objects
+        .select_for_update(skip_locked=True)
+        .filter(processed=False, processing=False)
+        .order_by("created_at")
+        .values_list("id", flat=True)[:batch_size]
+    )
+
+
+def claim_queue_items(batch_size):
+    """
+    Preleva con lock pessimista un batch di lead dalla WorkflowQueue e li segna come in lavorazione
+    con un solo UPDATE. L'UPDATE ricontrolla `processing` e firma le righe con un token del dispatcher:
+    vengono restituite solo quelle firmate, anche se un altro ciclo le ha lette nello stesso momento.
+    """
+    claim_token = f"{DISPATCH_WORKER_PREFIX}{uuid.uuid4()}"
+
     with transaction.atomic():
-        queue_items = (
-            WorkflowQueue.objects
-            .select_for_update(skip_locked=True)
-            .filter(processed=False, processing=False)
-            .order_by("created_at")[:BATCH_SIZE]
+        claimable_ids = get_claimable_ids(batch_size)
+        if not claimable_ids:
+            return []
+
+        WorkflowQueue.objects.filter(id__in=claimable_ids, processed=False, processing=False).update(
+            processing=True,
+            worker_id=claim_token,
+            leased_until=now() + DISPATCH_LEASE_DURATION,
+            attempts=F("attempts") + 1
         )
 
-        if not queue_items:
-            print("🎯 Nessun lead da processare.")
-            return
+    return list(
+        WorkflowQueue.objects
+        .filter(worker_id=claim_token)
+        .order_by("created_at")
+        .values_list("id", "lead_id", "workflow_execution_id", "settings")
+    )
 
-        for item in queue_items:
-            item.processing = True
-            item.save(update_fields=["processing"])
 
-    # 🔁 Ora fuori dalla transazione: eseguiamo i workflow in async
-    for item in queue_items:
-        lead = item.lead
-        execution = WorkflowExecution.objects.get(id=item.workflow_execution_id)
-        settings = item.settings
+def dispatch_queue_items(queue_items):
+    """
+    Pubblica i workflow dei lead prelevati come group Celery. Ogni elemento resta in lease
+    e viene confermato dal worker (`execute_workflow`) solo a esecuzione terminata.
+    """
+    for i in range(0, len(queue_items), DISPATCH_GROUP_SIZE):
+        chunk = queue_items[i:i + DISPATCH_GROUP_SIZE]
+        group(
+            execute_workflow.s(workflow_execution_id, lead_id, settings, queue_item_id=queue_item_id)
+            for queue_item_id, lead_id, workflow_execution_id, settings in chunk
+        ).apply_async()
 
-        execute_workflow.apply_async(
-            args=[execution.id, lead.id, settings]
-        )
 
-        item.processed = True
-        item.processing = False
-        item.processed_at = now()
-        item.save()
+@shared_task(name="workflows.tasks.scheduler.schedule_workflow_batch")
+def schedule_workflow_batch():
+    """
+    Task periodico che svuota la WorkflowQueue a batch (con lock pessimista e aggiornamenti massivi)
+    e lancia i workflow come group Celery, finché c'è lavoro e c'è tempo nel ciclo.
+    """
+    started = time.monotonic()
+    dispatched = 0
+
+    while time.monotonic() - started < DISPATCH_TIME_BUDGET:
+        batch_size = get_batch_size()
+        if batch_size <= 0:
+            break
+
+        queue_items = claim_queue_items(batch_size)
+        if not queue_items:
+            break
 
-    print(f"🚀 Processati {len(queue_items)} lead dal batch.")
+        dispatch_queue_items(queue_items)
+        dispatched += len(queue_items)
+
+        if len(queue_items) < batch_size:
+            break
+
+    if not dispatched:
+        print("🎯 Nessun lead da processare.")
+        return
+
+    print(f"🚀 Processati {dispatched} lead in {time.monotonic() - started:.1f}s.")
 
 
 @shared_task(name="workflows.tasks.scheduler.reset_stuck_queue")
-def reset_stuck_queue(timeout_minutes=10):
+def reset_stuck_queue():
     """
-    Task per sbloccare lead nella WorkflowQueue rimasti bloccati con processing=True
-    da troppo tempo (es. worker crashati).
+    Task periodico che rimette in coda i lead della WorkflowQueue il cui lease è scaduto
+    (worker crashato o task perso), così il dispatcher li ridistribuisce al ciclo successivo.
     """
-    threshold_time = now() - timedelta(minutes=timeout_minutes)
-
-    stuck_items = WorkflowQueue.objects.filter(
+    expired = WorkflowQueue.objects.filter(
         processed=False,
         processing=True,
-        updated_at__lt=threshold_time  # o `created_at`
+        leased_until__lt=now()
     )
 
-    count = stuck_items.update(processing=False)
+    # Troppi tentativi: il lead viene scartato invece di essere ridistribuito all'infinito
+    discarded = expired.filter(attempts__gte=MAX_QUEUE_ATTEMPTS).update(
+        processed=True,
+        processing=False,
+        processed_at=now(),
+        leased_until=None
+    )
+
+    count = expired.update(processing=False, worker_id=None, leased_until=None)
+
+    if count or discarded:
+        print(f"🧹 Ripristinati {count} lead con lease scaduto, scartati {discarded} dopo {MAX_QUEUE_ATTEMPTS} tentativi")
+
+
+@shared_task(name="workflows.tasks.scheduler.resume_waiting_leads")
+def resume_waiting_leads():
+    """
+    Task periodico che riprende i workflow dei lead fermi su un nodo in attesa (WAIT)
+    il cui timer `resume_at` è scaduto.
+    Riprende anche i nodi PENDING il cui task non è partito entro RESUME_GRACE_PERIOD
+    (pubblicazione fallita, messaggio ETA perso, worker terminato).
+    """
+    current_time = now()
+    with transaction.atomic():
+        due_items = list(
+            LeadStepStatus.objects
+            .select_for_update(skip_locked=True, of=("self",))
+            .filter(
+                Q(status=WorkflowExecutionStepStatus.WAITING, resume_at__lte=current_time)
+                | Q(status=WorkflowExecutionStepStatus.PENDING, resume_at__lte=current_time - RESUME_GRACE_PERIOD)
+            )
+            .order_by("resume_at")
+            .values_list("id", "lead_id", "step_id", "step__workflow_execution_id")[:RESUME_BATCH_SIZE]
+        )
+
+        if not due_items:
+            return
+
+        # PENDING = ripresa in corso; `resume_at` = momento del dispatch, da cui conta il periodo di tolleranza
+        LeadStepStatus.objects.filter(id__in=[item[0] for item in due_items]).update(
+            status=WorkflowExecutionStepStatus.PENDING,
+            resume_at=current_time
+        )
+
+    settings_by_execution = {}
+    for _, lead_id, step_id, workflow_execution_id in due_items:
+        if workflow_execution_id not in settings_by_execution:
+            workflow_settings = WorkflowSettings.objects.filter(workflow__execution__id=workflow_execution_id).first()
+            settings_by_execution[workflow_execution_id] = serialize_workflow_settings(workflow_settings)
+
+        execute_workflow.apply_async(
+            args=[workflow_execution_id, lead_id, settings_by_execution[workflow_execution_id]],
+            kwargs={"node_ids": [str(step_id)]}
+        )
 
-    print(f"🧹 Ripristinati {count} lead bloccati nella queue (timeout > {timeout_minutes} minuti)")
\ No newline at end of file
+    print(f"⏰ Ripresi {len(due_items)} lead in attesa.")
@@ -1,82 +1,159 @@
-import json
+import time
+from datetime import timedelta
 from celery import shared_task
+from django.db.models import Q
 from django.utils.timezone import now
 from leads.models import Lead, LeadWorkflowExecutionStatus
-from workflows.models import WorkflowExecution, WorkflowExecutionStep, WorkflowExecutionStepStatus, LeadStepStatus
-from workflows.workflow_executor import execute_step
+from workflows.models import WorkflowExecutionStepStatus, WorkflowQueue
+from workflows.workflow_executor import advance_lead
+from workflows.utils.execution_plan import get_execution_plan
+from workflows.utils.lead_state import LeadState
 
+# Le attese più brevi vengono riprese con un task ETA; quelle più lunghe dal task periodico
+# `resume_waiting_leads`, per non tenere a lungo messaggi ETA nel broker (visibility timeout di Redis)
+RESUME_COUNTDOWN_MAX = timedelta(minutes=30)
 
-def check_and_complete_workflow_for_lead(workflow_execution, lead_id):
-    incomplete_steps = LeadStepStatus.objects.filter(
-        lead_id=lead_id,
-        workflow=workflow_execution.workflow
-    ).exclude(status=WorkflowExecutionStepStatus.COMPLETED)
+QUEUE_LEASE_DURATION = timedelta(minutes=5)  # Durata del lease rinnovato dal heartbeat del worker
+QUEUE_HEARTBEAT_INTERVAL = 60  # Secondi minimi tra due rinnovi del lease
+DISPATCH_WORKER_PREFIX = "dispatch:"  # worker_id provvisorio assegnato dal dispatcher fino alla presa in carico
 
-    if not incomplete_steps.exists():
+
+class QueueLease:
+    """
+    Lease di un elemento della WorkflowQueue tenuto dal worker durante `execute_workflow`.
+    """
+
+    def __init__(self, queue_item_id, worker_id):
+        self.queue_item_id = queue_item_id
+        self.worker_id = worker_id
+        self.last_heartbeat = 0
+
+    def acquire(self):
+        """
+        Prende in carico l'elemento solo se non è già in mano a un altro worker con lease valido
+        (es. task consegnato due volte dopo un ripristino). Il token del dispatcher non conta come worker.
+        """
+        acquired = WorkflowQueue.objects.filter(
+            Q(worker_id__isnull=True) | Q(worker_id__startswith=DISPATCH_WORKER_PREFIX)
+            | Q(leased_until__lt=now()) | Q(worker_id=self.worker_id),
+            id=self.queue_item_id,
+            processed=False,
+        ).update(worker_id=self.worker_id, processing=True, leased_until=now() + QUEUE_LEASE_DURATION)
+        self.last_heartbeat = time.monotonic()
+        return acquired > 0
+
+    def heartbeat(self):
+        if time.monotonic() - self.last_heartbeat < QUEUE_HEARTBEAT_INTERVAL:
+            return
+        WorkflowQueue.objects.filter(id=self.queue_item_id, worker_id=self.worker_id).update(
+            leased_until=now() + QUEUE_LEASE_DURATION
+        )
+        self.last_heartbeat = time.monotonic()
+
+    def release(self):
+        """
+        Conferma l'elemento solo a esecuzione terminata.
+        """
+        WorkflowQueue.objects.filter(id=self.queue_item_id, worker_id=self.worker_id).update(
+            processed=True,
+            processing=False,
+            processed_at=now(),
+            leased_until=None
+        )
+
+
+def check_and_complete_workflow_for_lead(state):
+    lead_id = state.lead.id
+    incomplete_steps = [
+        lead_step_status for lead_step_status in state.statuses.values()
+        if lead_step_status.status != WorkflowExecutionStepStatus.COMPLETED
+    ]
+
+    if not incomplete_steps:
         # Tutti gli step avviati sono completati, aggiorniamo lo stato del lead
         Lead.objects.filter(id=lead_id).update(workflow_status=LeadWorkflowExecutionStatus.COMPLETED)
         print(f"✅ Lead {lead_id}: workflow completato")
     else:
-        print(f"⏳ Lead {lead_id}: workflow ancora in esecuzione ({incomplete_steps.count()} step incompleti)")
+        print(f"⏳ Lead {lead_id}: workflow ancora in esecuzione ({len(incomplete_steps)} step incompleti)")
+
+def schedule_workflow_resume(state, settings, node):
+    """
+    Programma la ripresa del workflow per un lead fermo su un nodo in attesa:
+    allo scadere del timer verrà rieseguito solo quel nodo e i suoi successori.
+    """
+    lead_id = state.lead.id
+    lead_step_status = state.get(node.id)
+
+    if lead_step_status.resume_at - now() > RESUME_COUNTDOWN_MAX:
+        print(f"⏰ Lead {lead_id}: ripresa alle {lead_step_status.resume_at} affidata allo scheduler")
+        return
+
+    # PENDING = ripresa già programmata: lo scheduler periodico la riprende solo se il task ETA
+    # non è partito entro RESUME_GRACE_PERIOD da `resume_at` (pubblicazione fallita o messaggio perso)
+    lead_step_status.status = WorkflowExecutionStepStatus.PENDING
+    state.save(lead_step_status)
+    state.flush()  # Lo stato deve essere salvato prima che il task ETA possa partire
+
+    execute_workflow.apply_async(
+        args=[state.plan.workflow_execution.id, lead_id, settings],
+        kwargs={"node_ids": [str(node.id)]},
+        eta=lead_step_status.resume_at
+    )
+    print(f"⏰ Lead {lead_id}: ripresa programmata alle {lead_step_status.resume_at}")
 
 @shared_task(bind=True)
-def execute_workflow(self, workflow_execution_id, lead_id, settings):
+def execute_workflow(self, workflow_execution_id, lead_id, settings, node_ids=None, queue_item_id=None):
     """
-    Task Celery per eseguire un intero workflow in background, rispettando le condizioni e applicandolo a un lead specifico.
+    Task Celery per far avanzare un lead nel workflow in background.
+    Senza `node_ids` parte dalla frontiera del lead (nodi pronti e non completati),
+    altrimenti solo dai nodi indicati dall'evento (timer scaduto, click, ecc.).
+    Con `queue_item_id` l'elemento della WorkflowQueue resta in lease finché l'esecuzione non termina.
     """
+    lease = None
+    if queue_item_id is not None:
+        lease = QueueLease(queue_item_id, f"{self.request.hostname}:{self.request.id}")
+        if not lease.acquire():
+            print(f"⏭️ Lead {lead_id}: elemento {queue_item_id} della coda già in esecuzione o completato.")
+            return
+
+    state = None
     try:
-        workflow_execution = WorkflowExecution.objects.get(id=workflow_execution_id)
-
-        # Ordiniamo i nodi
-        steps = WorkflowExecutionStep.objects.filter(workflow_execution=workflow_execution).order_by("number")
-        executed_steps = {}
-
-        for step in steps:
-            # Se il nodo ha un parent, controlliamo che sia completato
-            if step.parent_node_id:
-                parent_step = WorkflowExecutionStep.objects.get(id=step.parent_node_id)
-
-                try:
-                    parent_status = LeadStepStatus.objects.get(
-                        lead_id=lead_id,
-                        workflow=workflow_execution.workflow,
-                        step=parent_step
-                    )
-                except LeadStepStatus.DoesNotExist:
-                    continue  # Non è stato ancora eseguito
-
-                if parent_status.status != WorkflowExecutionStepStatus.COMPLETED:
-                    continue                
-                
-                # Se il nodo padre è un CHECK_LINK_CLICKED, verificare la condizione
-                if parent_step.node:
-                    parent_node_data = parent_step.node
-                    if isinstance(parent_node_data, str):
-                        parent_node_data = json.loads(parent_node_data)
-
-                    if parent_node_data["type"] == "CHECK_LINK_CLICKED":
-                        if step.condition == "YES" and parent_status.condition != "YES":
-                            continue
-                        if step.condition == "NO" and parent_status.condition != "NO":
-                            continue
-
-            # Eseguiamo il nodo passando il `lead_id`
-            # execute_step(step, lead_id, settings, task=self)
-            # executed_steps[step.id] = step
-
-            # Eseguiamo il nodo passando il `lead_id`
-            result = execute_step(step, lead_id, settings, task=self)
-
-            # Se lo step ritorna False, blocchiamo il workflow per questo lead
-            if result is False:
-                print(f"⛔ Lead {lead_id}: esecuzione interrotta per step {step.id} (stato SKIPPED)")
-                Lead.objects.filter(id=lead_id).update(workflow_status=LeadWorkflowExecutionStatus.SKIPPED)
-                return  # STOP: non processiamo gli altri step
-
-            executed_steps[step.id] = step            
-
-        check_and_complete_workflow_for_lead(workflow_execution, lead_id)
+        # Piano compilato una sola volta per WorkflowExecution (nodi ordinati, payload già decodificati)
+        plan = get_execution_plan(workflow_execution_id)
+
+        # Tutti gli stati degli step del lead caricati con una sola query
+        state = LeadState.load(plan, lead_id)
+
+        start_nodes = None
+        if node_ids is not None:
+            start_nodes = [node for node in (plan.get(node_id) for node_id in node_ids) if node]
+
+        stopped_node, waiting_nodes = advance_lead(
+            plan, state, settings, task=self, start_nodes=start_nodes,
+            heartbeat=lease.heartbeat if lease else None
+        )
+
+        # Se uno step ritorna False, blocchiamo il workflow per questo lead
+        if stopped_node:
+            print(f"⛔ Lead {lead_id}: esecuzione interrotta per step {stopped_node.id} (stato SKIPPED)")
+            Lead.objects.filter(id=lead_id).update(workflow_status=LeadWorkflowExecutionStatus.SKIPPED)
+            return
+
+        # Nodi in attesa: liberiamo il worker, ogni ramo riprenderà allo scadere del proprio timer
+        if waiting_nodes:
+            for node in waiting_nodes:
+                schedule_workflow_resume(state, settings, node)
+            return
+
+        check_and_complete_workflow_for_lead(state)
         
     except Exception as e:
         Lead.objects.filter(id=lead_id).update(workflow_status=LeadWorkflowExecutionStatus.FAILED)
-        print(f"Workflow execution failed: {e}")
\ No newline at end of file
+        print(f"Workflow execution failed: {e}")
+
+    finally:
+        # Scrittura unica (bulk_create/bulk_update) di tutti gli stati modificati durante l'esecuzione
+        if state is not None:
+            state.flush()
+        if lease is not None:
+            lease.release()
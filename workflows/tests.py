@@ -1,3 +1,517 @@
-from django.test import TestCase
+import uuid
+from datetime import datetime
+import pytz
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now, timedelta
+from campaigns.models import Campaign
+from connected_accounts.models import ConnectedAccount, Provider
+from leads.models import Lead, LeadWorkflowExecutionStatus
+from rest_framework.test import APIClient
+from users.models import User
+from emails.models import EmailLog, EmailStatus
+from workflows.models import LeadStepStatus, Workflow, WorkflowQueue, WorkflowSettings, WorkflowExecution, WorkflowExecutionStep, WorkflowExecutionStepStatus
+from workflows.steps.send_email import execute_send_email
+from workflows.tasks.enqueue import enqueue_workflow_leads, get_enqueue_progress_key
+from workflows.tasks.events import on_email_clicked, on_email_replied
+from workflows.tasks import scheduler
+from workflows.tasks.worker import DISPATCH_WORKER_PREFIX, QUEUE_HEARTBEAT_INTERVAL, QueueLease
+from workflows.tasks.scheduler import RESUME_GRACE_PERIOD, resume_waiting_leads
+from workflows.utils import execution_plan
+from workflows.utils.email_placeholders import replace_placeholders
+from workflows.utils.email_template import CompiledEmailTemplate
+from workflows.utils.email_tracking import prepare_email_body
+from workflows.utils.lead_state import LeadState
+from workflows.utils.send_window import get_next_send_time
 
-# Create your tests here.
+LOCMEM_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WorkflowTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(email="owner@example.com", password="password123")
+        campaign = Campaign.objects.create(user=user, name="Campaign")
+        self.workflow = Workflow.objects.create(campaign=campaign, user=user, name="Workflow")
+        self.execution = WorkflowExecution.objects.create(workflow=self.workflow, trigger="manual")
+        self.step = WorkflowExecutionStep.objects.create(
+            id=uuid.uuid4(), workflow_execution=self.execution, number=1, name="Wait",
+            node={"type": "WAIT", "data": {"settings": {"delay": 1, "format": "Minutes"}}}
+        )
+        self.lead = Lead.objects.create(campaign=campaign, email="lead@example.com")
+
+    def lead_step_status(self, status, resume_at=None, **fields):
+        return LeadStepStatus.objects.create(lead=self.lead, workflow=self.workflow, step=self.step, status=status, resume_at=resume_at, **fields)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResumeWaitingLeadsTests(WorkflowTestCase):
+    @mock.patch("workflows.tasks.scheduler.execute_workflow")
+    def test_resumes_expired_timers(self, execute_workflow):
+        lead_step_status = self.lead_step_status(WorkflowExecutionStepStatus.WAITING, now() - timedelta(seconds=1))
+
+        resume_waiting_leads()
+
+        execute_workflow.apply_async.assert_called_once()
+        lead_step_status.refresh_from_db()
+        self.assertEqual(lead_step_status.status, WorkflowExecutionStepStatus.PENDING)
+
+    @mock.patch("workflows.tasks.scheduler.execute_workflow")
+    def test_recovers_lost_pending_resumes(self, execute_workflow):
+        self.lead_step_status(WorkflowExecutionStepStatus.PENDING, now() - RESUME_GRACE_PERIOD - timedelta(minutes=1))
+
+        resume_waiting_leads()
+        # Appena ripresa: il ciclo successivo non la ripubblica
+        resume_waiting_leads()
+
+        execute_workflow.apply_async.assert_called_once()
+
+    @mock.patch("workflows.tasks.scheduler.execute_workflow")
+    def test_ignores_recent_pending_resumes(self, execute_workflow):
+        self.lead_step_status(WorkflowExecutionStepStatus.PENDING, now() - timedelta(minutes=1))
+
+        resume_waiting_leads()
+
+        execute_workflow.apply_async.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SendEmailStepTests(WorkflowTestCase):
+    @mock.patch("workflows.steps.send_email.send_email_smtp")
+    def test_interrupted_send_is_not_repeated(self, send_email_smtp):
+        # Esecuzione precedente terminata dopo l'invio ma prima di completare il nodo
+        email_log = EmailLog.objects.create(lead=self.lead, subject="Hello", sender="sender@example.com", status=EmailStatus.SENT)
+        lead_step_status = self.lead_step_status(WorkflowExecutionStepStatus.RUNNING, email_log=email_log)
+        state = LeadState(mock.Mock(workflow_execution=self.execution), self.lead)
+        node_data = {"type": "SEND_EMAIL", "data": {"settings": {"email_account": "sender@example.com", "subject": "Hello", "body": "Hi"}}}
+
+        result = execute_send_email(self.step, state, {}, None, node_data)
+
+        self.assertIs(result, True)
+        send_email_smtp.assert_not_called()
+        self.assertEqual(EmailLog.objects.count(), 1)
+        lead_step_status.refresh_from_db()
+        self.assertEqual(lead_step_status.status, WorkflowExecutionStepStatus.COMPLETED)
+
+    @mock.patch("workflows.steps.send_email.release_send_slot")
+    def test_deferred_send_releases_its_slot_when_lead_unsubscribes(self, release_send_slot):
+        account = ConnectedAccount.objects.create(user=self.workflow.user, provider=Provider.IMAP_SMTP, email_address="sender@example.com")
+        self.lead_step_status(WorkflowExecutionStepStatus.PENDING, now())
+        Lead.objects.filter(id=self.lead.id).update(unsubscribed=True)
+        self.lead.refresh_from_db()
+        state = LeadState(mock.Mock(workflow_execution=self.execution), self.lead)
+        node_data = {"type": "SEND_EMAIL", "data": {"settings": {"email_account": "sender@example.com", "subject": "Hello", "body": "Hi"}}}
+
+        self.assertIs(execute_send_email(self.step, state, {}, None, node_data), False)
+
+        release_send_slot.assert_called_once_with(account, f"{self.lead.id}:{self.step.id}")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExecutionPlanTests(WorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        execution_plan._local_plans.clear()
+        self.addCleanup(execution_plan._local_plans.clear)
+
+    def test_user_timezone_is_not_cached_with_the_plan(self):
+        plan = execution_plan.get_execution_plan(self.execution.id)
+        self.assertEqual(str(LeadState(plan, self.lead).user_timezone), "UTC")
+
+        User.objects.filter(id=self.workflow.user_id).update(timezone="Europe/Rome")
+
+        plan = execution_plan.get_execution_plan(self.execution.id)
+        self.assertEqual(str(LeadState(plan, self.lead).user_timezone), "Europe/Rome")
+
+    def test_local_plan_expires(self):
+        with mock.patch("workflows.utils.execution_plan.time.monotonic", return_value=1000):
+            plan = execution_plan.get_execution_plan(self.execution.id)
+            self.assertIs(execution_plan.get_execution_plan(self.execution.id), plan)
+
+        with mock.patch("workflows.utils.execution_plan.time.monotonic", return_value=1000 + execution_plan.LOCAL_PLAN_CACHE_TIMEOUT + 1):
+            self.assertIsNot(execution_plan.get_execution_plan(self.execution.id), plan)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WorkflowEventsTests(WorkflowTestCase):
+    LINK = "https://example.com/offer"
+
+    def setUp(self):
+        super().setUp()
+        # SEND_EMAIL -> WAIT (self.step) -> CHECK_LINK_CLICKED
+        self.send_step = WorkflowExecutionStep.objects.create(
+            id=uuid.uuid4(), workflow_execution=self.execution, number=0, name="Send",
+            node={"type": "SEND_EMAIL", "data": {"settings": {}}}
+        )
+        WorkflowExecutionStep.objects.filter(id=self.step.id).update(parent_node_id=self.send_step.id)
+        WorkflowExecutionStep.objects.create(
+            id=uuid.uuid4(), workflow_execution=self.execution, number=2, name="Check", parent_node_id=self.step.id,
+            node={"type": "CHECK_LINK_CLICKED", "data": {"settings": {"link_url": self.LINK}}}
+        )
+        WorkflowSettings.objects.create(workflow=self.workflow, reply_action="stop")
+        self.email_log = EmailLog.objects.create(lead=self.lead, subject="Hello", sender="sender@example.com", status=EmailStatus.SENT)
+        LeadStepStatus.objects.create(
+            lead=self.lead, workflow=self.workflow, step=self.send_step,
+            status=WorkflowExecutionStepStatus.COMPLETED, email_log=self.email_log
+        )
+        self.waiting = self.lead_step_status(WorkflowExecutionStepStatus.WAITING, now() + timedelta(days=1))
+
+    @mock.patch("workflows.tasks.events.execute_workflow")
+    def test_click_resumes_waiting_step(self, execute_workflow):
+        on_email_clicked(self.lead.id, self.email_log.id, self.LINK)
+
+        execute_workflow.apply_async.assert_called_once()
+        self.assertEqual(execute_workflow.apply_async.call_args.kwargs["kwargs"], {"node_ids": [str(self.step.id)]})
+        self.waiting.refresh_from_db()
+        self.assertEqual(self.waiting.status, WorkflowExecutionStepStatus.PENDING)
+
+    @mock.patch("workflows.tasks.events.execute_workflow")
+    def test_click_on_other_email_or_link_is_ignored(self, execute_workflow):
+        other_log = EmailLog.objects.create(lead=self.lead, subject="Other", sender="sender@example.com", status=EmailStatus.SENT)
+
+        on_email_clicked(self.lead.id, other_log.id, self.LINK)
+        on_email_clicked(self.lead.id, self.email_log.id, "https://example.com/other")
+
+        execute_workflow.apply_async.assert_not_called()
+        self.waiting.refresh_from_db()
+        self.assertEqual(self.waiting.status, WorkflowExecutionStepStatus.WAITING)
+
+    def test_reply_skips_waiting_steps_and_completes_lead(self):
+        on_email_replied(self.lead.id)
+
+        self.waiting.refresh_from_db()
+        self.lead.refresh_from_db()
+        self.assertEqual(self.waiting.status, WorkflowExecutionStepStatus.SKIPPED)
+        self.assertIsNone(self.waiting.resume_at)
+        self.assertEqual(self.lead.workflow_status, LeadWorkflowExecutionStatus.COMPLETED)
+
+    @mock.patch("workflows.tasks.events.release_send_email_slot")
+    def test_reply_releases_deferred_send_slots(self, release_send_email_slot):
+        send_status = LeadStepStatus.objects.get(step=self.send_step)
+        LeadStepStatus.objects.filter(id=send_status.id).update(status=WorkflowExecutionStepStatus.WAITING, resume_at=now() + timedelta(minutes=5))
+        self.send_step.node = {"type": "SEND_EMAIL", "data": {"settings": {"email_account": "sender@example.com"}}}
+        self.send_step.save()
+
+        on_email_replied(self.lead.id)
+
+        release_send_email_slot.assert_called_once_with(self.lead.id, self.send_step, "sender@example.com")
+
+    def test_reply_with_continue_action_keeps_waiting(self):
+        WorkflowSettings.objects.filter(workflow=self.workflow).update(reply_action="continue")
+
+        on_email_replied(self.lead.id)
+
+        self.waiting.refresh_from_db()
+        self.assertEqual(self.waiting.status, WorkflowExecutionStepStatus.WAITING)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EnqueueWorkflowLeadsTests(WorkflowTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for index in range(3):
+            Lead.objects.create(campaign=self.workflow.campaign, email=f"lead{index}@example.com")
+        # Lead già avviato nel workflow: non va riaccodato
+        self.lead_step_status(WorkflowExecutionStepStatus.COMPLETED)
+
+    def enqueue(self):
+        return enqueue_workflow_leads.apply(args=[self.execution.id, {}]).get()
+
+    def test_second_run_does_not_duplicate_queue_rows(self):
+        self.assertEqual(self.enqueue(), {"status": "completed", "queued": 3})
+        self.assertEqual(self.enqueue(), {"status": "completed", "queued": 0})
+
+        self.assertEqual(WorkflowQueue.objects.count(), 3)
+        self.assertFalse(WorkflowQueue.objects.filter(lead=self.lead).exists())
+        self.assertEqual(cache.get(get_enqueue_progress_key(self.execution.id)), 100)
+
+    def test_concurrent_run_is_skipped(self):
+        cache.add(f"workflow_enqueue_lock_{self.execution.id}", "other-task")
+
+        self.assertIsNone(self.enqueue())
+        self.assertEqual(WorkflowQueue.objects.count(), 0)
+
+    def test_enqueue_progress_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.workflow.user)
+        url = f"/api/workflows/{self.workflow.id}/enqueue-progress/"
+
+        self.assertEqual(client.get(url).data, {"progress": None})
+        self.enqueue()
+        self.assertEqual(client.get(url).data, {"progress": 100})
+
+        client.force_authenticate(User.objects.create_user(email="other@example.com", password="password123"))
+        self.assertEqual(client.get(url).status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WorkflowQueueTestCase(WorkflowTestCase):
+    def queue_items(self, count):
+        leads = [Lead.objects.create(campaign=self.workflow.campaign, email=f"queued{index}@example.com") for index in range(count)]
+        return [WorkflowQueue.objects.create(lead=lead, workflow_execution=self.execution, settings={}) for lead in leads]
+
+
+class ScheduleWorkflowBatchTests(WorkflowQueueTestCase):
+    def test_claimed_rows_are_leased_to_the_dispatcher(self):
+        self.queue_items(3)
+
+        claimed = scheduler.claim_queue_items(2)
+
+        self.assertEqual(len(claimed), 2)
+        for queue_item in WorkflowQueue.objects.filter(id__in=[item[0] for item in claimed]):
+            self.assertTrue(queue_item.processing)
+            self.assertTrue(queue_item.worker_id.startswith(DISPATCH_WORKER_PREFIX))
+            self.assertGreater(queue_item.leased_until, now())
+            self.assertEqual(queue_item.attempts, 1)
+        self.assertEqual(len(scheduler.claim_queue_items(5)), 1)
+        self.assertEqual(scheduler.claim_queue_items(5), [])
+
+    def test_concurrent_claims_never_return_the_same_rows(self):
+        self.queue_items(4)
+        get_claimable_ids = scheduler.get_claimable_ids
+        concurrent_claims = []
+
+        def read_then_race(batch_size):
+            # Un altro dispatcher preleva gli stessi elementi tra la lettura e l'UPDATE
+            claimable_ids = get_claimable_ids(batch_size)
+            with mock.patch.object(scheduler, "get_claimable_ids", get_claimable_ids):
+                concurrent_claims.extend(scheduler.claim_queue_items(2))
+            return claimable_ids
+
+        with mock.patch.object(scheduler, "get_claimable_ids", read_then_race):
+            claimed = scheduler.claim_queue_items(4)
+
+        claimed_ids = {item[0] for item in claimed}
+        concurrent_ids = {item[0] for item in concurrent_claims}
+        self.assertEqual((len(claimed_ids), len(concurrent_ids)), (2, 2))
+        self.assertFalse(claimed_ids & concurrent_ids)
+
+    def test_batch_size_without_broker_backlog(self):
+        self.queue_items(10)
+
+        with mock.patch.object(scheduler.current_app, "connection_for_read", side_effect=OSError("broker down")):
+            self.assertEqual(scheduler.get_batch_size(), 10)
+
+    def test_batch_size_shrinks_with_broker_backlog(self):
+        self.queue_items(10)
+
+        with mock.patch.object(scheduler, "get_broker_backlog", return_value=scheduler.BROKER_BACKLOG_LIMIT - 3):
+            self.assertEqual(scheduler.get_batch_size(), 3)
+        with mock.patch.object(scheduler, "get_broker_backlog", return_value=scheduler.BROKER_BACKLOG_LIMIT + 1):
+            self.assertLessEqual(scheduler.get_batch_size(), 0)
+
+    def test_empty_queue_has_no_batch(self):
+        self.assertEqual(scheduler.get_batch_size(), 0)
+
+    @mock.patch.object(scheduler, "DISPATCH_GROUP_SIZE", 2)
+    @mock.patch.object(scheduler, "get_broker_backlog", return_value=0)
+    @mock.patch.object(scheduler, "group")
+    def test_dispatch_publishes_claimed_rows_in_groups(self, group, get_broker_backlog):
+        queue_items = self.queue_items(5)
+
+        scheduler.schedule_workflow_batch()
+
+        signatures = [list(call.args[0]) for call in group.call_args_list]
+        self.assertEqual([len(chunk) for chunk in signatures], [2, 2, 1])
+        self.assertEqual(
+            sorted(signature.kwargs["queue_item_id"] for chunk in signatures for signature in chunk),
+            sorted(queue_item.id for queue_item in queue_items)
+        )
+        self.assertEqual(group.return_value.apply_async.call_count, 3)
+
+
+class QueueLeaseTests(WorkflowQueueTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue_item = self.queue_items(1)[0]
+
+    def test_acquire_conflicts_with_a_live_lease(self):
+        self.assertTrue(QueueLease(self.queue_item.id, "worker-1").acquire())
+        self.assertFalse(QueueLease(self.queue_item.id, "worker-2").acquire())
+        # Stesso worker (task riconsegnato allo stesso processo): il lease viene rinnovato
+        self.assertTrue(QueueLease(self.queue_item.id, "worker-1").acquire())
+
+    def test_acquire_takes_over_dispatcher_claim(self):
+        scheduler.claim_queue_items(1)
+
+        self.assertTrue(QueueLease(self.queue_item.id, "worker-1").acquire())
+        self.queue_item.refresh_from_db()
+        self.assertEqual(self.queue_item.worker_id, "worker-1")
+
+    def test_expired_lease_is_reclaimed(self):
+        QueueLease(self.queue_item.id, "worker-1").acquire()
+        WorkflowQueue.objects.filter(id=self.queue_item.id).update(leased_until=now() - timedelta(seconds=1))
+
+        self.assertTrue(QueueLease(self.queue_item.id, "worker-2").acquire())
+        self.queue_item.refresh_from_db()
+        self.assertEqual(self.queue_item.worker_id, "worker-2")
+
+    def test_heartbeat_extends_the_lease(self):
+        lease = QueueLease(self.queue_item.id, "worker-1")
+        lease.acquire()
+        short_lease = now() + timedelta(seconds=10)
+        WorkflowQueue.objects.filter(id=self.queue_item.id).update(leased_until=short_lease)
+
+        lease.heartbeat()  # Troppo presto: nessun rinnovo
+        self.queue_item.refresh_from_db()
+        self.assertEqual(self.queue_item.leased_until, short_lease)
+
+        lease.last_heartbeat -= QUEUE_HEARTBEAT_INTERVAL
+        lease.heartbeat()
+        self.queue_item.refresh_from_db()
+        self.assertGreater(self.queue_item.leased_until, short_lease)
+
+    def test_release_only_by_the_lease_owner(self):
+        QueueLease(self.queue_item.id, "worker-1").acquire()
+
+        QueueLease(self.queue_item.id, "worker-2").release()
+        self.queue_item.refresh_from_db()
+        self.assertFalse(self.queue_item.processed)
+
+        QueueLease(self.queue_item.id, "worker-1").release()
+        self.queue_item.refresh_from_db()
+        self.assertTrue(self.queue_item.processed)
+        self.assertFalse(self.queue_item.processing)
+
+
+class ResetStuckQueueTests(WorkflowQueueTestCase):
+    def test_expired_leases_are_requeued(self):
+        expired, live = self.queue_items(2)
+        WorkflowQueue.objects.filter(id=expired.id).update(processing=True, worker_id="worker-1", leased_until=now() - timedelta(seconds=1), attempts=1)
+        WorkflowQueue.objects.filter(id=live.id).update(processing=True, worker_id="worker-2", leased_until=now() + timedelta(minutes=5), attempts=1)
+
+        scheduler.reset_stuck_queue()
+
+        expired.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual((expired.processing, expired.worker_id, expired.leased_until), (False, None, None))
+        self.assertEqual((live.processing, live.worker_id), (True, "worker-2"))
+        self.assertEqual([item[0] for item in scheduler.claim_queue_items(5)], [expired.id])
+
+    def test_discarded_after_max_attempts(self):
+        queue_item = self.queue_items(1)[0]
+        WorkflowQueue.objects.filter(id=queue_item.id).update(
+            processing=True, worker_id="worker-1", leased_until=now() - timedelta(seconds=1), attempts=scheduler.MAX_QUEUE_ATTEMPTS
+        )
+
+        scheduler.reset_stuck_queue()
+
+        queue_item.refresh_from_db()
+        self.assertTrue(queue_item.processed)
+        self.assertFalse(queue_item.processing)
+        self.assertIsNotNone(queue_item.processed_at)
+        self.assertEqual(scheduler.claim_queue_items(5), [])
+
+
+class SendWindowTests(SimpleTestCase):
+    ROME = pytz.timezone("Europe/Rome")
+    WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+
+    def settings(self, days=WEEKDAYS, start="08:00:00", end="18:00:00"):
+        return {"sending_days": days, "sending_time_start": start, "sending_time_end": end}
+
+    def local(self, *args):
+        return self.ROME.localize(datetime(*args))
+
+    def next_send_time(self, settings, reference, jitter=timedelta(0)):
+        return get_next_send_time(settings, self.ROME, reference=reference, jitter=jitter)
+
+    def test_inside_window(self):
+        self.assertIsNone(self.next_send_time(self.settings(), self.local(2025, 4, 14, 10, 0)))  # Lunedì
+
+    def test_before_window_opens_today(self):
+        self.assertEqual(self.next_send_time(self.settings(), self.local(2025, 4, 14, 7, 0)), self.local(2025, 4, 14, 8, 0))
+
+    def test_after_window_opens_next_day(self):
+        self.assertEqual(self.next_send_time(self.settings(), self.local(2025, 4, 14, 19, 0)), self.local(2025, 4, 15, 8, 0))
+
+    def test_weekend_wraps_to_next_sending_day(self):
+        self.assertEqual(self.next_send_time(self.settings(), self.local(2025, 4, 18, 18, 30)), self.local(2025, 4, 21, 8, 0))
+        self.assertEqual(
+            self.next_send_time(self.settings(days=["Wednesday"]), self.local(2025, 4, 17, 9, 0)),
+            self.local(2025, 4, 23, 8, 0)
+        )
+
+    def test_dst_transition_keeps_local_opening_time(self):
+        settings = self.settings(days=["sunday"])
+
+        # Passaggio all'ora legale (30 marzo 2025): le 08:00 locali sono le 06:00 UTC
+        spring = self.next_send_time(settings, self.local(2025, 3, 29, 19, 0))
+        self.assertEqual(spring.astimezone(pytz.utc), pytz.utc.localize(datetime(2025, 3, 30, 6, 0)))
+        # Ritorno all'ora solare (26 ottobre 2025): le 08:00 locali sono le 07:00 UTC
+        autumn = self.next_send_time(settings, self.local(2025, 10, 25, 19, 0))
+        self.assertEqual(autumn.astimezone(pytz.utc), pytz.utc.localize(datetime(2025, 10, 26, 7, 0)))
+
+    def test_reference_in_another_timezone(self):
+        # 06:30 UTC = 08:30 a Roma (ora legale): già nella finestra
+        self.assertIsNone(self.next_send_time(self.settings(), pytz.utc.localize(datetime(2025, 4, 14, 6, 30))))
+
+    def test_jitter_stays_within_bounds_and_window(self):
+        opening = self.local(2025, 4, 15, 8, 0)
+        for _ in range(50):
+            next_time = self.next_send_time(self.settings(), self.local(2025, 4, 14, 19, 0), jitter=timedelta(minutes=15))
+            self.assertTrue(opening <= next_time <= opening + timedelta(minutes=15))
+
+            # Finestra più corta del jitter: la ripresa non esce dalla finestra
+            next_time = self.next_send_time(self.settings(end="08:05:00"), self.local(2025, 4, 14, 19, 0), jitter=timedelta(minutes=15))
+            self.assertTrue(opening <= next_time <= opening + timedelta(minutes=5))
+
+    def test_no_sending_days(self):
+        for days in ([], None):
+            with self.assertRaises(ValueError):
+                self.next_send_time(self.settings(days=days), self.local(2025, 4, 14, 10, 0))
+
+
+@mock.patch("django.core.signing.time.time", return_value=1700000000)  # Firme identiche tra i due percorsi
+class CompiledEmailTemplateTests(TestCase):
+    DOMAIN = "app.example.com"
+
+    def setUp(self):
+        user = User.objects.create_user(email="owner@example.com", password="password123")
+        campaign = Campaign.objects.create(user=user, name="Campaign")
+        self.lead = Lead.objects.create(
+            campaign=campaign, email="lead@example.com", first_name="Mario", last_name="Rossi",
+            company="Rossi & <Figli> \"Srl\"", website="https://rossi.example.com"
+        )
+
+    def assertRendersLikeLegacy(self, text, track_links=True, compiled=True):
+        template = CompiledEmailTemplate(text, track_links, self.DOMAIN)
+        expected = replace_placeholders(text, self.lead)
+        if track_links:
+            expected = prepare_email_body(expected, self.lead.id, 42, self.DOMAIN)
+
+        self.assertEqual(template.compiled, compiled)
+        self.assertEqual(template.render(self.lead, 42), expected)
+        return template
+
+    def test_missing_and_unknown_placeholders(self, _):
+        self.lead.phone = None
+        self.assertRendersLikeLegacy("Ciao {first_name}, tel. {phone} {unknown} {}", track_links=False)
+        self.assertRendersLikeLegacy("Ciao {first_name}, tel. {phone} {unknown} {}")
+
+    def test_html_special_values_are_inserted_as_is(self, _):
+        self.assertRendersLikeLegacy("<p>{company}</p><p title=\"{company}\">&amp; {last_name}</p>")
+
+    def test_repeated_and_adjacent_placeholders(self, _):
+        self.assertRendersLikeLegacy("{first_name}{last_name} {first_name}{first_name}\n{last_name}", track_links=False)
+        self.assertRendersLikeLegacy("{first_name}{last_name} {first_name}{first_name}\n{last_name}")
+
+    def test_links_and_unsubscribe_are_rewritten(self, _):
+        self.assertRendersLikeLegacy(
+            '<a href="https://example.com/a">A</a> https://example.com/b <a href=\'https://example.com/a\'>again</a>'
+            ' <a href="https://app.example.com/already">tracked</a> <a href="{unsubscribe_link}">Unsubscribe</a>'
+            ' {unsubscribe_link} <a href="{website}">{website}</a>'
+        )
+
+    def test_placeholder_inside_url_uses_legacy_render(self, _):
+        self.assertRendersLikeLegacy('<a href="https://example.com/?c={company}">x</a>', compiled=False)
+        self.assertRendersLikeLegacy("https://example.com/{first_name}", compiled=False)
+
+    def test_url_value_next_to_text_uses_legacy_render(self, _):
+        with mock.patch.object(CompiledEmailTemplate, "_render_legacy", autospec=True, side_effect=CompiledEmailTemplate._render_legacy) as render_legacy:
+            self.assertRendersLikeLegacy("Sito:{website}.")
+            self.assertRendersLikeLegacy("Sito: {website} ")
+        # Solo il valore attaccato al testo richiede il render completo
+        self.assertEqual(render_legacy.call_count, 1)
@@ -0,0 +1,218 @@
+import re
+from functools import lru_cache
+from itertools import chain
+from django.core import signing
+from django.urls import reverse
+from leads.models import Lead
+from workflows.utils.email_placeholders import CUSTOM_PLACEHOLDER_FUNCTIONS, replace_placeholders
+from workflows.utils.email_tracking import wrap_plain_links, prepare_email_body
+
+COMPILED_TEMPLATE_CACHE_SIZE = 256  # Template compilati tenuti in memoria per processo
+
+PLACEHOLDER_PATTERN = re.compile(r"\{([a-zA-Z0-9_]+)\}")
+HREF_PATTERN = re.compile(r'(href)\s*=\s*["\'](https?://[^"\']+)["\']')
+URL_PATTERN = re.compile(r"https?://")
+UNSAFE_LINK_VALUE_PATTERN = re.compile(r"[\s\"'<]")
+
+# Segnaposto interni usati durante la compilazione al posto dei placeholder
+MARKER = "\x00{}\x00"
+MARKER_PATTERN = re.compile(r"\x00(\d+)\x00")
+HREF_MARKER = "\x01{}\x01"
+HREF_MARKER_PATTERN = re.compile(r"\x01(\d+)\x01")
+EXACT_HREF_PLACEHOLDER_PATTERN = re.compile(r'href=(["\'])\x00(\d+)\x00\1')
+UNSAFE_MARKER_PATTERNS = [
+    re.compile(r'https?://[^\s<"]*[\x00\x01]'),  # Placeholder dentro un URL
+    re.compile(r'href\s*=\s*["\'][^"\']*\x00'),  # Placeholder dentro un href
+]
+MARKER_BEFORE_URL_PATTERN = re.compile(r"[\x00\x01]https?://")  # Placeholder attaccato a un URL
+
+TEXT, PLACEHOLDER, LINK, PLACEHOLDER_LINK = range(4)
+
+CLICK_URL_ARG = "SIGNEDDATA"
+
+
+def _lead_fields():
+    """
+    Campi del Lead disponibili come placeholder (gli stessi restituiti da `model_to_dict`).
+    """
+    opts = Lead._meta
+    return {
+        field.name: field
+        for field in chain(opts.concrete_fields, opts.private_fields, opts.many_to_many)
+        if getattr(field, "editable", False)
+    }
+
+
+def _resolve_placeholder(key, lead, lead_fields):
+    if key in CUSTOM_PLACEHOLDER_FUNCTIONS:
+        try:
+            return str(CUSTOM_PLACEHOLDER_FUNCTIONS[key](lead))
+        except Exception as e:
+            return f"[Errore: {e}]"
+    return str(lead_fields[key].value_from_object(lead))
+
+
+class CompiledEmailTemplate:
+    """
+    Template di una email già analizzato: testo fisso, placeholder e link tracciabili
+    sono separati una volta sola, il render per lead diventa una semplice join.
+    Se il template non è compilabile in modo equivalente (es. placeholder dentro un URL)
+    il render usa `replace_placeholders` + `prepare_email_body`.
+    """
+
+    def __init__(self, text, track_links, domain):
+        self.text = text
+        self.track_links = track_links
+        self.domain = domain
+        self.lead_fields = _lead_fields()
+        self.compiled = True
+        self.isolated = {}
+        self.segments = self._compile(text)
+
+        if track_links:
+            # reverse() risolto una volta sola: per ogni link basta concatenare il payload firmato
+            click_path = reverse("track_email_click", args=[CLICK_URL_ARG])
+            self.click_url_prefix, self.click_url_suffix = f"https://{domain}{click_path}".split(CLICK_URL_ARG)
+
+    def _compile(self, text):
+        keys = []
+
+        def mark(match):
+            key = match.group(1)
+            if key not in CUSTOM_PLACEHOLDER_FUNCTIONS and key not in self.lead_fields:
+                return match.group(0)  # Placeholder sconosciuto: resta invariato
+            keys.append(key)
+            return MARKER.format(len(keys) - 1)
+
+        marked = PLACEHOLDER_PATTERN.sub(mark, text)
+
+        if not self.track_links:
+            return self._split_placeholders(marked, keys)
+
+        # href="{placeholder}": il valore viene tracciato al momento del render
+        href_placeholders = []
+
+        def mark_href(match):
+            href_placeholders.append((match.group(1), keys[int(match.group(2))]))
+            return HREF_MARKER.format(len(href_placeholders) - 1)
+
+        marked = EXACT_HREF_PLACEHOLDER_PATTERN.sub(mark_href, marked)
+        unsafe = MARKER_BEFORE_URL_PATTERN.search(marked)
+        marked = wrap_plain_links(marked)
+
+        if unsafe or any(pattern.search(marked) for pattern in UNSAFE_MARKER_PATTERNS):
+            self.compiled = False
+            return []
+
+        self.isolated = {
+            int(match.group(1)): self._is_isolated(marked, match.start(), match.end())
+            for match in MARKER_PATTERN.finditer(marked)
+        }
+
+        segments = []
+        position = 0
+        for match in HREF_PATTERN.finditer(marked):
+            segments.extend(self._split_href_placeholders(marked[position:match.start()], keys, href_placeholders))
+            url = match.group(2)
+            if self.domain in url:
+                segments.append((TEXT, match.group(0)))  # Link già tracciato
+            else:
+                segments.append((LINK, url))
+            position = match.end()
+        segments.extend(self._split_href_placeholders(marked[position:], keys, href_placeholders))
+        return segments
+
+    def _split_href_placeholders(self, text, keys, href_placeholders):
+        segments = []
+        position = 0
+        for match in HREF_MARKER_PATTERN.finditer(text):
+            segments.extend(self._split_placeholders(text[position:match.start()], keys))
+            segments.append((PLACEHOLDER_LINK, href_placeholders[int(match.group(1))]))
+            position = match.end()
+        segments.extend(self._split_placeholders(text[position:], keys))
+        return segments
+
+    def _split_placeholders(self, text, keys):
+        segments = []
+        position = 0
+        for match in MARKER_PATTERN.finditer(text):
+            if match.start() > position:
+                segments.append((TEXT, text[position:match.start()]))
+            index = int(match.group(1))
+            segments.append((PLACEHOLDER, (keys[index], self.isolated.get(index, False))))
+            position = match.end()
+        if position < len(text):
+            segments.append((TEXT, text[position:]))
+        return segments
+
+    @staticmethod
+    def _is_isolated(text, start, end):
+        """
+        Un valore che contiene un URL può essere elaborato da solo solo se il testo attorno
+        non cambia i confini del link trovato dalle regex di `prepare_email_body`.
+        """
+        before = text[start - 1] if start > 0 else " "
+        after = text[end] if end < len(text) else " "
+        return not (before.isalnum() or before in "_\x00\x01") and (after.isspace() or after in '<"')
+
+    def _tracking_url(self, url, lead_id, email_log_id, signer, signed_urls):
+        tracking_url = signed_urls.get(url)
+        if tracking_url is None:
+            signed_data = signer.sign_object({
+                "lead_id": lead_id,
+                "email_log_id": email_log_id,
+                "url": url,
+            })
+            tracking_url = f"{self.click_url_prefix}{signed_data}{self.click_url_suffix}"
+            signed_urls[url] = tracking_url
+        return tracking_url
+
+    def _render_legacy(self, lead, email_log_id):
+        text = replace_placeholders(self.text, lead)
+        if self.track_links:
+            text = prepare_email_body(text, lead.id, email_log_id, self.domain)
+        return text
+
+    def render(self, lead, email_log_id=None):
+        if not self.compiled:
+            return self._render_legacy(lead, email_log_id)
+
+        signer = signing.TimestampSigner(salt="django.core.signing") if self.track_links else None
+        signed_urls = {}  # Link uguali nella stessa email vengono firmati una volta sola
+        parts = []
+
+        for kind, value in self.segments:
+            if kind == TEXT:
+                parts.append(value)
+
+            elif kind == LINK:
+                parts.append(f'href="{self._tracking_url(value, lead.id, email_log_id, signer, signed_urls)}"')
+
+            elif kind == PLACEHOLDER:
+                key, isolated = value
+                resolved = _resolve_placeholder(key, lead, self.lead_fields)
+                if self.track_links and URL_PATTERN.search(resolved):
+                    if not isolated:
+                        return self._render_legacy(lead, email_log_id)
+                    resolved = prepare_email_body(resolved, lead.id, email_log_id, self.domain)
+                parts.append(resolved)
+
+            else:  # PLACEHOLDER_LINK
+                quote, key = value
+                resolved = _resolve_placeholder(key, lead, self.lead_fields)
+                if UNSAFE_LINK_VALUE_PATTERN.search(resolved) or len(URL_PATTERN.findall(resolved)) > 1:
+                    return self._render_legacy(lead, email_log_id)
+                if URL_PATTERN.match(resolved) and self.domain not in resolved:
+                    parts.append(f'href="{self._tracking_url(resolved, lead.id, email_log_id, signer, signed_urls)}"')
+                else:
+                    parts.append(f"href={quote}{resolved}{quote}")
+
+        return "".join(parts)
+
+
+@lru_cache(maxsize=COMPILED_TEMPLATE_CACHE_SIZE)
+def get_email_template(text, track_links=False, domain=None):
+    """
+    Restituisce il template compilato (cache per processo: ogni nodo SEND_EMAIL viene analizzato una volta).
+    """
+    return CompiledEmailTemplate(text, track_links, domain)
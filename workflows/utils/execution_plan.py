@@ -0,0 +1,154 @@
+import heapq
+import json
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from django.core.cache import cache
+from workflows.models import WorkflowExecution, WorkflowExecutionStep
+
+PLAN_CACHE_TIMEOUT = 60 * 60 * 24  # Piano condiviso in cache per 24 ore
+LOCAL_PLAN_CACHE_SIZE = 128  # Piani tenuti in memoria per processo worker
+LOCAL_PLAN_CACHE_TIMEOUT = 60 * 5  # Oltre questo tempo il piano locale viene riletto dalla cache condivisa
+
+_local_plans = OrderedDict()
+_local_plans_lock = Lock()
+
+
+class PlanNode:
+    """
+    Nodo del workflow già compilato: payload JSON decodificato e adiacenze risolte.
+    """
+    __slots__ = ("id", "step", "number", "type", "data", "parent_id", "condition", "children")
+
+    def __init__(self, step):
+        node_data = step.node
+        if isinstance(node_data, str):
+            node_data = json.loads(node_data)
+
+        self.id = step.id
+        self.step = step
+        self.number = step.number
+        self.type = node_data.get("type")
+        self.data = node_data
+        self.parent_id = step.parent_node_id
+        self.condition = step.condition
+        self.children = []
+
+    @property
+    def settings(self):
+        return self.data.get("data", {}).get("settings", {})
+
+
+class ExecutionPlan:
+    """
+    Rappresentazione in memoria di una WorkflowExecution: nodi in ordine topologico
+    (a parità di livello vale il `number` dello step) e mappa parent -> figli.
+    """
+
+    def __init__(self, workflow_execution, steps):
+        self.workflow_execution = workflow_execution
+        self.nodes_by_id = {}
+
+        for step in steps:
+            step.workflow_execution = workflow_execution  # Evita una query per step nei nodi
+            self.nodes_by_id[step.id] = PlanNode(step)
+
+        for node in self.nodes_by_id.values():
+            parent = self.nodes_by_id.get(node.parent_id)
+            if parent:
+                parent.children.append(node)
+
+        for node in self.nodes_by_id.values():
+            node.children.sort(key=lambda child: child.number)
+
+        self.nodes = self._topological_order()
+
+    def _topological_order(self):
+        roots = [node for node in self.nodes_by_id.values() if node.parent_id not in self.nodes_by_id]
+        heap = [(node.number, str(node.id), node) for node in roots]
+        heapq.heapify(heap)
+
+        ordered = []
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            ordered.append(node)
+            for child in node.children:
+                heapq.heappush(heap, (child.number, str(child.id), child))
+        return ordered
+
+    def get(self, node_id):
+        if node_id is not None and not isinstance(node_id, uuid.UUID):
+            node_id = uuid.UUID(str(node_id))
+        return self.nodes_by_id.get(node_id)
+
+    def parent(self, node):
+        return self.nodes_by_id.get(node.parent_id)
+
+    def ancestors(self, node):
+        parent = self.parent(node)
+        while parent:
+            yield parent
+            parent = self.parent(parent)
+
+
+def build_execution_plan(workflow_execution_id):
+    # L'utente resta fuori dal piano: le sue impostazioni (es. timezone) si leggono a ogni esecuzione
+    workflow_execution = WorkflowExecution.objects.select_related("workflow").get(id=workflow_execution_id)
+    steps = WorkflowExecutionStep.objects.filter(workflow_execution_id=workflow_execution_id).order_by("number")
+    return ExecutionPlan(workflow_execution, list(steps))
+
+
+def _version_key(workflow_execution_id):
+    return f"workflow_plan_version:{workflow_execution_id}"
+
+
+def get_plan_version(workflow_execution_id):
+    key = _version_key(workflow_execution_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, timeout=None)
+        version = cache.get(key, 1)
+    return version
+
+
+def invalidate_execution_plan(workflow_execution_id):
+    """
+    Incrementa la versione del piano: worker e cache condivisa ricompileranno il workflow.
+    """
+    key = _version_key(workflow_execution_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, timeout=None)
+
+
+def get_execution_plan(workflow_execution_id):
+    """
+    Restituisce il piano compilato della WorkflowExecution, cercandolo nell'LRU del processo
+    (con scadenza), poi nella cache condivisa e solo in ultima istanza ricostruendolo dal database.
+    """
+    version = get_plan_version(workflow_execution_id)
+    local_key = (str(workflow_execution_id), version)
+
+    with _local_plans_lock:
+        entry = _local_plans.get(local_key)
+        if entry is not None:
+            plan, expires_at = entry
+            if expires_at > time.monotonic():
+                _local_plans.move_to_end(local_key)
+                return plan
+            del _local_plans[local_key]
+
+    shared_key = f"workflow_plan:{workflow_execution_id}:{version}"
+    plan = cache.get(shared_key)
+    if plan is None:
+        plan = build_execution_plan(workflow_execution_id)
+        cache.set(shared_key, plan, timeout=PLAN_CACHE_TIMEOUT)
+
+    with _local_plans_lock:
+        _local_plans[local_key] = (plan, time.monotonic() + LOCAL_PLAN_CACHE_TIMEOUT)
+        while len(_local_plans) > LOCAL_PLAN_CACHE_SIZE:
+            _local_plans.popitem(last=False)
+
+    return plan
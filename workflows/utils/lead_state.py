@@ -0,0 +1,91 @@
+import pytz
+from leads.models import Lead
+from users.models import User
+from workflows.models import LeadStepStatus, WorkflowExecutionStepStatus
+
+# Campi di LeadStepStatus modificati dagli step e scritti con bulk_update
+LEAD_STEP_STATUS_FIELDS = ["status", "condition", "started_at", "completed_at", "resume_at", "email_log"]
+
+
+class LeadState:
+    """
+    Snapshot in memoria di tutti i LeadStepStatus di un lead per un workflow, caricato con una sola query.
+    Gli step leggono e modificano lo snapshot; le scritture vengono raccolte e salvate con `flush()`.
+    """
+
+    def __init__(self, plan, lead):
+        self.plan = plan
+        self.lead = lead
+        self.workflow = plan.workflow_execution.workflow
+        self.statuses = {
+            lead_step_status.step_id: lead_step_status
+            for lead_step_status in LeadStepStatus.objects.filter(
+                lead=lead,
+                workflow=self.workflow
+            ).select_related("email_log")
+        }
+        self._created = {}
+        self._updated = {}
+        self._user_timezone = None
+
+    @classmethod
+    def load(cls, plan, lead_id):
+        return cls(plan, Lead.objects.get(id=lead_id))
+
+    @property
+    def user_timezone(self):
+        """
+        Timezone dell'utente letta dal database una volta per esecuzione: il piano in cache non include l'utente,
+        così una modifica alle impostazioni vale dalla prossima esecuzione.
+        """
+        if self._user_timezone is None:
+            timezone = User.objects.filter(id=self.workflow.user_id).values_list("timezone", flat=True).first()
+            self._user_timezone = pytz.timezone(timezone or "UTC")
+        return self._user_timezone
+
+    def get(self, step_id):
+        return self.statuses.get(step_id)
+
+    def get_or_create(self, step):
+        lead_step_status = self.statuses.get(step.id)
+        if lead_step_status is None:
+            lead_step_status = LeadStepStatus(lead=self.lead, workflow=self.workflow, step=step)
+            self.statuses[step.id] = lead_step_status
+            self._created[step.id] = lead_step_status
+        return lead_step_status
+
+    def save(self, lead_step_status):
+        """
+        Segna lo stato come da salvare (i nuovi stati sono già tracciati da `get_or_create`).
+        """
+        if lead_step_status.pk is not None:
+            self._updated[lead_step_status.pk] = lead_step_status
+
+    def is_completed(self, step_id):
+        lead_step_status = self.statuses.get(step_id)
+        return lead_step_status is not None and lead_step_status.status == WorkflowExecutionStepStatus.COMPLETED
+
+    def is_waiting(self, step_id):
+        lead_step_status = self.statuses.get(step_id)
+        return lead_step_status is not None and lead_step_status.status in (
+            WorkflowExecutionStepStatus.WAITING,
+            WorkflowExecutionStepStatus.PENDING,
+        )
+
+    def find_previous_email_log(self, node):
+        """
+        Risale i nodi padre e restituisce l'EmailLog dell'ultimo SEND_EMAIL eseguito per il lead.
+        """
+        for parent in self.plan.ancestors(node):
+            lead_step_status = self.statuses.get(parent.id)
+            if lead_step_status and lead_step_status.email_log:
+                return lead_step_status.email_log
+        return None
+
+    def flush(self):
+        if self._created:
+            LeadStepStatus.objects.bulk_create(list(self._created.values()))
+        if self._updated:
+            LeadStepStatus.objects.bulk_update(list(self._updated.values()), LEAD_STEP_STATUS_FIELDS)
+        self._created = {}
+        self._updated = {}
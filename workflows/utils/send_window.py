@@ -0,0 +1,55 @@
+import random
+from datetime import datetime, time as dt_time, timedelta
+from django.utils.timezone import now
+
+SEND_WINDOW_JITTER = timedelta(minutes=15)  # Sparpaglia le riprese all'apertura della finestra
+SEND_WINDOW_LOOKAHEAD_DAYS = 7
+
+
+def _parse_time(value):
+    if isinstance(value, dt_time):
+        return value
+    return dt_time.fromisoformat(value)
+
+
+def _localize(user_timezone, day, at):
+    naive = datetime.combine(day, at)
+    if hasattr(user_timezone, "localize"):  # pytz
+        return user_timezone.normalize(user_timezone.localize(naive))
+    return naive.replace(tzinfo=user_timezone)
+
+
+def get_next_send_time(settings, user_timezone, reference=None, jitter=SEND_WINDOW_JITTER):
+    """
+    Restituisce None se `reference` (default: adesso) cade nella finestra di invio
+    (`sending_days` tra `sending_time_start` e `sending_time_end` nel fuso dell'utente),
+    altrimenti l'istante di apertura della prossima finestra valida più un jitter casuale.
+    Solleva ValueError se nessun giorno è abilitato all'invio.
+    """
+    sending_days = [day.lower() for day in settings.get("sending_days") or []]
+    if not sending_days:
+        raise ValueError("No sending days configured")
+
+    start_time = _parse_time(settings.get("sending_time_start"))
+    end_time = _parse_time(settings.get("sending_time_end"))
+
+    reference = reference or now()
+    local_now = reference.astimezone(user_timezone)
+
+    for offset in range(SEND_WINDOW_LOOKAHEAD_DAYS + 1):
+        day = local_now.date() + timedelta(days=offset)
+        if day.strftime("%A").lower() not in sending_days:
+            continue
+
+        window_start = _localize(user_timezone, day, start_time)
+        window_end = _localize(user_timezone, day, end_time)
+        if window_end < local_now:
+            continue
+        if window_start <= local_now:
+            return None
+
+        # Jitter limitato alla durata della finestra, per non uscirne
+        max_jitter = min(jitter, window_end - window_start).total_seconds()
+        return window_start + timedelta(seconds=random.uniform(0, max(max_jitter, 0)))
+
+    raise ValueError("No valid sending window found")
@@ -1,10 +1,12 @@
 from uuid import UUID
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from .models import Workflow, WorkflowExecution, WorkflowExecutionStep, WorkflowSettings
+from .tasks.enqueue import get_enqueue_progress_key
 from .serializers import (
     WorkflowExecutionWithStepsSerializer, 
     WorkflowExecutionSerializer, 
@@ -41,6 +43,19 @@ class WorkflowViewSet(viewsets.ModelViewSet):
 
         return Response({'status': workflow.status}, status=status.HTTP_200_OK)
     
+    @action(detail=True, methods=['get'], url_path='enqueue-progress')
+    def enqueue_progress(self, request, pk=None):
+        """ Avanzamento (0-100) dell'accodamento dei lead dopo la pubblicazione con start="all" """
+        workflow = self.get_object()
+
+        try:
+            workflow_execution = workflow.execution
+        except WorkflowExecution.DoesNotExist:
+            return Response({"error": "Workflow execution not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        progress = cache.get(get_enqueue_progress_key(workflow_execution.id))
+        return Response({"progress": progress})
+
     # get workflows by campaign id
     @action(detail=False, methods=['get'], url_path='campaign/(?P<campaign_id>[^/.]+)')
     def get_by_campaign_id(self, request, campaign_id):
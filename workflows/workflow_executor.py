@@ -1,25 +1,29 @@
 import json
+from collections import deque
+from workflows.models import WorkflowExecutionStepStatus
 from workflows.steps.send_email import execute_send_email
 from workflows.steps.wait import execute_wait
 from workflows.steps.check_link_clicked import execute_check_link_clicked
 
 
-def execute_step(step, lead_id, settings, task):
+def execute_step(step, state, settings, task, node_data=None):
     try:
-        node_data = step.node
-        if isinstance(node_data, str):
-            node_data = json.loads(node_data)
+        # Il piano compilato passa il nodo già decodificato
+        if node_data is None:
+            node_data = step.node
+            if isinstance(node_data, str):
+                node_data = json.loads(node_data)
 
         node_type = node_data.get("type")
 
         if node_type == "SEND_EMAIL":
-            return execute_send_email(step, lead_id, settings, task, node_data)
+            return execute_send_email(step, state, settings, task, node_data)
 
         elif node_type == "WAIT":
-            return execute_wait(step, lead_id, node_data)
+            return execute_wait(step, state, node_data)
 
         elif node_type == "CHECK_LINK_CLICKED":
-            return execute_check_link_clicked(step, lead_id, node_data)
+            return execute_check_link_clicked(step, state, node_data)
 
         else:
             print(f"⚠️ Nodo {node_type} non supportato.")
@@ -31,6 +35,81 @@ def execute_step(step, lead_id, settings, task):
 
 
 
+def is_node_ready(plan, state, node):
+    """
+    Un nodo è eseguibile se è una radice oppure se il suo parent è completato
+    e, per i rami di un CHECK_LINK_CLICKED, la condizione corrisponde.
+    """
+    if not node.parent_id:
+        return True
+
+    parent_node = plan.parent(node)
+    if not parent_node:
+        return False  # Parent non presente nel workflow
+
+    parent_status = state.get(parent_node.id)
+    if parent_status is None or parent_status.status != WorkflowExecutionStepStatus.COMPLETED:
+        return False
+
+    if parent_node.type == "CHECK_LINK_CLICKED" and node.condition in ("YES", "NO"):
+        return parent_status.condition == node.condition
+
+    return True
+
+
+def get_ready_nodes(plan, state):
+    """
+    Frontiera del lead: nodi non ancora completati ma eseguibili.
+    """
+    return [
+        node for node in plan.nodes
+        if not state.is_completed(node.id) and is_node_ready(plan, state, node)
+    ]
+
+
+def advance_lead(plan, state, settings, task, start_nodes=None, heartbeat=None):
+    """
+    Fa avanzare il lead nel workflow partendo dai nodi indicati (o dalla sua frontiera):
+    ogni nodo completato accoda solo i propri successori.
+    Restituisce (stopped, waiting_nodes): `stopped` è il nodo che ha interrotto il workflow.
+    `heartbeat` viene chiamato dopo ogni nodo per rinnovare il lease del worker.
+    """
+    if start_nodes is None:
+        start_nodes = get_ready_nodes(plan, state)
+    else:
+        # Eventi per nodi non più in attesa (timer già ripreso, workflow fermato) vengono ignorati
+        start_nodes = [node for node in start_nodes if state.is_waiting(node.id)]
+
+    queue = deque(start_nodes)
+    waiting_nodes = []
+
+    while queue:
+        node = queue.popleft()
+
+        if state.is_completed(node.id):
+            continue
+
+        if not is_node_ready(plan, state, node):
+            continue
+
+        result = execute_step(node.step, state, settings, task=task, node_data=node.data)
+
+        if heartbeat:
+            heartbeat()
+
+        # Nodo in attesa: questo ramo riprenderà allo scadere del timer
+        if result == WorkflowExecutionStepStatus.WAITING:
+            waiting_nodes.append(node)
+            continue
+
+        if result is False:
+            return node, waiting_nodes
+
+        queue.extend(node.children)
+
+    return None, waiting_nodes
+
+
 
 # import re
 # import json